@@ -33,6 +33,12 @@ GENCODE_VERSION = 48
 # Set number of parallel processes for data ingestion on a single node
 NUM_PROCS = 8
 
+# `pheweb2 process` runs independent steps at the same time, each with NUM_PROCS processes. Set how many of the steps that read or write every variant (parsing, sites, annotation, matrix, ...) may run at once.
+PROCESS_MAX_IO_STEPS = 2
+
+# Set how much memory (in GB) the parallel processes of data ingestion may use on a node. A task only starts if the memory that its input size suggests still fits, so steps with big phenotypes run fewer tasks at once instead of running out of memory. By default, the memory that the node has available is used. The steps that `pheweb2 process` runs at once share the budget, which counts the memory of all of their processes.
+#MEMORY_BUDGET_GB = 64.0
+
 # Please specify the value in the "test" column of your GWAS files that indicates rows with the main effect of the tested variant. For Regenie and PLINK2, this value should be set to “ADD” to denote rows with an additive effect. If Regenie was executed with the –interaction option, then “ADD-CONDTL” can also be used.
 ASSOC_TEST_NAME = ["ADD", "ADD-CONDTL"]
 
@@ -111,6 +117,8 @@ MANHATTAN_PEAK_SPRAWL_DIST = 200_000
 MANHATTAN_PEAK_VARIANT_COUNTING_PVAL_THRESHOLD = 5e-8
 TOP_HITS_PVAL_CUTOFF = 1e-6
 PHENO_CORRELATIONS_PVALUE_THRESHOLD = 0.05
+# Maximum number of bytes of `autocomplete.db` that API workers memory-map (SQLite caps it at its compile-time limit).
+AUTOCOMPLETE_MMAP_SIZE = 2**34
 
 
 
@@ -6,7 +6,6 @@ from flask_restx import Api, apidoc
 from .blueprints import phenotype_routes, gene_routes, variant_routes, autocomplete
 from flask_cors import CORS
 from dotenv import load_dotenv
-from .models.variant_utils import VariantLoading
 from .models.autocomplete_util import AutocompleteLoading
 from .conf import get_cors_origins, is_debug_mode, get_host, get_port, get_num_api_workers, get_api_url_prefix
 load_dotenv()
@@ -1,17 +1,27 @@
 from flask import Blueprint, request, current_app
-from flask_restx import Namespace, Resource
+from flask_restx import Namespace, Resource, reqparse
 import re
+import concurrent.futures
 from ..models.autocomplete_util import AutocompleteLoading
+from ..models.pheno_search import normalize_query
+from .cache import cache
 
 autocomplete_service = AutocompleteLoading()
 
 bp = Blueprint("autocomplete", __name__)
 api = Namespace("autocomplete", description="Routes related to autocomplete")
 
-def search_gene_names(query):
-    
-    results = autocomplete_service.query_genes(query)
-    # print(f"DEBUG: results: {results}")
+DEFAULT_NUM_SUGGESTIONS = 10
+MAX_NUM_SUGGESTIONS = 50
+SEARCH_TIMEOUT_SECONDS = 1.0  # backends that take longer are left out of the response
+
+search_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+gene_like_pattern = re.compile(r"^[A-Za-z][A-Za-z0-9\-\.]*$")
+rsid_pattern = re.compile(r"^rs\d+$", re.IGNORECASE)
+
+def search_gene_names(query, max_results=4):
+    results = autocomplete_service.query_genes(query, max_results=max_results)
     output = []
     for gene, chrom, start, stop in results:
         output.append({
@@ -24,9 +34,8 @@ def search_gene_names(query):
     return output
 
 
-def search_pheno_names(query):
-    results = autocomplete_service.query_phenotypes(query)
-    # print(f"DEBUG: results: {results}")
+def search_pheno_names(query, max_results=4):
+    results = autocomplete_service.query_phenotypes(query, max_results=max_results)
     output = []
     for phenocode, phenostring in results:
         output.append({
@@ -37,16 +46,11 @@ def search_pheno_names(query):
     return output
 
 
-def search_variant_names(query, chrom=None, pos=None):
-    print("DEBUG: search_variant_names called")
-    print(f"DEBUG: query: {query}")
-    # autocomplete_service = current_app.config["AUTOCOMPLETE"]
+def search_variant_names(query, chrom=None, pos=None, max_results=4):
     if chrom and pos:
-        results = autocomplete_service.query_variants(query, chrom=chrom, pos=pos)
-        print(f"DEBUG: variant query results: {results}")
+        results = autocomplete_service.query_variants(query, chrom=chrom, pos=pos, max_results=max_results)
     else:
-        results = autocomplete_service.query_variants(query)
-    # print("DEBUG: results", results)
+        results = autocomplete_service.query_variants(query, max_results=max_results)
     output = []
     for rsid, variant_id in results:
         output.append({
@@ -103,12 +107,99 @@ def extract_partial_variant_id(query):
 
     
 
+def classify_query(query):
+    """
+    Returns the kind of `query` ("rsid", "cpra", "gene", "text" or "empty") and the backends to search, most relevant first.
+    Gene-like queries (one word, like "PCSK9" or "HLA-A") could also be phenocodes, so they go to both backends.
+    Rsids could also be gene symbols (like "RS1"), so they go to the variant and gene backends.
+    """
+    if query == "":
+        return "empty", []
+    if rsid_pattern.match(query):
+        return "rsid", ["variant", "gene"]
+    if extract_partial_variant_id(query):
+        return "cpra", ["variant"]
+    if gene_like_pattern.match(query):
+        return "gene", ["gene", "pheno"]
+    return "text", ["pheno"]
+
+
+def _run_backend(backend, query, max_results):
+    if backend == "variant":
+        partial_variant_id_list = extract_partial_variant_id(query)
+        if partial_variant_id_list:
+            variant_id, chrom, pos = partial_variant_id_list
+            return search_variant_names(variant_id, chrom=chrom, pos=int(pos), max_results=max_results)
+        return search_variant_names(query.lower(), max_results=max_results)
+    elif backend == "gene":
+        return search_gene_names(query, max_results=max_results)
+    else:
+        return search_pheno_names(query, max_results=max_results)
+
+
+def _is_exact_suggestion(suggestion, query):
+    if suggestion["feature"] == "gene":
+        return suggestion["gene"].upper() == query.upper()
+    elif suggestion["feature"] == "pheno":
+        normalized = normalize_query(query)
+        return normalized in (normalize_query(suggestion["phenocode"]), normalize_query(suggestion["phenostring"]))
+    return query.lower() in ((suggestion["rsid"] or "").lower(), suggestion["variant_id"].lower())
+
+
+def merge_suggestions(results_by_backend, query, max_results):
+    """Interleaves the ranked results of each backend (in the given order), with exact matches first."""
+    merged, seen = [], set()
+    for rank in range(max(map(len, results_by_backend), default=0)):
+        for results in results_by_backend:
+            if rank < len(results):
+                suggestion = results[rank]
+                key = (suggestion["feature"], suggestion.get("gene") or suggestion.get("phenocode") or suggestion.get("variant_id"))
+                if key not in seen:
+                    seen.add(key)
+                    merged.append(suggestion)
+    merged.sort(key=lambda suggestion: not _is_exact_suggestion(suggestion, query))  # stable
+    return merged[:max_results]
+
+
+def search(raw_query, max_results=DEFAULT_NUM_SUGGESTIONS):
+    """
+    Searches the backends that are relevant to `raw_query`, concurrently if there are several, and returns the merged top `max_results`.
+    "partial" is true if a backend was left out because it was too slow or failed.
+    """
+    query = raw_query.strip()
+    kind, backends = classify_query(query)
+    partial = False
+    if len(backends) <= 1:
+        results_by_backend = [_run_backend(backend, query, max_results) for backend in backends]
+    else:
+        futures = [search_executor.submit(_run_backend, backend, query, max_results) for backend in backends]
+        concurrent.futures.wait(futures, timeout=SEARCH_TIMEOUT_SECONDS)
+        results_by_backend = []
+        for backend, future in zip(backends, futures):
+            if not future.done():
+                # a running future can't be cancelled, so it finishes in the background and its results are dropped
+                current_app.logger.warning(
+                    f"Autocomplete backend {backend!r} took longer than {SEARCH_TIMEOUT_SECONDS}s for {query!r}, so it was left out"
+                )
+                partial = True
+            elif future.exception() is not None:
+                current_app.logger.error(f"Autocomplete backend {backend!r} failed for {query!r}: {future.exception()}")
+                partial = True
+            else:
+                results_by_backend.append(future.result())
+    return {"suggestions": merge_suggestions(results_by_backend, query, max_results), "query_type": kind, "partial": partial}
+
+
+def is_complete_response(response):
+    """Only complete suggestions are cached, so that a slow moment doesn't serve partial ones until the cache expires."""
+    body, status = response
+    return status == 200 and not body.get("partial")
+
+
 def aggregate(raw_query):
     query = raw_query.lstrip()
     if "-" in query or ":" in query:
-        print("DEBUG: query contains - or :")
         partial_variant_id_list = extract_partial_variant_id(query)
-        print(f"DEBUG: partial_variant_id_list: {partial_variant_id_list}")
         if partial_variant_id_list:
             return {"suggestions": search_variant_names(partial_variant_id_list[0], chrom=partial_variant_id_list[1], pos=int(partial_variant_id_list[2]))}
     elif query.lower().startswith("rs"):
@@ -123,7 +214,9 @@ def aggregate(raw_query):
         return {"suggestions": all_results}
 
 
-
+search_parser = reqparse.RequestParser()
+search_parser.add_argument("q", type=str, default="", help="The (partial) rsid, chr-pos-ref-alt, gene or phenotype typed so far.")
+search_parser.add_argument("limit", type=int, default=DEFAULT_NUM_SUGGESTIONS, help=f"The maximum number of suggestions (at most {MAX_NUM_SUGGESTIONS}).")
 
 
 @api.route("/")
@@ -140,4 +233,22 @@ class Autocomplete(Resource):
             else:
                 return {"message": "Could not find any results"}, 404
         except Exception as e:
-            return {"message": "Internal server error."}, 500
\ No newline at end of file
+            return {"message": "Internal server error."}, 500
+
+
+@api.route("/search")
+class AutocompleteSearch(Resource):
+    @api.expect(search_parser)
+    @cache.cached(timeout=300, query_string=True, response_filter=is_complete_response)
+    def get(self):
+        """
+        Get ranked autocomplete suggestions for variants, genes and phenotypes in one request
+        """
+        try:
+            args = search_parser.parse_args()
+            if not 1 <= args["limit"] <= MAX_NUM_SUGGESTIONS:
+                return {"message": f"limit must be between 1 and {MAX_NUM_SUGGESTIONS}."}, 400
+            return search(args["q"], max_results=args["limit"]), 200
+        except Exception as e:
+            current_app.logger.error(f"Autocomplete search failed for {request.args.get('q')!r}: {e}")
+            return {"message": "Internal server error."}, 500
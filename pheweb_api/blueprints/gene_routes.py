@@ -1,11 +1,14 @@
-from flask import Blueprint, g, current_app
+from flask import Blueprint, g, current_app, Response, stream_with_context
 from ..models import create_genes
-from flask_restx import Namespace, Resource
+import json
+from flask_restx import Namespace, Resource, reqparse
 from .cache import cache
 
 bp = Blueprint("gene_routes", __name__)
 api = Namespace("gene", description="Routes related to genes")
 
+MAX_ASSOCIATIONS_PER_PAGE = 10_000
+
 class GenesServiceNotAvailable(Exception):
     pass
 
@@ -37,20 +40,101 @@ class GeneNames(Resource):
             current_app.logger.error(f"Error getting gene names: {e}")
             return {"message": "Internal server error."}, 500
 
+near_parser = reqparse.RequestParser()
+near_parser.add_argument("max_results", type=int, default=5, help="The maximum number of genes to return (at most 100).")
+near_parser.add_argument("max_distance", type=int, default=None, help="Only return genes within this many base pairs.")
+
+
+@api.route("/region/<region_code>")
+class GenesInRegion(Resource):
+    @cache.cached(timeout=300)
+    @api.doc(params={"region_code": "Region string, ex: 10:112900000-113100000"})
+    def get(self, region_code):
+        """
+        Get the genes overlapping a region
+        """
+        try:
+            current_app.logger.debug(f"Cache missed. Executing {self.__module__}.{self.__class__.__name__}.")
+            genes_service = get_genes_service()
+            try:
+                genes = genes_service.get_genes_in_region(region_code)
+            except ValueError:
+                return {"message": "Region must be like 10:112900000-113100000."}, 400
+            return genes, 200
+        except GenesServiceNotAvailable as e:
+            return {"message": str(e)}, 404
+        except Exception as e:
+            current_app.logger.error(f"Error getting genes in region {region_code}: {e}")
+            return {"message": "Internal server error."}, 500
+
+
+@api.route("/near/<chrom>/<int:pos>")
+class GenesNearPosition(Resource):
+    @cache.cached(timeout=300, query_string=True)
+    @api.expect(near_parser)
+    @api.doc(params={"chrom": "Chromosome, ex: 10", "pos": "Base-pair position, ex: 112999020"})
+    def get(self, chrom, pos):
+        """
+        Get the genes nearest to a position, nearest first
+        """
+        try:
+            current_app.logger.debug(f"Cache missed. Executing {self.__module__}.{self.__class__.__name__}.")
+            args = near_parser.parse_args()
+            if not 1 <= args["max_results"] <= 100:
+                return {"message": "max_results must be between 1 and 100."}, 400
+            if args["max_distance"] is not None and args["max_distance"] < 0:
+                return {"message": "max_distance must not be negative."}, 400
+            genes_service = get_genes_service()
+            genes = genes_service.get_genes_near(chrom, pos, max_results=args["max_results"], max_distance=args["max_distance"])
+            return genes, 200
+        except GenesServiceNotAvailable as e:
+            return {"message": str(e)}, 404
+        except Exception as e:
+            current_app.logger.error(f"Error getting genes near {chrom}:{pos}: {e}")
+            return {"message": "Internal server error."}, 500
+
+
+table_parser = reqparse.RequestParser()
+table_parser.add_argument("max_pval", type=float, default=None, help="Only return associations with a p-value at most this.")
+table_parser.add_argument("stratification", type=str, action="append", default=None, help="Only return associations in this stratification, ex: european.male. Can be repeated.")
+table_parser.add_argument("limit", type=int, default=None, help=f"The maximum number of associations to return (at most {MAX_ASSOCIATIONS_PER_PAGE}). By default, all of them are returned.")
+table_parser.add_argument("offset", type=int, default=0, help="The number of associations to skip.")
+
+
+def stream_genes_table(table_data):
+    # the associations are stored already encoded, so only the envelope is encoded here
+    yield '{{"gene":{},"total":{},"offset":{},"limit":{},"data":['.format(
+        json.dumps(table_data["gene"]), table_data["total"], table_data["offset"], json.dumps(table_data["limit"])
+    )
+    for i, assoc_json in enumerate(table_data["data"]):
+        yield assoc_json if i == 0 else "," + assoc_json
+    yield "]}"
+
+
 @api.route("/<gene>")
 class SignificantAssociationTable(Resource):
-    @cache.cached(timeout=300)
+    @api.expect(table_parser)
     def get(self, gene):
         """
-        Get association information for a specific gene name.
+        Get association information for a specific gene name, best p-value first.
         """
         try:
-            current_app.logger.debug(f"Cache missed. Executing {self.__module__}.{self.__class__.__name__}.")
+            args = table_parser.parse_args()
+            if args["limit"] is not None and not 0 <= args["limit"] <= MAX_ASSOCIATIONS_PER_PAGE:
+                return {"message": f"limit must be between 0 and {MAX_ASSOCIATIONS_PER_PAGE}."}, 400
+            if args["offset"] < 0:
+                return {"message": "offset must not be negative."}, 400
             genes_service = get_genes_service()
-            table_data = genes_service.get_genes_table(gene)
+            table_data = genes_service.get_genes_table(
+                gene,
+                max_pval=args["max_pval"],
+                stratifications=args["stratification"],
+                limit=args["limit"],
+                offset=args["offset"],
+            )
 
             if table_data:
-                return table_data, 200
+                return Response(stream_with_context(stream_genes_table(table_data)), mimetype="application/json")
             else:
                 return {"data": [], "message": "No data found for this gene"}, 404
 
@@ -179,15 +179,23 @@ class QQ(Resource):
             return {"message": "Internal server error."}, 500
 
 
+region_parser = reqparse.RequestParser()
+region_parser.add_argument("max_points", type=int, default=None, help="Thin the region down to this many variants, keeping the significant and strongest variants first.")
+
+
 @api.route("/<phenocode>/region/<region_code>")
 @api.route("/<phenocode>/<stratification>/region/<region_code>")
 class Region(Resource):
-    @cache.cached(timeout=300)
+    @cache.cached(timeout=300, query_string=True)
+    @api.expect(region_parser)
     def get(self, phenocode, region_code, stratification=None):
         try:
             current_app.logger.debug(f"Cache missed. Executing {self.__module__}.{self.__class__.__name__}.")
+            args = region_parser.parse_args()
+            if args["max_points"] is not None and args["max_points"] < 1:
+                return {"message": "max_points must be a positive integer."}, 400
             pheno_service = get_pheno_service()
-            result = pheno_service.get_region(phenocode, stratification, region_code)
+            result = pheno_service.get_region(phenocode, stratification, region_code, max_points=args["max_points"])
             if not result:
                 return jsonify({
                     "data": [],
@@ -201,6 +209,53 @@ class Region(Resource):
             return {"message": "Internal server error."}, 500
 
 
+MAX_PHENOS_PER_MULTI_REGION = 50
+
+
+@api.route("/region/<region_code>")
+class MultiRegion(Resource):
+    @api.doc(
+        params={"region_code": "Region string, ex: 10:112900000-113100000"},
+        description='Body is like {"phenos": [{"phenocode": "X", "stratification": ".european.male"}, ...], "max_points": 2000}',
+    )
+    def post(self, region_code):
+        try:
+            current_app.logger.debug(f"Getting multi-pheno region for {region_code}")
+            data = api.payload
+            if not data or not isinstance(data.get("phenos"), list) or not data["phenos"]:
+                return {"message": "A non-empty list of phenos is required."}, 400
+            if len(data["phenos"]) > MAX_PHENOS_PER_MULTI_REGION:
+                return {"message": f"At most {MAX_PHENOS_PER_MULTI_REGION} phenos can be requested at once."}, 400
+            if any(
+                not isinstance(pheno, dict)
+                or not isinstance(pheno.get("phenocode"), str)
+                or not pheno["phenocode"]
+                or not isinstance(pheno.get("stratification") or "", str)
+                for pheno in data["phenos"]
+            ):
+                return {"message": "Each pheno must have a phenocode, and its stratification must be a string."}, 400
+            max_points = data.get("max_points")
+            if max_points is not None and (not isinstance(max_points, int) or max_points < 1):
+                return {"message": "max_points must be a positive integer."}, 400
+
+            pheno_service = get_pheno_service()
+            # the phenocode and stratification name a file, so only the loaded ones are allowed
+            unknown_phenos = [
+                pheno["phenocode"] + (pheno.get("stratification") or "")
+                for pheno in data["phenos"]
+                if not pheno_service.has_pheno(pheno["phenocode"], pheno.get("stratification"))
+            ]
+            if unknown_phenos:
+                return {"data": [], "message": f"Could not find phenos: {', '.join(unknown_phenos)}"}, 404
+            result = pheno_service.get_multi_region(data["phenos"], region_code, max_points=max_points)
+            return jsonify(result)
+        except PhenotypeServiceNotAvailable as e:
+            return {"message": str(e)}, 404
+        except Exception as e:
+            current_app.logger.error(f"Error getting multi-pheno region for {region_code}: {e}")
+            return {"message": "Internal server error."}, 500
+
+
 @api.route("/variants")
 class GetVariants(Resource):
     @cache.cached(timeout=300)
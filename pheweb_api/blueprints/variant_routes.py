@@ -1,10 +1,13 @@
-from flask import g, current_app
+from flask import g, current_app, Response, stream_with_context
 from ..models import create_variant
+import json
 from flask_restx import Namespace, Resource
 from .cache import cache
 
 api = Namespace("variant", description="Routes related to variants")
 
+MAX_IDS_PER_RESOLVE = 100_000
+
 class VariantServiceNotAvailable(Exception):
     pass
 
@@ -110,3 +113,28 @@ class NearestGenes(Resource):
         except Exception as e:
             current_app.logger.error(f"Error getting nearest genes for {variant_code}: {e}")
             return {"message": "Internal server error."}, 500
+
+@api.route("/resolve")
+class Resolve(Resource):
+    @api.doc(
+        description='Body is like {"ids": ["rs7412", "19-44908822-C-T", ...]}. '
+        'Responds with one JSON object per line (NDJSON), in the same order: '
+        '{"query": ..., "type": "rsid"|"cpra"|"unknown", "matches": [{"variant_id": ..., "rsids": [...]}]}',
+    )
+    def post(self):
+        try:
+            current_app.logger.debug(f"Resolving variants in {self.__module__}.{self.__class__.__name__}.")
+            data = api.payload
+            if not data or not isinstance(data.get("ids"), list):
+                return {"message": "A list of ids is required."}, 400
+            if len(data["ids"]) > MAX_IDS_PER_RESOLVE:
+                return {"message": f"At most {MAX_IDS_PER_RESOLVE} ids can be resolved at once."}, 400
+            variant_service = get_variant_service()
+            results = variant_service.resolve_variants(data["ids"])
+            lines = (json.dumps(result) + "\n" for result in results)
+            return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+        except VariantServiceNotAvailable as e:
+            return {"message": str(e)}, 404
+        except Exception as e:
+            current_app.logger.error(f"Error resolving variants: {e}")
+            return {"message": "Internal server error."}, 500
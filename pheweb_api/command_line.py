@@ -36,7 +36,7 @@ for submodule in """
  make_gene_aliases_sqlite3
  add_rsids
  add_genes
- make_cpras_rsids_sqlite3
+ make_variant_index
  augment_phenos
  pheno_correlation
  best_of_pheno
@@ -69,6 +69,7 @@ for submodule in """
 
 handlers["process"] = handlers["process-assoc-files"]
 handlers["parse"] = handlers["parse-input-files"]
+handlers["make-cpras-rsids-sqlite3"] = handlers["make-variant-index"]  # the variant index replaced cpras-rsids.sqlite3
 
 
 def serve(argv:List[str]) -> None:
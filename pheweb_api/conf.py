@@ -5,7 +5,7 @@ from . import parse_utils
 
 import os
 import boltons.fileutils
-from typing import Optional, Any, Dict, Tuple, List, Set
+from typing import Optional, Any, Dict, Tuple, List, Set, Union
 
 
 # All state lives in this dictionary.
@@ -106,7 +106,7 @@ def _is_readable(filepath: str) -> bool:
     return os.access(filepath, os.R_OK)
 
 
-def _check_overrides_type(key: str, value_type: type) -> None:
+def _check_overrides_type(key: str, value_type: Union[type, Tuple[type, ...]]) -> None:
     if key in overrides and not isinstance(overrides[key], value_type):
         raise PheWebError(
             "configuration for {} must be of type {}, but {!r} is of type {}".format(
@@ -251,6 +251,19 @@ def get_num_procs(cmd: Optional[str] = None) -> int:
     return 1 if n_cpus == 1 else int(n_cpus * 3 / 4)
 
 
+def get_process_max_io_steps() -> int:
+    """How many steps that read or write every variant `pheweb2 process` runs at once."""
+    return _get_config_int("PROCESS_MAX_IO_STEPS", 2)
+
+
+def get_memory_budget() -> Optional[int]:
+    """How many bytes the processes of a load (eg, the steps of `pheweb2 process`) may use together, or None to use whatever the node has available."""
+    _check_overrides_type("MEMORY_BUDGET_GB", (int, float))
+    if overrides.get("MEMORY_BUDGET_GB") is None:
+        return None
+    return int(overrides["MEMORY_BUDGET_GB"] * 1024**3)
+
+
 # Configuration for the external databases
 def get_hg_build_number() -> int:
     ret = _get_config_int("HG_BUILD_NUMBER", 19)
@@ -357,6 +370,9 @@ def get_pheno_correlations_pvalue_threshold() -> float:
 def get_api_url_prefix() -> str:
     return _get_config_str("API_URL_PREFIX", "")
 
+def get_autocomplete_mmap_size() -> int:
+    return _get_config_int("AUTOCOMPLETE_MMAP_SIZE", 2**34)
+
 def get_lzjs_version() -> str:
     return _get_config_str("lzjs_version", "0.13.4")
 
@@ -10,6 +10,7 @@ from . import parse_utils
 import io
 import os
 import csv
+import hashlib
 from contextlib import contextmanager
 import json
 import gzip
@@ -56,6 +57,13 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
             )
         )
     ),
+    "rsids-indexed": (
+        lambda: get_generated_path(
+            "resources/rsids-v{}-hg{}.indexed.tsv.gz".format(
+                conf.get_dbsnp_version(), conf.get_hg_build_number()
+            )
+        )
+    ),
     "rsids-hg19": (
         lambda: get_generated_path(
             "resources/rsids-v{}-hg19.tsv.gz".format(conf.get_dbsnp_version())
@@ -95,7 +103,6 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
         lambda: get_generated_path("best-phenos-by-gene.json")
     ),
     "correlations": (lambda: get_generated_path("pheno-correlations.txt")),
-    "cpras-rsids-sqlite3": (lambda: get_generated_path("sites/cpras-rsids.sqlite3")),
     "matrix": (lambda: get_generated_path("matrix.tsv.gz")),
     "top-hits": (lambda: get_generated_path("top_hits.json")),
     "top-hits-1k": (lambda: get_generated_path("top_hits_1k.json")),
@@ -104,6 +111,8 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
     "top-loci-tsv": (lambda: get_generated_path("top_loci.tsv")),
     "phenotypes_summary": (lambda: get_generated_path("phenotypes.json")),
     "phenotypes_summary_tsv": (lambda: get_generated_path("phenotypes.tsv")),
+    "process-checkpoint": (lambda: get_generated_path("tmp/process-checkpoint.json")),
+    "build-manifest": (lambda: get_generated_path("build-manifest.sqlite3")),
     # directories for pheno filepaths:
     "parsed": (lambda: get_generated_path("parsed")),
     "pheno_gz": (lambda: get_generated_path("pheno_gz")),
@@ -183,6 +192,14 @@ def get_tmp_path(arg: Union[Path, str]) -> str:
     return ret
 
 
+def hash_file(filepath: Union[str, Path], chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 def get_dated_tmp_path(prefix: str) -> str:
     assert "/" not in prefix, prefix
     time_str = datetime.datetime.isoformat(datetime.datetime.now()).replace(":", "-")
@@ -337,6 +354,11 @@ class _ivfr:
               'chrom': 'X', 'pos': 43254, ...,
             }, ...]
         """
+        for variant_row in self.get_region_rows(chrom, start, end):
+            yield self._parse_variant_row(variant_row)
+
+    def get_region_rows(self, chrom: str, start: int, end: int) -> Iterator[List[str]]:
+        """Like `get_region()`, but yields the unparsed columns of each row, for callers that only need a few of them."""
         if start < 1:
             start = 1
         if start >= end:
@@ -359,8 +381,7 @@ class _ivfr:
         reader: Iterator[List[str]] = csv.reader(
             tabix_iter, dialect="pheweb-internal-dialect"
         )
-        for variant_row in reader:
-            yield self._parse_variant_row(variant_row)
+        yield from reader
 
     def get_variant(
         self, chrom: str, pos: int, ref: str, alt: int
@@ -479,10 +500,22 @@ class _mr(_ivfr):
                 p = {}
                 for field in fields:
                     p[field] = self._parse_field(variant_row, field, phenocode)
-                    p.update(self._info_for_pheno[phenocode])
-                    variant["phenos"][phenocode] = p
+                p.update(self._info_for_pheno[phenocode])
+                variant["phenos"][phenocode] = p
         return variant
 
+    def get_phenocodes(self) -> List[str]:
+        return list(self._colidxs_for_pheno)
+
+    def get_colidx(self, field: str, phenocode: Optional[str] = None) -> int:
+        return self._colidxs[field] if phenocode is None else self._colidxs_for_pheno[phenocode][field]
+
+    def get_fields_for_pheno(self, phenocode: str) -> List[str]:
+        return list(self._colidxs_for_pheno[phenocode])
+
+    def get_info_for_pheno(self, phenocode: str) -> Dict[str, Any]:
+        return self._info_for_pheno[phenocode]
+
 
 def with_chrom_idx(variants: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
     for v in variants:
@@ -4,96 +4,53 @@ This script takes a file with the columns [chrom, pos, ...] (but no headers) and
 
 from ..utils import get_gene_tuples
 from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath
-from .load_utils import mtime
+from . import build_manifest
+from ..models.gene_index import GeneIntervals, get_gene_intervals_for_chrom
 
-from intervaltree import IntervalTree, Interval
-import bisect
 import os
 import os.path
 import boltons.iterutils
-from typing import List, Tuple, Optional, Dict, Iterator
+import numpy as np
+from typing import List, Tuple, Dict, Iterator, Set
 
 Chrom = str
 GeneName = str
 
 
-class BisectFinder(object):
-    """Given a list like [(123, 'foo'), (125, 'bar')...], BisectFinder helps you find the things before and after 124."""
-
-    def __init__(self, tuples: List[Tuple[int, str]]):
-        """tuples is like [(123, 'foo'),...]"""
-        tuples = sorted(tuples, key=lambda t: t[0])
-        self._nums, self._values = list(zip(*tuples))
-
-    def get_item_before(self, pos: int) -> Optional[Tuple[int, str]]:
-        """If we get an exact match, let's return it"""
-        idx = (
-            bisect.bisect_right(self._nums, pos) - 1
-        )  # note: bisect_{left,right} just deals with ties.
-        if idx < 0:
-            return None  # It's fallen off the beginning!
-        return (self._nums[idx], self._values[idx])
-
-    def get_item_after(self, pos: int) -> Optional[Tuple[int, str]]:
-        if pos > self._nums[-1]:
-            return None  # it's fallen off the end!
-        idx = bisect.bisect_left(self._nums, pos)
-        return (self._nums[idx], self._values[idx])
+# variants are annotated this many at a time
+CHUNK_SIZE = 100_000
 
 
 class GeneAnnotator(object):
     def __init__(self, interval_tuples: Iterator[Tuple[Chrom, int, int, GeneName]]):
         """interval_tuples is like [('22', 12321, 12345, 'APOL1'), ...]"""
-        self._its: Dict[Chrom, IntervalTree] = {}
-        gene_start_tuples_by_chrom: Dict[Chrom, List[Tuple[int, GeneName]]] = {}
-        gene_end_tuples_by_chrom: Dict[Chrom, List[Tuple[int, GeneName]]] = {}
-        for chrom, pos_start, pos_end, gene_name in interval_tuples:
-            if chrom not in self._its:
-                self._its[chrom] = IntervalTree()
-                gene_start_tuples_by_chrom[chrom] = []
-                gene_end_tuples_by_chrom[chrom] = []
-            self._its[chrom].add(Interval(pos_start, pos_end, gene_name))
-            gene_start_tuples_by_chrom[chrom].append((pos_start, gene_name))
-            gene_end_tuples_by_chrom[chrom].append((pos_end, gene_name))
-        self._gene_starts = {
-            chrom: BisectFinder(tuples)
-            for chrom, tuples in gene_start_tuples_by_chrom.items()
-        }
-        self._gene_ends = {
-            chrom: BisectFinder(tuples)
-            for chrom, tuples in gene_end_tuples_by_chrom.items()
-        }
+        self._intervals: Dict[Chrom, GeneIntervals] = get_gene_intervals_for_chrom(interval_tuples)
 
-    def annotate_position(self, chrom: str, pos: int) -> str:
+    def annotate_positions(self, chrom: str, positions: List[int]) -> List[str]:
+        """
+        For each position, returns the genes overlapping it (comma-separated), or else the gene whose start or end is nearest.
+        """
         if chrom == "MT":
             chrom = "M"
-        if chrom not in self._its:
-            return ""
-        overlapping_genes = (
-            self._its[chrom].at(pos)
-            if hasattr(self._its[chrom], "at")
-            else self._its[chrom].search(pos)
-        )  # support intervaltree 2.x and 3.x
-        if overlapping_genes:
-            return ",".join(
-                sorted(
-                    boltons.iterutils.unique_iter(og.data for og in overlapping_genes)
-                )
-            )
-        nearest_gene_end = self._gene_ends[chrom].get_item_before(pos)
-        nearest_gene_start = self._gene_starts[chrom].get_item_after(pos)
-        if nearest_gene_end is None or nearest_gene_start is None:
-            if nearest_gene_end is not None:
-                return nearest_gene_end[1]
-            if nearest_gene_start is not None:
-                return nearest_gene_start[1]
-            print("This is very surprising - {!r} {!r}".format(chrom, pos))
-            return ""
-        dist_to_nearest_gene_end = abs(nearest_gene_end[0] - pos)
-        dist_to_nearest_gene_start = abs(nearest_gene_start[0] - pos)
-        if dist_to_nearest_gene_end < dist_to_nearest_gene_start:
-            return nearest_gene_end[1]
-        return nearest_gene_start[1]
+        if chrom not in self._intervals:
+            return [""] * len(positions)
+        intervals = self._intervals[chrom]
+        position_array = np.array(positions, dtype=np.int64)
+        overlapping_genes: Dict[int, Set[GeneName]] = {}
+        for position_idx, gene_idx in zip(*(x.tolist() for x in intervals.get_overlapping(position_array))):
+            overlapping_genes.setdefault(position_idx, set()).add(intervals.data[gene_idx])
+        annotations = [
+            ",".join(sorted(overlapping_genes[i])) if i in overlapping_genes else ""
+            for i in range(len(positions))
+        ]
+        other_idxs = [i for i in range(len(positions)) if i not in overlapping_genes]
+        nearest = intervals.get_nearest(position_array[other_idxs]).tolist()
+        for i, gene_idx in zip(other_idxs, nearest):
+            annotations[i] = intervals.data[gene_idx] if gene_idx >= 0 else ""
+        return annotations
+
+    def annotate_position(self, chrom: str, pos: int) -> str:
+        return self.annotate_positions(chrom, [pos])[0]
 
 
 def annotate_genes(in_filepath: str, out_filepath: str) -> None:
@@ -102,9 +59,16 @@ def annotate_genes(in_filepath: str, out_filepath: str) -> None:
     with VariantFileWriter(out_filepath) as out_f, VariantFileReader(
         in_filepath
     ) as variants:
-        for v in variants:
-            v["nearest_genes"] = ga.annotate_position(v["chrom"], v["pos"])
-            out_f.write(v)
+        for chunk in boltons.iterutils.chunked_iter(variants, CHUNK_SIZE):
+            idxs_for_chrom: Dict[Chrom, List[int]] = {}
+            for i, v in enumerate(chunk):
+                idxs_for_chrom.setdefault(v["chrom"], []).append(i)
+            for chrom, idxs in idxs_for_chrom.items():
+                annotations = ga.annotate_positions(chrom, [chunk[i]["pos"] for i in idxs])
+                for i, annotation in zip(idxs, annotations):
+                    chunk[i]["nearest_genes"] = annotation
+            for v in chunk:
+                out_f.write(v)
 
 
 def run(argv: List[str]) -> None:
@@ -124,9 +88,15 @@ def run(argv: List[str]) -> None:
 
         download_genes.run([])
 
-    if os.path.exists(out_filepath) and max(
-        mtime(genes_filepath), mtime(input_filepath)
-    ) <= mtime(out_filepath):
+    if build_manifest.is_up_to_date("add-genes", out_filepath, [input_filepath, genes_filepath]):
         print("gene annotation is up-to-date!")
     else:
+        # Each variant's genes only depend on its position, so if the input only gained rows, so does the output.
+        changes = build_manifest.get_changes(out_filepath, [input_filepath, genes_filepath])
+        old_sha256 = build_manifest.get_hash(out_filepath) if changes is not None else None
         annotate_genes(input_filepath, out_filepath)
+        if changes is not None and changes["extended"] == [input_filepath] and not (
+            changes["added"] or changes["changed"] or changes["removed"]
+        ):
+            build_manifest.record_extension(out_filepath, old_sha256)
+        build_manifest.record("add-genes", out_filepath, [input_filepath, genes_filepath])
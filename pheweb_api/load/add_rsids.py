@@ -11,6 +11,10 @@ Notes:
 In `resources/rsids-*.tsv.gz`, sometimes `alt` contains `N`, which matches any nucleotide I think.
 
 We read one full position at a time.  When we have a position-match, we find all rsids that match a variant.
+
+The rsids file is validated once and rewritten as `resources/rsids-*.indexed.tsv.gz`, which is BGZF-compressed, tabix-indexed,
+and has one line per chrom-pos-ref-alt-rsid.  Then each chromosome of the sites is annotated in its own process,
+which only reads that chromosome of the indexed rsids, and the chromosomes are concatenated in their original order.
 """
 
 # TODO: do we need to left-normalize all indels?
@@ -18,17 +22,31 @@ We read one full position at a time.  When we have a position-match, we find all
 
 from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
 from ..file_utils import (
-    VariantFileReader,
-    VariantFileWriter,
     get_filepath,
+    get_tmp_path,
     read_maybe_gzip,
 )
 from .. import conf
-from .load_utils import mtime
+from .. import parse_utils
+from .load_utils import Parallelizer
+from . import build_manifest
 
 import os
+import re
+import csv
+import contextlib
+import gzip
+import shutil
 import itertools
-from typing import Iterator, Dict, Any, List
+import pysam
+from boltons.fileutils import AtomicSaver, mkdir_p
+from typing import Iterator, Dict, Any, List, Optional, Tuple
+
+
+# lines are written to the indexed rsids file this many at a time
+LINES_PER_WRITE = 10_000
+
+_nucleotides_re = re.compile("[ATCGN]*")
 
 
 def get_rsid_reader(
@@ -96,7 +114,7 @@ def get_rsid_reader(
                     )
                 assert rsid.startswith("rs")
                 # Sometimes the reference contains `N`, and that's okay.
-                assert all(base in "ATCGN" for base in ref), (
+                assert _nucleotides_re.fullmatch(ref), (
                     chrom,
                     pos,
                     ref,
@@ -106,7 +124,7 @@ def get_rsid_reader(
                     # Alt can be a comma-separated list
                     if alt == ".":
                         continue  # TODO: I don't understand what this means or why it happens.  Probably it should match any alt.
-                    assert all(base in "ATCGN" for base in alt), (chrom, pos, ref, alt)
+                    assert _nucleotides_re.fullmatch(alt), (chrom, pos, ref, alt)
                     yield {
                         "chrom": chrom,
                         "pos": int(pos),
@@ -116,21 +134,6 @@ def get_rsid_reader(
                     }
 
 
-def get_one_chr_pos_at_a_time(
-    iterator: Iterator[Dict[str, Any]],
-) -> Iterator[List[Dict[str, Any]]]:
-    """Turns
-    [{'chr':'1', 'pos':123, 'ref':'A', 'alt':'T'},{'chr':'1', 'pos':123, 'ref':'A', 'alt':'GC'},{'chr':'1', 'pos':128, 'ref':'A', 'alt':'T'},...]
-    into:
-    [ [{'chr':'1', 'pos':123, 'ref':'A', 'alt':'T'},{'chr':'1', 'pos':123, 'ref':'A', 'alt':'GC'}] , [{'chr':'1', 'pos':128, 'ref':'A', 'alt':'T'}] ,...]
-    where variants with the same position are in a list.
-    """
-    for k, g in itertools.groupby(
-        iterator, key=lambda cpra: (cpra["chrom"], cpra["pos"])
-    ):
-        yield list(g)
-
-
 def are_match(seq1: str, seq2: str) -> bool:
     """Compares nucleotide sequences.  Eg, "A" == "A", "A" == "N", "A" != "AN"."""
     if seq1 == seq2:
@@ -140,6 +143,186 @@ def are_match(seq1: str, seq2: str) -> bool:
     return False
 
 
+def make_indexed_rsids(rsids_filepath: str, out_filepath: str) -> None:
+    """Validates `rsids_filepath` and writes it as a BGZF file with one alt per line, tabix-indexed by chrom and pos."""
+    tmp_filepath = get_tmp_path(out_filepath)
+    if not tmp_filepath.endswith(".gz"):
+        tmp_filepath += ".gz"
+    with read_maybe_gzip(rsids_filepath) as rsids_f, pysam.BGZFile(tmp_filepath, "wb") as out_f:
+        rsids = get_rsid_reader(rsids_f, rsids_filepath)
+        while True:
+            lines = [
+                "{chrom}\t{pos}\t{ref}\t{alt}\t{rsid}\n".format(**rsid)
+                for rsid in itertools.islice(rsids, LINES_PER_WRITE)
+            ]
+            if not lines:
+                break
+            out_f.write("".join(lines).encode())
+    pysam.tabix_index(tmp_filepath, seq_col=0, start_col=1, end_col=1, force=True)
+    os.replace(tmp_filepath + ".tbi", out_filepath + ".tbi")
+    os.replace(tmp_filepath, out_filepath)
+
+
+def split_by_chrom(in_filepath: str, tmp_dir: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    Copies the lines of each chromosome of `in_filepath` to its own uncompressed file in `tmp_dir`, without parsing them.
+    Returns the fields of `in_filepath` and [(chrom, filepath), ...] in the order of `in_filepath`.
+    """
+    filepath_for_chrom: Dict[str, str] = {}
+    with read_maybe_gzip(in_filepath) as in_f:
+        header = next(in_f)
+        fields = next(csv.reader([header], dialect="pheweb-internal-dialect"))
+        if fields[0].startswith("#"):
+            fields[0] = fields[0][1:]
+        chrom_colidx = fields.index("chrom")
+        for chrom, lines in itertools.groupby(in_f, key=lambda line: line.split("\t", chrom_colidx + 1)[chrom_colidx]):
+            if chrom in filepath_for_chrom:
+                raise PheWebError(
+                    "The sites file, {!r}, contains chromosome {!r} in more than one place.".format(in_filepath, chrom)
+                )
+            filepath_for_chrom[chrom] = os.path.join(tmp_dir, "sites-{}.tsv".format(chrom))
+            with open(filepath_for_chrom[chrom], "w") as out_f:
+                out_f.writelines(lines)
+    return fields, list(filepath_for_chrom.items())
+
+
+def annotate_chrom(task: Dict[str, Any]) -> None:
+    """Merge-joins the sites of one chromosome (`task["in"]`, no header) with that chromosome of the indexed rsids, into `task["out"]` (gzipped, no header)."""
+    fields: List[str] = task["fields"]
+    pos_colidx, ref_colidx, alt_colidx = fields.index("pos"), fields.index("ref"), fields.index("alt")
+    rsids_colidx = task["out_fields"].index("rsids")
+    with open(task["in"]) as in_f, pysam.TabixFile(task["indexed_rsids"], parser=None) as tabix_file, gzip.open(
+        task["out"], "wt", compresslevel=2
+    ) as out_f:
+        writer = csv.writer(out_f, dialect="pheweb-internal-dialect")
+        if task["chrom"] in tabix_file.contigs:
+            rsid_rows: Iterator[List[str]] = (line.split("\t") for line in tabix_file.fetch(task["chrom"]))
+        else:
+            rsid_rows = iter([])
+        debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
+        if debugging_limit_num_variants:
+            rsid_rows = itertools.islice(rsid_rows, 0, debugging_limit_num_variants)
+        rsid_group_reader = itertools.groupby(rsid_rows, key=lambda row: int(row[1]))
+        rsid_pos, rsid_group = next(rsid_group_reader, (None, None))
+
+        cp_group_reader = itertools.groupby(
+            csv.reader(in_f, dialect="pheweb-internal-dialect"), key=lambda row: int(row[pos_colidx])
+        )
+        for pos, cp_group in cp_group_reader:
+            # Advance rsid_group until it is up to/past cp_group
+            while rsid_pos is not None and rsid_pos < pos:
+                rsid_pos, rsid_group = next(rsid_group_reader, (None, None))
+            rsid_candidates: List[List[str]] = list(rsid_group) if rsid_pos == pos else []
+            for row in cp_group:
+                rsids = [
+                    rsid_row[4]
+                    for rsid_row in rsid_candidates
+                    if row[ref_colidx] == rsid_row[2] and are_match(row[alt_colidx], rsid_row[3])
+                ]
+                row.insert(rsids_colidx, ",".join(rsids))
+                writer.writerow(row)
+
+
+def annotate_sites(in_filepath: str, indexed_rsids_filepath: str, out_filepath: str) -> None:
+    tmp_dir = get_tmp_path("add-rsids")
+    mkdir_p(tmp_dir)
+    try:
+        fields, chrom_filepaths = split_by_chrom(in_filepath, tmp_dir)
+        assert "rsids" not in fields, fields
+        out_fields = [field for field in parse_utils.fields if field in fields or field == "rsids"]
+        assert len(out_fields) == len(fields) + 1, (fields, out_fields)
+        assert [field for field in out_fields if field != "rsids"] == fields, (fields, out_fields)
+        tasks = [
+            {
+                "chrom": chrom,
+                "fields": fields,
+                "out_fields": out_fields,
+                "in": chrom_filepath,
+                "out": chrom_filepath + ".annotated.gz",
+                "indexed_rsids": indexed_rsids_filepath,
+            }
+            for chrom, chrom_filepath in chrom_filepaths
+        ]
+        for _ in Parallelizer().run_single_tasks(
+            tasks, annotate_chrom, cmd="add-rsids", get_task_size=lambda task: os.path.getsize(task["in"])
+        ):
+            pass
+        # Concatenated gzip members are a valid gzip file, so the chromosomes are copied without recompressing them.
+        with AtomicSaver(
+            out_filepath, text_mode=False, part_file=get_tmp_path(out_filepath), overwrite_part=True
+        ) as out_f:
+            with gzip.open(out_f, "wt", compresslevel=2) as header_f:
+                csv.writer(header_f, dialect="pheweb-internal-dialect").writerow(out_fields)
+            for task in tasks:
+                with open(task["out"], "rb") as chrom_f:
+                    shutil.copyfileobj(chrom_f, out_f)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def update_sites(in_filepath: str, indexed_rsids_filepath: str, out_filepath: str) -> Optional[bool]:
+    """
+    Annotates `in_filepath` like `annotate_sites()`, but copies the rsids of the variants that are already in the previous `out_filepath`,
+    so that only the new variants are looked up in the indexed rsids.
+    Returns whether every row of the previous `out_filepath` was kept, or None (without writing anything) if its fields don't match.
+    """
+    with contextlib.ExitStack() as exit_stack:
+        in_reader = csv.reader(exit_stack.enter_context(read_maybe_gzip(in_filepath)), dialect="pheweb-internal-dialect")
+        old_reader = csv.reader(exit_stack.enter_context(read_maybe_gzip(out_filepath)), dialect="pheweb-internal-dialect")
+        fields, old_fields = next(in_reader), next(old_reader)
+        if fields[0].startswith("#"):
+            fields[0] = fields[0][1:]
+        out_fields = [field for field in parse_utils.fields if field in fields or field == "rsids"]
+        if old_fields != out_fields or [field for field in out_fields if field != "rsids"] != fields:
+            return None
+        rsids_colidx = out_fields.index("rsids")
+        def get_key(row: List[str], colidxs: List[int]) -> Tuple[int, int, str, str]:
+            return (chrom_order[row[colidxs[0]]], int(row[colidxs[1]]), row[colidxs[2]], row[colidxs[3]])
+
+        colidxs = [fields.index(field) for field in ["chrom", "pos", "ref", "alt"]]
+        old_colidxs = [out_fields.index(field) for field in ["chrom", "pos", "ref", "alt"]]
+        tabix_file = exit_stack.enter_context(pysam.TabixFile(indexed_rsids_filepath, parser=None))
+        out_f = exit_stack.enter_context(
+            AtomicSaver(out_filepath, text_mode=False, part_file=get_tmp_path(out_filepath), overwrite_part=True)
+        )
+        writer = csv.writer(
+            exit_stack.enter_context(gzip.open(out_f, "wt", compresslevel=2)), dialect="pheweb-internal-dialect"
+        )
+        writer.writerow(out_fields)
+
+        kept_all_old_rows = True
+        num_new_rows = 0
+        old_row = next(old_reader, None)
+        for row in in_reader:
+            key = get_key(row, colidxs)
+            while old_row is not None and get_key(old_row, old_colidxs) < key:
+                kept_all_old_rows = False
+                old_row = next(old_reader, None)
+            if old_row is not None and get_key(old_row, old_colidxs) == key:
+                if old_row[:rsids_colidx] + old_row[rsids_colidx + 1:] == row:
+                    writer.writerow(old_row)
+                    old_row = next(old_reader, None)
+                    continue
+                kept_all_old_rows = False
+                old_row = next(old_reader, None)
+            chrom, pos = row[colidxs[0]], int(row[colidxs[1]])
+            rsid_rows = (
+                (line.split("\t") for line in tabix_file.fetch(chrom, pos - 1, pos)) if chrom in tabix_file.contigs else []
+            )
+            rsids = [
+                rsid_row[4]
+                for rsid_row in rsid_rows
+                if int(rsid_row[1]) == pos and row[colidxs[2]] == rsid_row[2] and are_match(row[colidxs[3]], rsid_row[3])
+            ]
+            row.insert(rsids_colidx, ",".join(rsids))
+            writer.writerow(row)
+            num_new_rows += 1
+        if old_row is not None:
+            kept_all_old_rows = False
+    print("Looked up rsids for {:,} new variants".format(num_new_rows))
+    return kept_all_old_rows
+
+
 def run(argv: List[str]) -> None:
     if "-h" in argv or "--help" in argv:
         print(
@@ -150,6 +333,7 @@ def run(argv: List[str]) -> None:
     in_filepath = get_filepath("unanno")
     out_filepath = get_filepath("sites-rsids", must_exist=False)
     rsids_filepath = get_filepath("rsids", must_exist=False)
+    indexed_rsids_filepath = get_filepath("rsids-indexed", must_exist=False)
 
     if not os.path.exists(rsids_filepath):
         print("Fetching rsids...")
@@ -157,63 +341,24 @@ def run(argv: List[str]) -> None:
 
         download_rsids.run([])
 
-    if os.path.exists(out_filepath) and max(
-        mtime(in_filepath), mtime(rsids_filepath)
-    ) <= mtime(out_filepath):
+    if build_manifest.is_up_to_date("add-rsids", out_filepath, [in_filepath, rsids_filepath]):
         print("rsid annotation is up-to-date!")
         return
 
-    with VariantFileReader(in_filepath) as in_reader, read_maybe_gzip(
-        rsids_filepath
-    ) as rsids_f, VariantFileWriter(out_filepath) as writer:
-        rsid_group_reader = get_one_chr_pos_at_a_time(
-            get_rsid_reader(rsids_f, rsids_filepath)
-        )
-        cp_group_reader = get_one_chr_pos_at_a_time(in_reader)
-
-        debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
-        if debugging_limit_num_variants:
-            rsid_group_reader = itertools.islice(
-                rsid_group_reader, 0, debugging_limit_num_variants
-            )
+    indexed_rsids_filepaths = [indexed_rsids_filepath, indexed_rsids_filepath + ".tbi"]
+    if not build_manifest.is_up_to_date("add-rsids", indexed_rsids_filepaths, rsids_filepath):
+        print("Indexing {} (only needed once per dbSNP version and build)".format(rsids_filepath))
+        make_indexed_rsids(rsids_filepath, indexed_rsids_filepath)
+        build_manifest.record("add-rsids", indexed_rsids_filepaths, rsids_filepath)
 
-        rsid_group = next(rsid_group_reader)
-        for cp_group in cp_group_reader:
-            # Advance rsid_group until it is up to/past cp_group
-            while True:
-                if rsid_group[0]["chrom"] == cp_group[0]["chrom"]:
-                    rsid_is_not_behind = rsid_group[0]["pos"] >= cp_group[0]["pos"]
-                else:
-                    rsid_is_not_behind = (
-                        chrom_order[rsid_group[0]["chrom"]]
-                        >= chrom_order[cp_group[0]["chrom"]]
-                    )
-                if rsid_is_not_behind:
-                    break
-                else:
-                    try:
-                        rsid_group = next(rsid_group_reader)
-                    except StopIteration:
-                        break
-
-            if (
-                rsid_group[0]["chrom"] == cp_group[0]["chrom"]
-                and rsid_group[0]["pos"] == cp_group[0]["pos"]
-            ):
-                # we have rsids at this position!  will they match on ref/alt?
-                for cpra in cp_group:
-                    rsids = [
-                        rsid["rsid"]
-                        for rsid in rsid_group
-                        if cpra["ref"] == rsid["ref"]
-                        and are_match(cpra["alt"], rsid["alt"])
-                    ]
-                    # if len(rsids) > 1:
-                    #     print('WARNING: the variant {chrom}-{pos}-{ref}-{alt} has multiple rsids: {rsids}'.format(**cpra, rsids=rsids))
-                    cpra["rsids"] = ",".join(rsids)
-                    writer.write(cpra)
-            else:
-                # No match, just print each cpra with an empty `rsids` column
-                for cpra in cp_group:
-                    cpra["rsids"] = ""
-                    writer.write(cpra)
+    # If only the sites changed, the rsids of the variants that were already annotated can be reused.
+    changes = build_manifest.get_changes(out_filepath, [in_filepath, rsids_filepath])
+    kept_all_old_rows = None
+    if changes is not None and changes["changed"] + changes["extended"] == [in_filepath] and not (changes["added"] or changes["removed"]):
+        old_sha256 = build_manifest.get_hash(out_filepath)
+        kept_all_old_rows = update_sites(in_filepath, indexed_rsids_filepath, out_filepath)
+    if kept_all_old_rows is None:
+        annotate_sites(in_filepath, indexed_rsids_filepath, out_filepath)
+    elif kept_all_old_rows:
+        build_manifest.record_extension(out_filepath, old_sha256)
+    build_manifest.record("add-rsids", out_filepath, [in_filepath, rsids_filepath])
@@ -1,6 +1,7 @@
 
 from ..utils import (
     PheWebError,
+    chrom_order,
     get_phenocode_with_stratifications,
     get_phenocode_with_suffixes,
 )
@@ -14,11 +15,19 @@ from ..file_utils import (
     get_tmp_path,
     convert_VariantFile_to_IndexedVariantFile,
 )
+from ..models.variant_index import VariantIndex, load_variant_index, get_index_dir
+from . import make_variant_index
 from .load_utils import parallelize_per_pheno, get_phenos_subset, get_phenolist
 
 import argparse
 import os
-from typing import List, Dict, Any
+import numpy as np
+from boltons.iterutils import chunked_iter
+from typing import List, Dict, Any, Optional
+
+
+CHUNK_SIZE = 100_000
+INDEXED_SITES_FIELDS = {"chrom", "pos", "ref", "alt", "rsids", "nearest_genes"}
 
 
 def run(argv: List[str]) -> None:
@@ -45,12 +54,17 @@ def run(argv: List[str]) -> None:
             pheno["phenocode"] = get_phenocode_with_stratifications(pheno)
             non_interaction_phenos.append(pheno)
 
+    if phenos:
+        sites_filepath = get_filepath("sites")
+        make_variant_index.update_variant_index(sites_filepath, get_index_dir(os.path.dirname(sites_filepath)))
+
     parallelize_per_pheno(
         get_input_filepaths=get_input_filepaths,
         get_output_filepaths=get_output_filepaths,
         convert=convert,
         cmd="augment-pheno",
         phenos=non_interaction_phenos,
+        extendable_filepaths=get_extendable_filepaths(),
     )
 
     parallelize_per_pheno(
@@ -59,9 +73,15 @@ def run(argv: List[str]) -> None:
         convert=convert,
         cmd="augment-pheno",
         phenos=interaction_phenos,
+        extendable_filepaths=get_extendable_filepaths(),
     )
 
 
+def get_extendable_filepaths() -> List[str]:
+    # Each pheno only looks up its own variants in the sites, so variants added for new phenos don't change its output.
+    return [get_filepath("sites", must_exist=False)]
+
+
 def get_input_filepaths(pheno: dict) -> List[str]:
     return [
         get_pheno_filepath("parsed", pheno["phenocode"]),
@@ -94,11 +114,67 @@ def convert(pheno: Dict[str, Any], ignore=None) -> None:
 
     out_unzipped_filepath = get_tmp_path(out_filepath)
 
+    variant_index = get_variant_index_for_sites(sites_filepath)
+    with VariantFileWriter(out_unzipped_filepath, use_gzip=False) as writer:
+        if variant_index is not None:
+            annotate_from_variant_index(variant_index, parsed_filepath, sites_filepath, writer, pheno)
+        else:
+            merge_with_sites(parsed_filepath, sites_filepath, writer, pheno)
+
+    convert_VariantFile_to_IndexedVariantFile(out_unzipped_filepath, out_filepath)
+    os.unlink(out_unzipped_filepath)
+
+
+def get_variant_index_for_sites(sites_filepath: str) -> Optional[VariantIndex]:
+    """Returns the variant index if it is current and holds every column of `sites.tsv`, otherwise None."""
+    index_dir = get_index_dir(os.path.dirname(sites_filepath))
+    if not VariantIndex.exists(index_dir) or not make_variant_index.is_up_to_date(sites_filepath, index_dir):
+        return None
+    variant_index = load_variant_index(index_dir)
+    if not set(variant_index.meta["sites_fields"]) <= INDEXED_SITES_FIELDS or not variant_index.meta["rsids_are_exact"]:
+        return None
+    return variant_index
+
+
+def annotate_from_variant_index(
+    variant_index: VariantIndex, parsed_filepath: str, sites_filepath: str, writer, pheno: Dict[str, Any]
+) -> None:
+    """Looks up the variants of the phenotype in the memory-mapped variant index, so `sites.tsv` isn't read at all."""
+    with VariantFileReader(parsed_filepath) as pheno_reader:
+        num_variants = 0
+        for chunk in chunked_iter(pheno_reader, CHUNK_SIZE):
+            rows = variant_index.find_rows(
+                [chrom_order[variant["chrom"]] for variant in chunk],
+                [variant["pos"] for variant in chunk],
+                [variant["ref"] for variant in chunk],
+                [variant["alt"] for variant in chunk],
+            )
+            missing = np.nonzero(rows < 0)[0]
+            if len(missing):
+                raise PheWebError(
+                    "The sites file ({}) is missing a variant that's present in {}: {}.".format(
+                        sites_filepath, parsed_filepath, chunk[missing[0]]
+                    )
+                )
+            for variant, row in zip(chunk, rows.tolist()):
+                # Sometimes I use copy files from pheno_gz/ into parsed/, and I want the new sites info to take precendence.
+                variant["rsids"] = ",".join(variant_index.get_rsids(row))
+                variant["nearest_genes"] = ",".join(variant_index.get_nearest_genes(row))
+                writer.write(variant)
+            num_variants += len(chunk)
+    if num_variants == 0:
+        raise PheWebError(
+            "It appears that the phenotype {!r} has no variants.".format(
+                pheno["phenocode"]
+            )
+        )
+
+
+def merge_with_sites(parsed_filepath: str, sites_filepath: str, writer, pheno: Dict[str, Any]) -> None:
+    """Walks through `sites.tsv` alongside the phenotype, for when the variant index can't stand in for it."""
     with VariantFileReader(sites_filepath) as sites_reader, VariantFileReader(
         parsed_filepath
-    ) as pheno_reader, VariantFileWriter(
-        out_unzipped_filepath, use_gzip=False
-    ) as writer:
+    ) as pheno_reader:
         sites_variants = with_chrom_idx(iter(sites_reader))
         pheno_variants = with_chrom_idx(iter(pheno_reader))
 
@@ -158,9 +234,6 @@ def convert(pheno: Dict[str, Any], ignore=None) -> None:
                         )
                     )
 
-    convert_VariantFile_to_IndexedVariantFile(out_unzipped_filepath, out_filepath)
-    os.unlink(out_unzipped_filepath)
-
 
 def _which_variant_is_bigger(v1: Dict[str, Any], v2: Dict[str, Any]) -> int:
     """1 means v1 is bigger.  2 means v2 is bigger. 0 means tie."""
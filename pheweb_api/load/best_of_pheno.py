@@ -46,30 +46,32 @@ def run(argv: List[str]) -> None:
             non_interaction_phenos.append(pheno)
 
     parallelize_per_pheno(
-        get_input_filepaths=lambda pheno: get_pheno_filepath(
-            "pheno_gz", pheno["phenocode"]
-        ),
-        get_output_filepaths=lambda pheno: get_pheno_filepath(
-            "best_of_pheno", pheno["phenocode"], must_exist=False
-        ),
+        get_input_filepaths=get_input_filepaths,
+        get_output_filepaths=get_output_filepaths,
         convert=make_bestof_file,
         cmd="best_of_pheno",
         phenos=non_interaction_phenos,
     )
 
     parallelize_per_pheno(
-        get_input_filepaths=lambda pheno: get_pheno_filepath(
-            "interaction", pheno["phenocode"]
-        ),
-        get_output_filepaths=lambda pheno: get_pheno_filepath(
-            "best_of_pheno", pheno["phenocode"], must_exist=False
-        ),
+        get_input_filepaths=get_input_filepaths,
+        get_output_filepaths=get_output_filepaths,
         convert=make_bestof_file_interaction,
         cmd="best_of_pheno",
         phenos=interaction_phenos,
     )
 
 
+def get_input_filepaths(pheno: dict) -> List[str]:
+    if pheno.get("interaction") is not None:
+        return [get_pheno_filepath("interaction", pheno["phenocode"])]
+    return [get_pheno_filepath("pheno_gz", pheno["phenocode"])]
+
+
+def get_output_filepaths(pheno: dict) -> List[str]:
+    return [get_pheno_filepath("best_of_pheno", pheno["phenocode"], must_exist=False)]
+
+
 def make_bestof_file(pheno: Dict[str, Any]) -> None:
     make_bestof_file_explicit(
         get_pheno_filepath("pheno_gz", pheno["phenocode"]),
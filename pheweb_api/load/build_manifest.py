@@ -0,0 +1,229 @@
+"""
+Records what every output of the loading steps was made from, so that each step rebuilds exactly the outputs whose inputs or config changed.
+
+For each output, `build-manifest.sqlite3` holds the sha256 of the output, the sha256 of each of its inputs, and the config that the step used.
+An output is up-to-date if it still has its recorded hash, and its inputs and config are the same as when it was made.
+So adding or removing an input (eg, a phenotype) triggers a rebuild, but copying, restoring or touching a file doesn't.
+
+Hashes are cached by size and mtime, so a file is only re-read after it changes.
+Outputs made before the manifest existed are adopted the first time they're checked, if they're newer than their inputs.
+Paths inside the data directory are stored relative to it, so that the data directory can be moved.
+
+A step that only adds rows to a file (eg, `sites` after a phenotype was added) records the new version as an extension of the old one.
+Steps that only look up their own rows in an input (eg, `augment-phenos` in `sites.tsv`) pass it as `extendable_filepaths`,
+so that outputs made from the old version stay up-to-date.
+
+Each call opens its own connection, because steps run in separate processes and write the manifest concurrently.
+"""
+
+from ..file_utils import get_filepath, hash_file
+from .. import conf
+
+import os
+import json
+import sqlite3
+import contextlib
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Union
+
+Filepaths = Union[str, Sequence[str]]
+
+# seconds to wait for another process that is writing the manifest
+TIMEOUT = 600
+
+
+def is_up_to_date(
+    step: str,
+    output_filepaths: Filepaths,
+    input_filepaths: Filepaths,
+    config: Optional[Dict[str, Any]] = None,
+    extendable_filepaths: Sequence[str] = (),
+) -> bool:
+    output_filepaths, input_filepaths = _as_list(output_filepaths), _as_list(input_filepaths)
+    if not all(os.path.exists(filepath) for filepath in output_filepaths):
+        return False
+    with _connect() as db:
+        records = [
+            db.execute("SELECT sha256, inputs, config FROM artifacts WHERE output=?", (_get_key(filepath),)).fetchone()
+            for filepath in output_filepaths
+        ]
+        if all(record is None for record in records):
+            # made before the manifest existed, so fall back to comparing mtimes once
+            if not input_filepaths or max(map(_mtime, input_filepaths)) <= min(map(_mtime, output_filepaths)):
+                _record(db, step, output_filepaths, input_filepaths, config)
+                return True
+            return False
+        inputs_json = _dump_inputs(db, input_filepaths)
+        config_json = _dump_config(config)
+        extendable_keys = {_get_key(filepath) for filepath in extendable_filepaths}
+        up_to_date = all(
+            record is not None
+            and (record[1] == inputs_json or _is_extended(db, record[1], inputs_json, extendable_keys))
+            and record[2] == config_json
+            and record[0] == _get_hash(db, filepath)
+            for filepath, record in zip(output_filepaths, records)
+        )
+        if up_to_date and any(record[1] != inputs_json for record in records):
+            _record(db, step, output_filepaths, input_filepaths, config)  # so that the next check doesn't need to follow extensions
+        return up_to_date
+
+
+def get_changes(
+    output_filepath: str, input_filepaths: Filepaths, config: Optional[Dict[str, Any]] = None
+) -> Optional[Dict[str, List[str]]]:
+    """
+    Compares the inputs of `output_filepath` to the ones it was made from, for steps that can update their previous output.
+    Returns {"added": [...], "changed": [...], "extended": [...], "removed": [...]}, where "extended" are the inputs that only had rows added,
+    and "removed" holds keys of the manifest rather than filepaths.
+    Returns None if the previous output can't be reused, because it's missing, it changed after it was made, it isn't in the manifest,
+    or its config changed.
+    """
+    if not os.path.exists(output_filepath):
+        return None
+    with _connect() as db:
+        row = db.execute("SELECT sha256, inputs, config FROM artifacts WHERE output=?", (_get_key(output_filepath),)).fetchone()
+        if row is None or row[2] != _dump_config(config) or row[0] != _get_hash(db, output_filepath):
+            return None
+        old_hashes = dict(json.loads(row[1]))
+        changes: Dict[str, List[str]] = {"added": [], "changed": [], "extended": [], "removed": []}
+        current_keys = set()
+        for filepath in _as_list(input_filepaths):
+            key = _get_key(filepath)
+            current_keys.add(key)
+            sha256 = _get_hash(db, filepath)
+            if key not in old_hashes:
+                changes["added"].append(filepath)
+            elif _is_extension(db, key, old_hashes[key], sha256):
+                if old_hashes[key] != sha256:
+                    changes["extended"].append(filepath)
+            else:
+                changes["changed"].append(filepath)
+        changes["removed"] = sorted(set(old_hashes) - current_keys)
+        return changes
+
+
+def get_hash(filepath: str) -> str:
+    with _connect() as db:
+        return _get_hash(db, filepath)
+
+
+def hash_files(filepaths: Filepaths) -> None:
+    """Hashes the files that aren't in the cache yet, so that a later `record()` of them doesn't read them."""
+    with _connect() as db:
+        for filepath in _as_list(filepaths):
+            _get_hash(db, filepath)
+
+
+def record_extension(filepath: str, old_sha256: str) -> None:
+    """Call this after rewriting `filepath` with all of the rows of its version with hash `old_sha256`, in the same order, and some new rows."""
+    with _connect() as db:
+        new_sha256 = _get_hash(db, filepath)
+        if new_sha256 != old_sha256:
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO extensions (path, old_sha256, new_sha256) VALUES (?,?,?)",
+                    (_get_key(filepath), old_sha256, new_sha256),
+                )
+
+
+def record(
+    step: str, output_filepaths: Filepaths, input_filepaths: Filepaths, config: Optional[Dict[str, Any]] = None
+) -> None:
+    """Call this after `step` has written `output_filepaths` from `input_filepaths`."""
+    with _connect() as db:
+        _record(db, step, _as_list(output_filepaths), _as_list(input_filepaths), config)
+
+
+def _record(
+    db: sqlite3.Connection,
+    step: str,
+    output_filepaths: List[str],
+    input_filepaths: List[str],
+    config: Optional[Dict[str, Any]],
+) -> None:
+    inputs_json = _dump_inputs(db, input_filepaths)
+    rows = [
+        (_get_key(filepath), step, _get_hash(db, filepath), inputs_json, _dump_config(config))
+        for filepath in output_filepaths
+    ]
+    with db:
+        db.executemany("INSERT OR REPLACE INTO artifacts (output, step, sha256, inputs, config) VALUES (?,?,?,?,?)", rows)
+
+
+@contextlib.contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    db = sqlite3.connect(get_filepath("build-manifest", must_exist=False), timeout=TIMEOUT)
+    try:
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts (output TEXT PRIMARY KEY, step TEXT, sha256 TEXT, inputs TEXT, config TEXT) WITHOUT ROWID"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT) WITHOUT ROWID"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS extensions (path TEXT, old_sha256 TEXT, new_sha256 TEXT, PRIMARY KEY (path, new_sha256)) WITHOUT ROWID"
+            )
+        yield db
+    finally:
+        db.close()
+
+
+def _get_hash(db: sqlite3.Connection, filepath: str) -> str:
+    key = _get_key(filepath)
+    stat = os.stat(filepath)
+    row = db.execute("SELECT size, mtime_ns, sha256 FROM file_hashes WHERE path=?", (key,)).fetchone()
+    if row is not None and (row[0], row[1]) == (stat.st_size, stat.st_mtime_ns):
+        return row[2]
+    sha256 = hash_file(filepath)
+    with db:  # commit right away, so that the lock isn't held while hashing the next file
+        db.execute(
+            "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, sha256) VALUES (?,?,?,?)",
+            (key, stat.st_size, stat.st_mtime_ns, sha256),
+        )
+    return sha256
+
+
+def _is_extension(db: sqlite3.Connection, key: str, old_sha256: str, new_sha256: str) -> bool:
+    """Follows the recorded extensions back from `new_sha256`, looking for `old_sha256`."""
+    seen = set()
+    while new_sha256 != old_sha256:
+        if new_sha256 in seen:
+            return False
+        seen.add(new_sha256)
+        row = db.execute("SELECT old_sha256 FROM extensions WHERE path=? AND new_sha256=?", (key, new_sha256)).fetchone()
+        if row is None:
+            return False
+        new_sha256 = row[0]
+    return True
+
+
+def _is_extended(db: sqlite3.Connection, old_inputs_json: str, new_inputs_json: str, extendable_keys: Set[str]) -> bool:
+    old_inputs, new_inputs = json.loads(old_inputs_json), json.loads(new_inputs_json)
+    return [key for key, _ in old_inputs] == [key for key, _ in new_inputs] and all(
+        old_sha256 == new_sha256 or (key in extendable_keys and _is_extension(db, key, old_sha256, new_sha256))
+        for (key, old_sha256), (_, new_sha256) in zip(old_inputs, new_inputs)
+    )
+
+
+def _dump_inputs(db: sqlite3.Connection, input_filepaths: List[str]) -> str:
+    return json.dumps(sorted([_get_key(filepath), _get_hash(db, filepath)] for filepath in input_filepaths))
+
+
+def _dump_config(config: Optional[Dict[str, Any]]) -> str:
+    return json.dumps(config or {}, sort_keys=True, default=sorted)  # config can hold sets, eg `ASSOC_TEST_NAME`
+
+
+def _get_key(filepath: str) -> str:
+    filepath = os.path.abspath(filepath)
+    data_dir = os.path.abspath(conf.get_pheweb_data_dir())
+    if filepath.startswith(data_dir + os.sep):
+        return os.path.relpath(filepath, data_dir)
+    return filepath
+
+
+def _as_list(filepaths: Filepaths) -> List[str]:
+    return [filepaths] if isinstance(filepaths, str) else list(filepaths)
+
+
+def _mtime(filepath: str) -> float:
+    return os.stat(filepath).st_mtime
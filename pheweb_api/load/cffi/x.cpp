@@ -330,10 +330,11 @@ public:
         next();
     }
     inline void next() {
-        std::getline(stream, line); // drops the \n
+        has_line = static_cast<bool>(std::getline(stream, line)); // drops the \n
         if (!line.empty() && line[line.size() - 1] == '\r') line.erase(line.size() - 1); // CR remover from <http://stackoverflow.com/a/2529011/1166306>
     }
     inline bool eof() { return stream.peek() == std::ifstream::traits_type::eof(); } // tells whether `next()` will work.
+    bool has_line = false; // whether `line` holds a line that was read, which is still true for the last line when `eof()` is
     std::string line;
     igzstream stream;
 };
@@ -471,7 +472,7 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
         size_t pos_after_cpra = pos_after_n_of_char(sites_reader.line, 4, '\t');
 
         for (size_t i=0; i<N_phenos; i++) {
-            if (!aug_readers[i].eof() && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
+            if (aug_readers[i].has_line && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
                 if (0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
                     std::ostringstream errstream;
                     errstream << "[There's a variant in a pheno file that has different information from that same variant in sites.tsv.]";
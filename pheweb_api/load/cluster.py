@@ -1,13 +1,33 @@
-from ..utils import get_phenolist, get_phenocode_with_stratifications
+"""
+Runs the heavy loading steps as array jobs on a cluster (Slurm, SGE or UGE), or with `--engine local`, as processes on this machine.
+
+`--step <step>` makes one array job for a per-phenotype step, over the phenos that aren't up-to-date.
+`--step all` makes a job for each heavy step, which starts once the jobs that make its inputs have completed:
+    parse -> sites (a merge tree, with one job per level) -> annotate (rsids, genes and the variant index) -> augment-phenos
+    -> manhattan, qq, best-of-pheno, and matrix (one task per chromosome, and then one that concatenates them)
+    -> gather-pvalues-for-each-gene (one task per shard of the regions)
+Then a final reduction, which builds best-phenos-by-gene.sqlite3 from the shards and runs `pheweb2 process` for the light steps, runs locally.
+Every task only processes what isn't up-to-date, so the jobs can be resubmitted after a failure.
+
+The annotate job runs `add-rsids` with NUM_PROCS processes, one chromosome each, and asks the cluster for that many CPUs.
+The other tasks run with one process.
+
+`--engine local` runs the same jobs and the final reduction with up to NUM_PROCS processes at a time, which stands in for a cluster in tests.
+"""
+
+from ..utils import get_phenolist, get_phenocode_with_stratifications, chrom_order_list, PheWebError
 from .. import conf
-from ..file_utils import get_tmp_path, get_dated_tmp_path
-from .load_utils import PerPhenoParallelizer
+from ..file_utils import get_tmp_path, get_dated_tmp_path, get_generated_path
+from .load_utils import PerPhenoParallelizer, ChildTask, run_tasks_in_children
 from boltons.fileutils import mkdir_p  # to make tmp directory
 
+import os
 import sys
+import shlex
 import argparse
+import importlib
 from boltons.iterutils import chunked
-from typing import List, Dict, Any
+from typing import List, NamedTuple
 
 header_template = {
     "slurm": """\
@@ -35,6 +55,12 @@ header_template = {
 #$ -e {tmp_path}
 """,
 }
+# for a job whose tasks run with more than one process
+cpus_option = {
+    "slurm": "#SBATCH --cpus-per-task={num_procs}\n",
+    "sge": "#$ -pe smp {num_procs}\n",
+    "uge": "#$ -pe smp {num_procs}\n",
+}
 array_id_variable = {
     "slurm": "SLURM_ARRAY_TASK_ID",
     "sge": "SGE_TASK_ID",
@@ -50,89 +76,233 @@ monitor_command = {
     "sge": "qstat -j",
     "uge": "qstat -j",
 }
+# for submitting a job that waits for others, in a script that keeps its job id
+parsable_submit_command = {
+    "slurm": "sbatch --parsable",
+    "sge": "qsub -terse",
+    "uge": "qsub -terse",
+}
+dependency_option = {
+    "slurm": lambda job_ids: "--dependency=afterok:" + ":".join(job_ids),
+    "sge": lambda job_ids: "-hold_jid " + ",".join(job_ids),
+    "uge": lambda job_ids: "-hold_jid " + ",".join(job_ids),
+}
+# removes what follows the job id in the output of `parsable_submit_command` (eg, the cluster, or the range of an array)
+job_id_suffix_pattern = {
+    "slurm": ";*",
+    "sge": ".*",
+    "uge": ".*",
+}
+
+# the per-pheno steps, and their modules
+per_pheno_steps = {
+    "parse": "parse_input_files",
+    "augment-phenos": "augment_phenos",
+    "manhattan": "manhattan",
+    "qq": "qq",
+    "best-of-pheno": "best_of_pheno",
+}
+
+
+class Job(NamedTuple):
+    name: str
+    tasks: List[List[str]]  # the `pheweb2` commands of each task of the array job, like [["conf NUM_PROCS=1 parse --phenos=0,1,2"], ...]
+    deps: List[str]  # the names of the jobs that must complete first
+    num_procs: int = 1  # the processes that each task uses
 
 
 def run(argv: List[str]) -> None:
     parser = argparse.ArgumentParser()
-    parser.add_argument("--engine", choices=["slurm", "sge", "uge"], required=True)
+    parser.add_argument("--engine", choices=["slurm", "sge", "uge", "local"], required=True)
+    parser.add_argument(
+        "--step", choices=list(per_pheno_steps) + ["all"], required=True
+    )
+    parser.add_argument("--N_per_job", type=int, default=3) # default is 3 to avoid IO restictions
     parser.add_argument(
-        "--step", choices=["parse", "augment-phenos", "manhattan", "qq"], required=True
+        "--gather-shards", type=int, default=20, help="How many tasks `gather-pvalues-for-each-gene` is split into, with `--step all`"
     )
-    parser.add_argument("--N_per_job", default=3) # default is 3 to avoid IO restictions
     parser.add_argument("--account", help="Slurm account to use")
     args = parser.parse_args(argv)
 
-    def should_process(pheno: Dict[str, Any]) -> bool:
-        # print(pheno)
-        if args.step == "parse":
-            from . import parse_input_files
-
-            get_input_filepaths = parse_input_files.get_input_filepaths
-            get_output_filepaths = parse_input_files.get_output_filepaths
-        elif args.step == "augment-phenos":
-            from . import augment_phenos
-
-            get_input_filepaths = augment_phenos.get_input_filepaths
-            get_output_filepaths = augment_phenos.get_output_filepaths
-        elif args.step == "manhattan":
-            from . import manhattan
-
-            get_input_filepaths = manhattan.get_input_filepaths
-            get_output_filepaths = manhattan.get_output_filepaths
-        elif args.step == "qq":
-            from . import qq
-
-            get_input_filepaths = qq.get_input_filepaths
-            get_output_filepaths = qq.get_output_filepaths
-        else:
-            raise Exception("No implementation for step {}".format(args.step))
-        return PerPhenoParallelizer().should_process_pheno(
-            pheno,
-            get_input_filepaths=get_input_filepaths,
-            get_output_filepaths=get_output_filepaths,
-        )
+    if args.step == "all":
+        jobs = get_pipeline_jobs(args.N_per_job, args.gather_shards)
+        reduction = [
+            "gather-pvalues-for-each-gene --from-shards {}".format(args.gather_shards),
+            "process",
+        ]
+    else:
+        idxs = get_idxs_to_process(args.step)
+        if not idxs:
+            print("All phenos are up-to-date!")
+            exit(0)
+        jobs = [Job(args.step, get_per_pheno_tasks(args.step, idxs, args.N_per_job), [])]
+        reduction = []
+
+    if args.engine == "local":
+        if reduction:
+            jobs.append(Job("reduce", [reduction], [job.name for job in jobs]))
+        run_jobs_locally(jobs)
+        return
+
+    write_job_scripts(jobs, args.engine, args.step, args.account)
+    if reduction:
+        print("Once all of the jobs have completed, finish locally with:")
+        print("\n".join("{} {}".format(sys.argv[0], command) for command in reduction) + "\n")
+
+
+def get_idxs_to_process(step: str) -> List[int]:
+    """Returns the indexes in pheno-list.json of the phenos that `step` hasn't processed yet."""
+    module = importlib.import_module(".{}".format(per_pheno_steps[step]), __package__)
+    get_config = getattr(module, "get_config", None)
+    extendable_filepaths = getattr(module, "get_extendable_filepaths", list)()
+
     phenolist = get_phenolist()
     for pheno in phenolist:
         if pheno["interaction"] is not None:
             pheno["phenocode"] += ".interaction-" + pheno["interaction"]
         if conf.has_stratifications():
             pheno["phenocode"] = get_phenocode_with_stratifications(pheno)
-            
-    idxs = [i for i, pheno in enumerate(phenolist) if should_process(pheno)]
-    if not idxs:
-        print("All phenos are up-to-date!")
-        exit(0)
-    
-    jobs = chunked(idxs, args.N_per_job)
-    batch_filepath = get_dated_tmp_path("{}-{}".format(args.engine, args.step)) + ".sh"
-    tmp_path = get_tmp_path(args.step)
+
+    return [
+        i
+        for i, pheno in enumerate(phenolist)
+        if PerPhenoParallelizer().should_process_pheno(
+            pheno,
+            get_input_filepaths=module.get_input_filepaths,
+            get_output_filepaths=module.get_output_filepaths,
+            get_config=get_config,
+            extendable_filepaths=extendable_filepaths,
+        )
+    ]
+
+
+def get_per_pheno_tasks(step: str, idxs: List[int], n_per_job: int) -> List[List[str]]:
+    return [
+        ["conf NUM_PROCS=1 {} --phenos={}".format(step, ",".join(map(str, job)))]
+        for job in chunked(idxs, n_per_job)
+    ]
+
+
+def get_pipeline_jobs(n_per_job: int, num_gather_shards: int) -> List[Job]:
+    from . import sites
+
+    all_idxs = list(range(len(get_phenolist())))
+    jobs = []
+    # the inputs of the later steps don't exist yet, so they run on every pheno, and each task skips the ones that are up-to-date
+    parse_idxs = get_idxs_to_process("parse")
+    if parse_idxs:
+        jobs.append(Job("parse", get_per_pheno_tasks("parse", parse_idxs, n_per_job), []))
+    for level, nodes in enumerate(sites.get_merge_tree(len(all_idxs))):
+        jobs.append(Job(
+            "sites-{}".format(level),
+            [["conf NUM_PROCS=1 sites --tree-node {}-{}".format(level, index)] for index in range(len(nodes))],
+            [jobs[-1].name] if jobs else [],
+        ))
+    # `add-rsids` annotates the chromosomes in parallel
+    num_procs = conf.get_num_procs("add-rsids")
+    jobs.append(Job(
+        "annotate",
+        [["conf NUM_PROCS={} {}".format(num_procs, command) for command in ["make-gene-aliases-sqlite3", "add-rsids", "add-genes", "make-variant-index"]]],
+        [jobs[-1].name],
+        num_procs,
+    ))
+    jobs.append(Job("augment-phenos", get_per_pheno_tasks("augment-phenos", all_idxs, n_per_job), ["annotate"]))
+    for step in ["manhattan", "qq", "best-of-pheno"]:
+        jobs.append(Job(step, get_per_pheno_tasks(step, all_idxs, n_per_job), ["augment-phenos"]))
+    jobs.append(Job(
+        "matrix-chroms",
+        [["conf NUM_PROCS=1 matrix --chrom {}".format(chrom)] for chrom in chrom_order_list],
+        ["augment-phenos"],
+    ))
+    jobs.append(Job("matrix", [["conf NUM_PROCS=1 matrix --concat-chroms"]], ["matrix-chroms"]))
+    jobs.append(Job(
+        "gather-pvalues",
+        [
+            ["conf NUM_PROCS=1 gather-pvalues-for-each-gene --shard {}/{}".format(shard_idx, num_gather_shards)]
+            for shard_idx in range(num_gather_shards)
+        ],
+        ["matrix"],
+    ))
+    return jobs
+
+
+def write_job_scripts(jobs: List[Job], engine: str, name: str, account: str = None) -> None:
+    """Writes a script for each job. With more than one job, also writes `submit.sh`, which submits each one to wait for its dependencies."""
+    batch_dir = get_dated_tmp_path("{}-{}".format(engine, name))
+    tmp_path = get_tmp_path(name)
+    mkdir_p(batch_dir)
     mkdir_p(tmp_path)
+    header = header_template[engine]
     # specify the account for slurm
-    slurm_header = header_template[args.engine]
-    if args.engine == "slurm" and args.account:  
-        slurm_header = slurm_header.replace(
+    if engine == "slurm" and account:
+        header = header.replace(
             "#!/bin/bash\n",
-            "#!/bin/bash\n#SBATCH --account={}\n".format(args.account)
-        )
-    with open(batch_filepath, "w") as f:
-        f.write(
-            slurm_header.format(
-                n_jobs_m1=len(jobs) - 1, n_jobs=len(jobs), tmp_path=tmp_path
-            )
+            "#!/bin/bash\n#SBATCH --account={}\n".format(account)
         )
-        f.write("\n\njobs=(\n")
-        for job in jobs:
-            f.write(",".join(map(str, job)) + "\n")
-        f.write(")\n\n")
-        f.write("export PHEWEB_DATADIR={!r}\n".format(conf.get_pheweb_data_dir()))
-        f.write(
-            sys.argv[0]
-            + " conf NUM_PROCS=1 "
-            + args.step
-            + " --phenos=${jobs[$"
-            + array_id_variable[args.engine]
-            + "]}\n"
-        )
-    print("Run:\n{} {}\n".format(submit_command[args.engine], batch_filepath))
-    print("Monitor with `{} <jobid>`\n".format(monitor_command[args.engine]))
+    script_filepaths = {}
+    for job in jobs:
+        script_filepaths[job.name] = os.path.join(batch_dir, job.name + ".sh")
+        job_header = header
+        if job.num_procs > 1:
+            job_header = job_header.replace("#!/bin/bash\n", "#!/bin/bash\n" + cpus_option[engine].format(num_procs=job.num_procs))
+        with open(script_filepaths[job.name], "w") as f:
+            f.write(job_header.format(n_jobs_m1=len(job.tasks) - 1, n_jobs=len(job.tasks), tmp_path=tmp_path))
+            f.write("\n\nexport PHEWEB_DATA_DIR={!r}\n".format(conf.get_pheweb_data_dir()))
+            f.write("case ${} in\n".format(array_id_variable[engine]))
+            for i, commands in enumerate(job.tasks):
+                f.write("{}) {} ;;\n".format(i, " && ".join("{} {}".format(sys.argv[0], command) for command in commands)))
+            f.write("esac\n")
+
+    if len(jobs) == 1:
+        print("Run:\n{} {}\n".format(submit_command[engine], script_filepaths[jobs[0].name]))
+    else:
+        submit_filepath = os.path.join(batch_dir, "submit.sh")
+        with open(submit_filepath, "w") as f:
+            f.write("#!/bin/bash\nset -euo pipefail\n\n")
+            for job in jobs:
+                variable = job.name.replace("-", "_")
+                f.write("{}=$({}{} {})\n".format(
+                    variable,
+                    parsable_submit_command[engine],
+                    " " + dependency_option[engine](["${}".format(dep.replace("-", "_")) for dep in job.deps]) if job.deps else "",
+                    script_filepaths[job.name],
+                ))
+                f.write("{0}=${{{0}%%{1}}}\n".format(variable, job_id_suffix_pattern[engine]))
+                f.write('echo "{} is job ${}"\n'.format(job.name, variable))
+        print("Run:\nbash {}\n".format(submit_filepath))
+    print("Monitor with `{} <jobid>`\n".format(monitor_command[engine]))
     print("output will be in {}".format(tmp_path))
+
+
+def run_jobs_locally(jobs: List[Job]) -> None:
+    """Runs each task of each job in a child process, up to NUM_PROCS at a time, once the jobs that it depends on have completed."""
+    log_dir = get_generated_path("tmp", "cluster-logs")
+    tasks = [
+        ChildTask(
+            group=job.name,
+            name="{}-{}".format(job.name, i),
+            description="Job {} task {}".format(job.name, i),
+            target=_run_commands,
+            args=(commands,),
+            deps=job.deps,
+        )
+        for job in jobs
+        for i, commands in enumerate(job.tasks)
+    ]
+    num_tasks = {job.name: len(job.tasks) for job in jobs}
+
+    def on_completion(task: ChildTask, seconds: float, group_completed: bool) -> None:
+        if group_completed:
+            print("==> Completed job {} ({} tasks)".format(task.group, num_tasks[task.group]), flush=True)
+
+    failed = run_tasks_in_children(tasks, log_dir, max_running=conf.get_num_procs(), on_completion=on_completion)
+    if failed:
+        raise PheWebError("Failed: {}. The logs are in {}".format(", ".join(task.description for task in failed), log_dir))
+
+
+def _run_commands(commands: List[str]) -> None:
+    from ..command_line import run as run_command
+
+    for command in commands:
+        print("==> pheweb2 {}".format(command), flush=True)
+        run_command(shlex.split(command))
@@ -3,95 +3,315 @@ This avoids reading any variant more than once.
  The sum of unpadded lengths of all 20k genes is 1400Mbases.
  The sum of the padded lengths is 5400Mbases.
  The total number of bases in the padded genes (without double-counting overlaps) is 2100Mbases (40%) (in 16k intervals)
+
+Each task is one region of one matrix. The worker keeps only `(pval, pos, raw columns)` for the best variant of each gene and phenotype,
+and sends the rows of a gene to the parent as soon as the region has been read past the gene, so memory doesn't grow with the matrix.
+The parent is the only process that writes to SQLite.
+
+`pheweb2 cluster` splits the regions between jobs (`--shard`), which each write their rows to their own SQLite file in `tmp/gather-shards/`,
+and then builds the database from those files (`--from-shards`) instead of from the matrices.
 """
 
-from ..utils import get_padded_gene_tuples, get_phenolist, get_stratification_paths
-from ..file_utils import MatrixReader, get_filepath, get_tmp_path, get_pheno_filepath
+from ..utils import get_padded_gene_tuples, get_phenolist, get_stratification_paths, PheWebError
+from ..file_utils import MatrixReader, get_filepath, get_tmp_path, get_pheno_filepath, get_generated_path, make_basedir
+from .. import parse_utils
 from .load_utils import Parallelizer
+from . import build_manifest
+from ..models.gene_index import GeneIntervals, get_gene_intervals_for_chrom
 from .. import conf
 
+import os
 import sqlite3
 import json
+import argparse
 import traceback
 import functools
+import contextlib
 from pathlib import Path
-from intervaltree import IntervalTree, Interval
-from typing import List, Any, Dict, Tuple
-import copy
+import boltons.iterutils
+import numpy as np
+from typing import List, Any, Dict, Iterable, Iterator, Optional, Tuple
+
+
+# rows are sent to the parent in batches of about this many
+ROWS_PER_BATCH = 10_000
+# matrix rows are assigned to genes this many at a time
+ROWS_PER_CHUNK = 10_000
+
+STEP = "gather-pvalues-for-each-gene"
+
+# (gene, phenocode, stratification, pval, json)
+AssociationRow = Tuple[str, str, str, float, str]
 
 
 def run(argv: List[str]) -> None:
-    if argv and "-h" in argv:
-        print("get info for genes")
-        exit(0)
+    parser = argparse.ArgumentParser(description="get info for genes")
+    parser.add_argument(
+        "--shard",
+        help="Like '3/50': only gather every 50th region starting from the 4th, into tmp/gather-shards/, for `pheweb2 cluster` (and only if the database isn't up-to-date)",
+    )
+    parser.add_argument(
+        "--from-shards",
+        type=int,
+        metavar="N",
+        help="Build the database from the N shards that `--shard` made, instead of reading the matrices",
+    )
+    args = parser.parse_args(argv)
 
-    print("running matrix")
-    # Check whether we're already up-to-date.
     out_filepath = Path(get_filepath("best-phenos-by-gene-sqlite3", must_exist=False))
+    genes_filepath = Path(get_filepath("genes"))
+    matrix_filepaths = get_matrix_filepaths()
+    input_filepaths = [str(genes_filepath)] + [str(filepath) for filepath in matrix_filepaths.values()]
 
-    if conf.has_stratifications():
-        matrix_filepaths = []
-        stratification_paths = set(get_stratification_paths(get_phenolist()))
-        print(f"stratification paths : {stratification_paths}")
-        for stratification_path in stratification_paths:
-            matrix_filepaths.append(
-                Path(get_pheno_filepath("matrix-stratified", stratification_path))
-            )
-    else:
-        matrix_filepaths = [Path(get_filepath("matrix"))]
+    if args.shard:
+        shard_idx, num_shards = map(int, args.shard.split("/"))
+        gather_shard(out_filepath, matrix_filepaths, input_filepaths, shard_idx, num_shards)
+        return
 
-    print(f"{matrix_filepaths=}")
+    # Check whether we're already up-to-date.
+    if out_filepath.exists() and not has_gene_associations_table(out_filepath):
+        # A database made before the manifest is adopted if it's newer than the matrices.
+        if build_manifest.is_up_to_date(STEP, str(out_filepath), input_filepaths):
+            convert_legacy_db(out_filepath)
+            build_manifest.record(STEP, str(out_filepath), input_filepaths)
+            print("Done converting {} to one row per gene and phenotype".format(str(out_filepath)))
+            return
+    elif build_manifest.is_up_to_date(STEP, str(out_filepath), input_filepaths):
+        print("{} is up-to-date!".format(str(out_filepath)))
+        return
+    elif args.from_shards is None:
+        changes = build_manifest.get_changes(str(out_filepath), input_filepaths)
+        changed_filepaths = [] if changes is None else changes["added"] + changes["changed"] + changes["extended"]
+        if changes is not None and str(genes_filepath) not in changed_filepaths:
+            stratification_of_filepath = {str(filepath): stratification for stratification, filepath in matrix_filepaths.items()}
+            changed = [stratification_of_filepath[filepath] for filepath in changed_filepaths]
+            db = sqlite3.connect(str(out_filepath))
+            try:
+                num_updated = update_stratifications(db, matrix_filepaths, changed, bool(changes["removed"]))
+            finally:
+                db.close()
+            build_manifest.record(STEP, str(out_filepath), input_filepaths)
+            print("Done updating {} stratifications of best-pheno-for-each-gene at {}".format(num_updated, str(out_filepath)))
+            return
 
     out_tmp_filepath = Path(get_tmp_path(out_filepath))
+    if out_tmp_filepath.exists():
+        out_tmp_filepath.unlink()
+    db = sqlite3.connect(str(out_tmp_filepath))
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        with db:
+            create_gene_associations_tables(db)
+        if args.from_shards is None:
+            gather(db, list(matrix_filepaths.values()))
+        else:
+            gather_from_shards(db, args.from_shards)
+        with db:
+            fill_genes_table(db)
+            create_gene_associations_indexes(db)
+    finally:
+        db.close()
+    out_tmp_filepath.replace(out_filepath)
+    build_manifest.record(STEP, str(out_filepath), input_filepaths)
+    if args.from_shards is not None:
+        for shard_idx in range(args.from_shards):
+            os.remove(get_shard_filepath(shard_idx))
+    print("Done making best-pheno-for-each-gene at {}".format(str(out_filepath)))
 
-    best_phenos_for_gene: Dict[str, List[Dict[str, Any]]] = {}
-    for i, matrix_filepath in enumerate(matrix_filepaths):
-        if (
-            out_filepath.exists()
-            and matrix_filepath.stat().st_mtime < out_filepath.stat().st_mtime
-        ):
-            print("{} is up-to-date!".format(str(out_filepath)))
-            return
 
-        else:
-            regions_on_chrom = get_regions_on_chrom()
-            regions: List[Tuple[str, int, int]] = [
-                (chrom, start, end)
-                for chrom, regions in regions_on_chrom.items()
-                for (start, end) in regions
-            ]
-            
-            print(f"{len(regions)=}")
-            
-            task_results = Parallelizer().run_multiple_tasks(
-                tasks=regions,
-                do_multiple_tasks=process_regions,
-                cmd="gather-pvalues-for-each-gene",
-                matrix_filepath=matrix_filepath,
+def get_matrix_filepaths() -> Dict[str, Path]:
+    """Returns {stratification: matrix filepath}, where stratification is spelled like in `gene_associations` (eg, "european.male")."""
+    if conf.has_stratifications():
+        return {
+            stratification_path.lstrip("."): Path(get_pheno_filepath("matrix-stratified", stratification_path))
+            for stratification_path in sorted(set(get_stratification_paths(get_phenolist())))
+        }
+    return {"": Path(get_filepath("matrix"))}
+
+
+def gather(db: sqlite3.Connection, matrix_filepaths: List[Path], shard: Optional[Tuple[int, int]] = None) -> None:
+    """
+    Inserts the best association of each gene and phenotype of the matrices into `gene_associations`, as the workers send them.
+    `shard` is like (shard_idx, num_shards), to only gather every num_shards-th region.
+    """
+    regions_on_chrom = get_regions_on_chrom()
+    tasks: List[Tuple[str, str, int, int]] = [
+        (str(matrix_filepath), chrom, start, end)
+        for matrix_filepath in matrix_filepaths
+        for chrom, regions in regions_on_chrom.items()
+        for (start, end) in regions
+    ]
+    print("Gathering p-values for {} regions of {} matrices".format(len(tasks) // max(1, len(matrix_filepaths)), len(matrix_filepaths)))
+    if shard is not None:
+        tasks = tasks[shard[0]::shard[1]]
+        print("Gathering shard {} of {}, with {} regions".format(shard[0], shard[1], len(tasks)))
+    task_results = Parallelizer().run_multiple_tasks(
+        tasks=tasks,
+        do_multiple_tasks=process_regions,
+        cmd="gather-pvalues-for-each-gene",
+    )
+    for task_result in task_results:
+        assert task_result["type"] == "result"
+        insert_gene_association_rows(db, task_result["value"])
+
+
+def gather_shard(
+    out_filepath: Path, matrix_filepaths: Dict[str, Path], input_filepaths: List[str], shard_idx: int, num_shards: int
+) -> None:
+    if (
+        out_filepath.exists()
+        and has_gene_associations_table(out_filepath)
+        and build_manifest.is_up_to_date(STEP, str(out_filepath), input_filepaths)
+    ):
+        print("{} is up-to-date!".format(str(out_filepath)))
+        return
+    shard_filepath = get_shard_filepath(shard_idx)
+    make_basedir(shard_filepath)
+    shard_tmp_filepath = Path(get_tmp_path(shard_filepath))
+    if shard_tmp_filepath.exists():
+        shard_tmp_filepath.unlink()
+    db = sqlite3.connect(str(shard_tmp_filepath))
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        with db:
+            create_gene_associations_tables(db)
+            gather(db, list(matrix_filepaths.values()), shard=(shard_idx, num_shards))
+    finally:
+        db.close()
+    shard_tmp_filepath.replace(shard_filepath)
+
+
+def gather_from_shards(db: sqlite3.Connection, num_shards: int) -> None:
+    for shard_idx in range(num_shards):
+        shard_filepath = get_shard_filepath(shard_idx)
+        if not os.path.exists(shard_filepath):
+            raise PheWebError(
+                "{} doesn't exist. Run `pheweb2 gather-pvalues-for-each-gene --shard {}/{}` first.".format(shard_filepath, shard_idx, num_shards)
             )
-            # best_phenos_for_gene: Dict[str, List[Dict[str, Any]]] = {}
-            for task_result in task_results:
-                assert task_result["type"] == "result"
-                partial_best_phenos_for_gene = task_result["value"]
-                for genename, best_phenos in partial_best_phenos_for_gene.items():
-                    # assert genename not in best_phenos_for_gene
-                    if genename in best_phenos_for_gene:
-                        best_phenos_for_gene[genename].extend(best_phenos)
-                    else:
-                        best_phenos_for_gene[genename] = best_phenos
-    data = best_phenos_for_gene
-    out_tmp_filepath = Path(get_tmp_path(out_filepath))
-    db = sqlite3.connect(str(out_tmp_filepath))
-    with db:
-        db.execute(
-            "CREATE TABLE IF NOT EXISTS best_phenos_for_each_gene (gene TEXT PRIMARY KEY, json TEXT)"
+        db.execute("ATTACH DATABASE ? AS shard", (shard_filepath,))
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO gene_associations (gene, phenocode, stratification, pval, json)"
+                " SELECT gene, phenocode, stratification, pval, json FROM shard.gene_associations"
+            )
+        db.execute("DETACH DATABASE shard")
+
+
+def get_shard_filepath(shard_idx: int) -> str:
+    return get_generated_path("tmp", "gather-shards", "{}.sqlite3".format(shard_idx))
+
+
+def update_stratifications(
+    db: sqlite3.Connection, matrix_filepaths: Dict[str, Path], changed: List[str], has_removed: bool
+) -> int:
+    """
+    Replaces the rows of the stratifications whose matrix changed (or was removed) in one transaction, so readers never see a partial update.
+    Returns the number of stratifications that were updated.
+    """
+    removed = []
+    if has_removed:
+        removed = sorted(
+            stratification
+            for (stratification,) in db.execute("SELECT DISTINCT stratification FROM gene_associations")
+            if stratification not in matrix_filepaths
         )
+    print("Updating stratifications: {}".format(", ".join(
+        repr(stratification) for stratification in changed + removed
+    )))
+    with db:
         db.executemany(
-            "INSERT INTO best_phenos_for_each_gene (gene, json) VALUES (?,?)",
-            ((k, json.dumps(v)) for k, v in data.items()),
+            "DELETE FROM gene_associations WHERE stratification = ?",
+            [(stratification,) for stratification in changed + removed],
         )
-    out_tmp_filepath.replace(out_filepath)
-    print("Done making best-pheno-for-each-gene at {}".format(str(out_filepath)))
+        gather(db, [matrix_filepaths[stratification] for stratification in changed])
+        fill_genes_table(db)
+        db.execute("DROP TABLE IF EXISTS input_manifest")  # from before `build-manifest.sqlite3`
+    return len(changed) + len(removed)
+
+
+def create_gene_associations_tables(db: sqlite3.Connection) -> None:
+    # One row per gene and (stratified) phenocode, holding the association already encoded as JSON,
+    #  so that the API can page through a gene's associations without decoding and re-encoding them.
+    db.execute(
+        "CREATE TABLE gene_associations (gene TEXT, phenocode TEXT, stratification TEXT, pval REAL, json TEXT,"
+        " PRIMARY KEY (gene, phenocode)) WITHOUT ROWID"
+    )
+    db.execute(
+        "CREATE TABLE genes (gene TEXT PRIMARY KEY, num_associations INTEGER, best_pval REAL) WITHOUT ROWID"
+    )
+
+
+def create_gene_associations_indexes(db: sqlite3.Connection) -> None:
+    db.execute("CREATE INDEX gene_associations_by_pval ON gene_associations (gene, pval)")
+    db.execute(
+        "CREATE INDEX gene_associations_by_stratification ON gene_associations (gene, stratification, pval)"
+    )
+
+
+def insert_gene_association_rows(db: sqlite3.Connection, rows: Iterable[AssociationRow]) -> None:
+    db.executemany(
+        "INSERT OR REPLACE INTO gene_associations (gene, phenocode, stratification, pval, json) VALUES (?,?,?,?,?)",
+        rows,
+    )
+
+
+def fill_genes_table(db: sqlite3.Connection) -> None:
+    db.execute("DELETE FROM genes")
+    db.execute(
+        "INSERT INTO genes (gene, num_associations, best_pval)"
+        " SELECT gene, COUNT(*), MIN(pval) FROM gene_associations GROUP BY gene"
+    )
+
+
+def make_association_row(genename: str, assoc: Dict[str, Any]) -> AssociationRow:
+    return (
+        genename,
+        assoc["phenocode"],
+        get_stratification_code(assoc),
+        assoc["pval"],
+        json.dumps(assoc, separators=(",", ":")),
+    )
+
+
+def get_stratification_code(assoc: Dict[str, Any]) -> str:
+    """Returns the stratification like the API spells it (eg, "european.male"), or "" if the phenotype isn't stratified."""
+    return ".".join((assoc.get("stratification") or {}).values())
+
+
+assert get_stratification_code({"stratification": {"ancestry": "european", "sex": "male"}}) == "european.male"
+assert get_stratification_code({}) == ""
+
+
+def has_gene_associations_table(filepath: Path) -> bool:
+    db = sqlite3.connect(str(filepath))
+    try:
+        return db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='gene_associations'"
+        ).fetchone() is not None
+    finally:
+        db.close()
+
+
+def convert_legacy_db(filepath: Path) -> None:
+    """Rewrites a database with one JSON blob per gene (`best_phenos_for_each_gene`) as one row per association, without re-reading the matrix."""
+    tmp_filepath = Path(get_tmp_path(filepath))
+    if tmp_filepath.exists():
+        tmp_filepath.unlink()
+    old_db = sqlite3.connect(str(filepath))
+    db = sqlite3.connect(str(tmp_filepath))
+    try:
+        with db:
+            create_gene_associations_tables(db)
+            for genename, blob in old_db.execute("SELECT gene, json FROM best_phenos_for_each_gene"):
+                insert_gene_association_rows(db, (make_association_row(genename, assoc) for assoc in json.loads(blob)))
+            fill_genes_table(db)
+            create_gene_associations_indexes(db)
+    finally:
+        db.close()
+        old_db.close()
+    tmp_filepath.replace(filepath)
 
 
 def get_regions_on_chrom() -> Dict[str, List[Tuple[int, int]]]:
@@ -118,7 +338,7 @@ def merged_intervals(intervals: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
 assert merged_intervals([(1, 2), (2, 4), (5, 7)]) == [(1, 4), (5, 7)]
 
 
-def process_regions(taskq, retq, parent_overrides, matrix_filepath) -> None:
+def process_regions(taskq, retq, parent_overrides) -> None:
     try:
         from .. import conf
 
@@ -137,82 +357,108 @@ def process_regions(taskq, retq, parent_overrides, matrix_filepath) -> None:
             }
         )
         raise
-    tree_for_chrom = get_gene_intervaltree_for_chrom()
+    intervals_for_chrom = get_gene_intervals_for_chrom_with_padding()
+
+    # each worker opens a matrix the first time it gets a region of it, and keeps it open
+    with contextlib.ExitStack() as stack:
+        matrix_readers: Dict[str, Any] = {}
+
+        def get_matrix_reader(matrix_filepath: str):
+            if matrix_filepath not in matrix_readers:
+                matrix_readers[matrix_filepath] = stack.enter_context(
+                    MatrixReader(matrix_filepath=matrix_filepath).context()
+                )
+            return matrix_readers[matrix_filepath]
 
-    # TODO: fix this
-    with MatrixReader(matrix_filepath=matrix_filepath).context() as matrix_reader:
-        f = functools.partial(get_region_info, matrix_reader, tree_for_chrom)
-        Parallelizer._make_multiple_tasks_doer(f)(taskq, retq, parent_overrides)
+        def do_task(task: Tuple[str, str, int, int]) -> Iterator[List[AssociationRow]]:
+            matrix_filepath, chrom, start, end = task
+            return get_region_info(get_matrix_reader(matrix_filepath), intervals_for_chrom, (chrom, start, end))
+
+        Parallelizer._make_multiple_tasks_doer(do_task)(taskq, retq, parent_overrides)
 
 
 def get_region_info(
-    matrix_reader, tree_for_chrom: Dict[str, IntervalTree], region: Tuple[str, int, int]
-) -> Dict[str, List[Dict[str, Any]]]:
+    matrix_reader, intervals_for_chrom: Dict[str, GeneIntervals], region: Tuple[str, int, int]
+) -> Iterator[List[AssociationRow]]:
+    """Yields batches of rows for `gene_associations`. A gene's rows are yielded once every variant in its padded range has been read."""
     chrom, start, end = region
-    best_assoc_for_pheno_gene_pair: Dict[Tuple[str, str], Dict[str, Any]] = {}
-    # best_assoc_for_pheno_gene_pair is like:
-    # { ('<phenocode>', '<genename>'): {'ac': 35, ... all per_pheno and per_assoc fields} }
-
-    for variant in matrix_reader.get_region(chrom, start, end + 1):
-        # genenames: List[str] = [
-        #     iv.data for iv in tree_for_chrom[variant["chrom"]].at(variant["pos"])
-        # ]
-        genenames_and_range = [
-            # HX
-            # tree: start, end, (genename, true_start, true_end)
-            # last tree elements are data
-            (iv.data[0], iv.data[1], iv.data[2]) for iv in tree_for_chrom[variant["chrom"]].at(variant["pos"])
-        ]
-        for phenocode, pheno in variant["phenos"].items():
-            assert isinstance(pheno["pval"], float)
-            for genename, true_start, true_end in genenames_and_range:
-                pheno_gene_pair = (phenocode, genename)
-                if (
-                    pheno_gene_pair not in best_assoc_for_pheno_gene_pair
-                    or pheno["pval"] < best_assoc_for_pheno_gene_pair[pheno_gene_pair]["pval"]
-                ):
-                    # HX: add info of whether variant is in gene range and how far variant is from a gene
-                    pheno_copy = copy.deepcopy(pheno)
-                    relative_distance_to_gene = variant["pos"] - true_start
-                    is_in_real_range = true_start <= variant["pos"] <= true_end
-                    pheno_copy["distance_to_true_start"] = relative_distance_to_gene
-                    pheno_copy["is_in_real_range"] = is_in_real_range
-                    best_assoc_for_pheno_gene_pair[pheno_gene_pair] = pheno_copy
-
-    phenos_in_gene: Dict[str, List[Dict[str, Any]]] = {}
-    for (phenocode, genename), assoc in best_assoc_for_pheno_gene_pair.items():
+    intervals = intervals_for_chrom[chrom]
+    pos_colidx = matrix_reader.get_colidx("pos")
+    pheno_columns = [
+        (phenocode, matrix_reader.get_colidx("pval", phenocode), [
+            matrix_reader.get_colidx(field, phenocode) for field in matrix_reader.get_fields_for_pheno(phenocode)
+        ])
+        for phenocode in matrix_reader.get_phenocodes()
+    ]
+
+    # best_for_gene is like { '<genename>': { '<phenocode>': (pval, pos, [raw values of the fields of this pheno]) } }
+    best_for_gene: Dict[str, Dict[str, Tuple[float, int, List[str]]]] = {}
+    # the genes in best_for_gene -> their index in `intervals`
+    gene_idx_for_gene: Dict[str, int] = {}
+    batch: List[AssociationRow] = []
+
+    for chunk in boltons.iterutils.chunked_iter(matrix_reader.get_region_rows(chrom, start, end + 1), ROWS_PER_CHUNK):
+        positions = np.array([int(variant_row[pos_colidx]) for variant_row in chunk], dtype=np.int64)
+        best_for_pheno_for_genes_for_row: Dict[int, List[Dict[str, Tuple[float, int, List[str]]]]] = {}
+        for row_idx, gene_idx in zip(*(x.tolist() for x in intervals.get_overlapping(positions))):
+            genename = intervals.data[gene_idx][0]
+            if genename not in best_for_gene:
+                best_for_gene[genename] = {}
+                gene_idx_for_gene[genename] = gene_idx
+            best_for_pheno_for_genes_for_row.setdefault(row_idx, []).append(best_for_gene[genename])
+
+        for row_idx, best_for_pheno_for_genes in best_for_pheno_for_genes_for_row.items():
+            variant_row = chunk[row_idx]
+            pos = int(positions[row_idx])
+            for phenocode, pval_colidx, colidxs in pheno_columns:
+                pval_str = variant_row[pval_colidx]
+                if pval_str == "":
+                    continue
+                pval = float(pval_str)
+                for best_for_pheno in best_for_pheno_for_genes:
+                    best = best_for_pheno.get(phenocode)
+                    if best is None or pval < best[0]:
+                        best_for_pheno[phenocode] = (pval, pos, [variant_row[colidx] for colidx in colidxs])
+
+        # rows are sorted by position, so a gene whose padded range ends at or before the last position can't get more variants
+        last_pos = int(positions[-1])
+        for genename in [g for g, gene_idx in gene_idx_for_gene.items() if intervals.ends[gene_idx] <= last_pos]:
+            batch.extend(finish_gene(matrix_reader, intervals.data[gene_idx_for_gene.pop(genename)], best_for_gene))
+        if len(batch) >= ROWS_PER_BATCH:
+            yield batch
+            batch = []
+
+    for genename, gene_idx in gene_idx_for_gene.items():
+        batch.extend(finish_gene(matrix_reader, intervals.data[gene_idx], best_for_gene))
+    if batch:
+        yield batch
+
+
+def finish_gene(
+    matrix_reader, gene_data: Tuple[str, int, int], best_for_gene: Dict[str, Dict[str, Tuple[float, int, List[str]]]]
+) -> List[AssociationRow]:
+    genename, true_start, true_end = gene_data
+    best_for_pheno = best_for_gene.pop(genename, None)
+    if not best_for_pheno:
+        return []
+    rows = []
+    for phenocode, (pval, pos, values) in best_for_pheno.items():
+        assoc: Dict[str, Any] = {
+            field: parse_utils.reader_for_field[field](value)
+            for field, value in zip(matrix_reader.get_fields_for_pheno(phenocode), values)
+        }
+        assoc.update(matrix_reader.get_info_for_pheno(phenocode))
+        # HX: add info of whether variant is in gene range and how far variant is from a gene
+        assoc["distance_to_true_start"] = pos - true_start
+        assoc["is_in_real_range"] = true_start <= pos <= true_end
         assoc["phenocode"] = phenocode
-        phenos_in_gene.setdefault(genename, []).append(assoc)
-    for genename in phenos_in_gene:
-        phenos_in_gene[genename] = order_and_truncate_phenos(phenos_in_gene[genename])
-    return phenos_in_gene
+        rows.append(make_association_row(genename, assoc))
+    return rows
 
 
 @functools.lru_cache(None)
-def get_gene_intervaltree_for_chrom() -> Dict[str, IntervalTree]:
-    tree_for_chrom = {}
-    for chrom, start, end, genename, true_start, true_end in get_padded_gene_tuples():
-        if chrom not in tree_for_chrom:
-            tree_for_chrom[chrom] = IntervalTree()
-        # Interval from intervaltree can only take 3 args
-        tree_for_chrom[chrom].add(Interval(start, end, (genename, true_start, true_end)))
-    return tree_for_chrom
-
-
-def order_and_truncate_phenos(phenos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    # Decide how many phenotypes to show.
-    #  - Always show all significant phenotypes (with pvalue < 5e-8).
-    #  - Always show the three strongest phenotypes (even if none are significant).
-    #  - Look at the p-values of the 4th to 10th strongest phenotypes to decide how many of them to show.
-    phenos.sort(key=lambda a: a["pval"]) # HX: we get all the phenos instead of the top 3
-    # biggest_idx_to_include = 2 
-    # for idx in range(biggest_idx_to_include, len(phenos)):
-    #     if phenos[idx]["pval"] < 5e-8:
-    #         biggest_idx_to_include = idx
-    #     elif idx < 10 and phenos[idx]["pval"] < 10 ** (
-    #         -4 - idx // 2
-    #     ):  # formula is arbitrary
-    #         biggest_idx_to_include = idx
-    #     else:
-    #         break
-    return phenos
+def get_gene_intervals_for_chrom_with_padding() -> Dict[str, GeneIntervals]:
+    return get_gene_intervals_for_chrom(
+        (chrom, start, end, (genename, true_start, true_end))
+        for chrom, start, end, genename, true_start, true_end in get_padded_gene_tuples()
+    )
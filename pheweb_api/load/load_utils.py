@@ -1,7 +1,8 @@
 from ..utils import round_sig, get_phenolist, PheWebError, fmt_seconds
 from .. import conf
 from .. import parse_utils
-from ..file_utils import get_dated_tmp_path
+from ..file_utils import get_dated_tmp_path, get_generated_path, make_basedir, mkdir_p
+from . import build_manifest
 
 import functools
 import traceback
@@ -9,15 +10,21 @@ import time
 import os
 import subprocess
 import multiprocessing
+import multiprocessing.connection
 import queue
 import random
 import sys
 import heapq
+import pickle
+import tempfile
 from pathlib import Path
 from types import GeneratorType
-from typing import List, Set, Dict, Optional, Any, Callable, Union
+from typing import List, Set, Dict, Optional, Any, Callable, Tuple, Union, NamedTuple
 import re
 
+# results that are at least this big when pickled go from the child to the parent through a file in `tmp/`
+RESULT_FILE_MIN_BYTES = 1024 * 1024
+
 
 def get_maf(variant: Dict[str, Any], pheno: Dict[str, Any]) -> Optional[float]:
     mafs = []
@@ -192,7 +199,14 @@ class MaxPriorityQueue:
 
 class Parallelizer:
     def run_multiple_tasks(
-        self, tasks, do_multiple_tasks, matrix_filepath=None, cmd=None
+        self,
+        tasks,
+        do_multiple_tasks,
+        matrix_filepath=None,
+        cmd=None,
+        on_task_completion=None,
+        get_task_size=None,
+        get_task_memory=None,
     ):
         """
         Make a task queue and a return queue.
@@ -200,17 +214,73 @@ class Parallelizer:
         We manually pass `overrides` down to the child, because otherwise multiprocessing won't pickle it and pass it down.
         Watch for results, exceptions, and task-completion in retq.
         Yields things like: {type:"result", ...}
+        `on_task_completion(task)` is called in this process after all of the results of `task` have been yielded,
+        and after the next task has been handed to the free child.
+
+        Tasks are handed out one at a time, as children become free, largest first by `get_task_size(task)` (eg, the size of its input files),
+        so that a big task doesn't start last and leave the other children idle.
+
+        A task only starts while its estimated memory fits, next to what the running tasks use and are still expected to use.
+        The estimate is `get_task_memory(task)`, or the task's size times the most memory per byte that a completed task used, if that's more.
+        Children report the peak RSS of each task, and this process reads their current RSS from /proc.
+        The budget is MEMORY_BUDGET_GB, which the processes of the whole load share (see `get_load_memory`),
+        or else the memory that the node has available at the moment.
+        A task that doesn't fit even by itself runs alone.
+        The time and memory that each task took are written to `tmp/task-timings/<cmd>.tsv`.
         """
         if not tasks:
             return
         n_procs = min(conf.get_num_procs(cmd), len(tasks))
+        sizes = [get_task_size(task) if get_task_size else 0 for task in tasks]
+        memories = [get_task_memory(task) if get_task_memory else 0 for task in tasks]
+        # sorted() is stable, so tasks without sizes keep their order
+        pending = sorted(range(len(tasks)), key=lambda i: -sizes[i])
+        running: List[int] = []  # the tasks in taskq or in a child
+        started: Dict[int, Tuple[int, int]] = {}  # {task index: (pid of its child, RSS of the child when it started)}
+        memory_budget = conf.get_memory_budget()
+        max_memory_per_byte = 0.0
+        timings: List[Tuple[float, int, Optional[int]]] = []  # [(seconds, task index, peak memory), ...]
+
         taskq = multiprocessing.Queue()
-        for task in tasks:
-            taskq.put(task)
-        for _ in range(n_procs):
-            taskq.put({"exit": True})
         retq = multiprocessing.Queue()
 
+        def estimate_memory(i: int) -> int:
+            return max(memories[i], int(max_memory_per_byte * sizes[i]))
+
+        def get_free_memory() -> Optional[int]:
+            # what the running tasks are expected to use on top of what they use now
+            expected = 0
+            for i in running:
+                growth = 0
+                if i in started:
+                    pid, start_rss = started[i]
+                    growth = max(0, (get_rss(pid) or start_rss) - start_rss)
+                expected += max(0, estimate_memory(i) - growth)
+            if memory_budget is None:
+                available = get_available_memory()
+                return None if available is None else available - expected
+            return memory_budget - (get_load_memory() or 0) - expected
+
+        def start_tasks() -> None:
+            while pending and len(running) < n_procs:
+                free_memory = get_free_memory() if running else None
+                idx = next(
+                    (idx for idx, i in enumerate(pending) if free_memory is None or estimate_memory(i) <= free_memory),
+                    None,
+                )
+                if idx is None:
+                    return
+                i = pending.pop(idx)
+                running.append(i)
+                taskq.put(tasks[i])
+            if not pending and not exits_sent:
+                exits_sent.append(True)
+                for _ in range(n_procs):
+                    taskq.put({"exit": True})
+
+        exits_sent: List[bool] = []
+        start_tasks()
+
         args = (taskq, retq, conf.overrides)
 
         if matrix_filepath is not None:
@@ -224,11 +294,18 @@ class Parallelizer:
             p.start()
         with ProgressBar() as progressbar:
             n_tasks_complete = 0
-            self._update_progressbar(progressbar, n_tasks_complete, n_procs, len(tasks))
+            self._update_progressbar(progressbar, n_tasks_complete, len(running), len(tasks))
             while True:
                 try:
-                    ret = retq.get(block=True, timeout=10)
+                    ret = retq.get(block=True, timeout=1)
                 except queue.Empty:
+                    start_tasks()  # memory may have been freed by other processes
+                    # a child that was killed (eg, for using too much memory) never reports its task, so don't wait for it
+                    for p in procs:
+                        if p.exitcode not in (None, 0):
+                            raise PheWebError(
+                                "A child process exited with status {} while running tasks for {}".format(p.exitcode, cmd)
+                            )
                     if not any(p.is_alive() for p in procs):
                         raise PheWebError(
                             "No living children remain and retq is empty, but n_procs={} and taskq.get_nowait()={!r}".format(
@@ -238,11 +315,24 @@ class Parallelizer:
                     continue
 
                 if ret["type"] == "result":
-                    yield ret
+                    yield {"type": "result", "task": ret["task"], "value": _load_result(ret)}
+                elif ret["type"] == "task-start":
+                    i = next(i for i in running if i not in started and tasks[i] == ret["task"])
+                    if ret["rss"] is not None:
+                        started[i] = (ret["pid"], ret["rss"])
                 elif ret["type"] == "task-completion":
+                    i = next(i for i in running if tasks[i] == ret["task"])
+                    running.remove(i)
+                    started.pop(i, None)
+                    timings.append((ret["seconds"], i, ret["memory"]))
+                    if ret["memory"] is not None and sizes[i] > 0:
+                        max_memory_per_byte = max(max_memory_per_byte, ret["memory"] / sizes[i])
+                    start_tasks()  # before `on_task_completion`, so that the free child doesn't wait for it
+                    if on_task_completion is not None:
+                        on_task_completion(ret["task"])
                     n_tasks_complete += 1
                     self._update_progressbar(
-                        progressbar, n_tasks_complete, n_procs, len(tasks)
+                        progressbar, n_tasks_complete, len(running), len(tasks)
                     )
                 elif ret["type"] == "exception":
                     for p in procs:
@@ -266,13 +356,13 @@ class Parallelizer:
                 elif ret["type"] == "exit":
                     n_procs -= 1
                     self._update_progressbar(
-                        progressbar, n_tasks_complete, n_procs, len(tasks)
+                        progressbar, n_tasks_complete, len(running), len(tasks)
                     )
                     for p in procs:
                         p.is_alive()  # This cleans up zombies
                     if n_procs == 0:
                         self._update_progressbar(
-                            progressbar, n_tasks_complete, n_procs, len(tasks)
+                            progressbar, n_tasks_complete, len(running), len(tasks)
                         )
                         for p in procs:
                             p.join()
@@ -282,17 +372,27 @@ class Parallelizer:
                                         p.exitcode
                                     )
                                 )
-                        return
+                        break
                 else:
                     raise PheWebError("Unknown type of ret: {}".format(ret))
+        self._report_timings(cmd, tasks, sizes, timings)
 
-    def run_single_tasks(self, tasks, do_single_task, cmd=None):
+    def run_single_tasks(
+        self, tasks, do_single_task, cmd=None, on_task_completion=None, get_task_size=None, get_task_memory=None
+    ):
         do_multiple_tasks = self._make_multiple_tasks_doer(do_single_task)
-        for ret in self.run_multiple_tasks(tasks, do_multiple_tasks, cmd=cmd):
+        for ret in self.run_multiple_tasks(
+            tasks,
+            do_multiple_tasks,
+            cmd=cmd,
+            on_task_completion=on_task_completion,
+            get_task_size=get_task_size,
+            get_task_memory=get_task_memory,
+        ):
             yield ret
 
-    def _update_progressbar(self, progressbar, n_tasks_complete, n_procs, num_tasks):
-        if n_procs == 0 and num_tasks == n_tasks_complete:
+    def _update_progressbar(self, progressbar, n_tasks_complete, n_running, num_tasks):
+        if n_running == 0 and num_tasks == n_tasks_complete:
             progressbar.set_message(
                 "Completed {:4} tasks in {}".format(
                     n_tasks_complete, progressbar.fmt_elapsed()
@@ -303,8 +403,24 @@ class Parallelizer:
                 "Completed {:4} tasks in {} ({} currently in progress, {} queued)".format(
                     n_tasks_complete,
                     progressbar.fmt_elapsed(),
-                    n_procs,
-                    num_tasks - n_tasks_complete - n_procs,
+                    n_running,
+                    num_tasks - n_tasks_complete - n_running,
+                )
+            )
+
+    def _report_timings(self, cmd, tasks, sizes, timings):
+        timings.sort(reverse=True)
+        timings_filepath = get_generated_path("tmp", "task-timings", "{}.tsv".format(cmd or "tasks"))
+        make_basedir(timings_filepath)
+        with open(timings_filepath, "w") as f:
+            f.write("seconds\tsize\tpeak_memory\ttask\n")
+            for seconds, i, memory in timings:
+                f.write("{:.2f}\t{}\t{}\t{}\n".format(seconds, sizes[i], "" if memory is None else memory, _describe_task(tasks[i])))
+        if len(timings) > 1:
+            print(
+                "Slowest tasks: {} (all timings are in {})".format(
+                    ", ".join("{} ({})".format(_describe_task(tasks[i]), fmt_seconds(seconds)) for seconds, i, _ in timings[:5]),
+                    timings_filepath,
                 )
             )
 
@@ -336,6 +452,10 @@ class Parallelizer:
         conf.overrides.update(parent_overrides)
         for task in iter(taskq.get, {"exit": True}):
             try:
+                start_time = time.time()
+                _reset_peak_rss()
+                start_rss = get_rss(os.getpid())
+                retq.put({"type": "task-start", "task": task, "pid": os.getpid(), "rss": start_rss})
                 if matrix_filepath is None:
                     x = do_single_task(task)
                 else:
@@ -343,17 +463,13 @@ class Parallelizer:
                 for ret in (
                     x if isinstance(x, GeneratorType) else [x]
                 ):  # if it returns None (rather than a generator), assume it has no results
-                    retq.put(
-                        {
-                            "type": "result",
-                            "task": task,
-                            "value": ret,
-                        }
-                    )
+                    retq.put(_dump_result(task, ret))
                 retq.put(
                     {
                         "type": "task-completion",
                         "task": task,
+                        "seconds": time.time() - start_time,
+                        "memory": _get_task_memory(start_rss),
                     }
                 )
             except (Exception, KeyboardInterrupt) as exc:
@@ -369,6 +485,110 @@ class Parallelizer:
         retq.put({"type": "exit"})
 
 
+def _dump_result(task, value) -> Dict[str, Any]:
+    """Pickles `value` in the child. A big one goes through a file, so that the child doesn't wait on the pipe while the parent is busy."""
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) < RESULT_FILE_MIN_BYTES:
+        return {"type": "result", "task": task, "pickled_value": data}
+    mkdir_p(get_generated_path("tmp"))
+    fd, filepath = tempfile.mkstemp(prefix="result-", dir=get_generated_path("tmp"))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return {"type": "result", "task": task, "value_filepath": filepath}
+
+
+def _load_result(ret: Dict[str, Any]) -> Any:
+    if "pickled_value" in ret:
+        return pickle.loads(ret["pickled_value"])
+    with open(ret["value_filepath"], "rb") as f:
+        value = pickle.load(f)
+    os.remove(ret["value_filepath"])
+    return value
+
+
+def _describe_task(task) -> str:
+    if isinstance(task, dict):
+        for key in ["phenocode", "chrom"]:
+            if key in task:
+                return str(task[key])
+    return repr(task)
+
+
+def get_rss(pid: int) -> Optional[int]:
+    """Returns the resident memory of process `pid` in bytes, or None if it has exited or there is no /proc."""
+    return _read_proc_status(pid, "VmRSS:")
+
+
+def get_load_memory() -> Optional[int]:
+    """
+    Returns the resident memory of the load in bytes, or None where there is no /proc.
+    The load is every task that `run_tasks_in_children()` runs at once (eg, the steps of `pheweb2 process`), with their children,
+    or else this process and its children.
+    """
+    try:
+        pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    children: Dict[int, List[int]] = {}
+    rss: Dict[int, int] = {}
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                stat = f.read()
+        except OSError:
+            continue  # it exited
+        fields = stat[stat.rindex(")") + 2 :].split()  # the command before ")" can hold spaces
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * page_size
+    total = 0
+    pids = [conf.overrides.get("PROCESS_ROOT_PID") or os.getpid()]
+    while pids:
+        pid = pids.pop()
+        total += rss.get(pid, 0)
+        pids.extend(children.get(pid, []))
+    return total
+
+
+def _reset_peak_rss() -> None:
+    """Resets VmHWM of this process to its current RSS, so that it holds the peak of the next task."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass  # then VmHWM is the peak since the process started, which only overestimates
+
+
+def _get_task_memory(start_rss: Optional[int]) -> Optional[int]:
+    peak_rss = _read_proc_status(os.getpid(), "VmHWM:")
+    if peak_rss is None or start_rss is None:
+        return None
+    return max(0, peak_rss - start_rss)
+
+
+def _read_proc_status(pid: int, field: str) -> Optional[int]:
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_available_memory() -> Optional[int]:
+    """Returns MemAvailable from /proc/meminfo in bytes, or None where there is no /proc."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
 class PerPhenoParallelizer(Parallelizer):
     def run_on_each_pheno(
         self,
@@ -378,7 +598,17 @@ class PerPhenoParallelizer(Parallelizer):
         *,
         cmd=None,
         phenos=None,
+        get_config=None,
+        extendable_filepaths=(),
+        get_memory=None,
     ):
+        """
+        Runs `convert(pheno)` for each pheno whose outputs aren't up-to-date in the build manifest, and records each one as it completes.
+        `get_config(pheno)` returns the config that the outputs depend on, so that changing it triggers a rebuild.
+        `extendable_filepaths` are inputs that `convert` only looks up the pheno's own variants in, so that rows added to them don't trigger a rebuild.
+        Phenos start largest-first by the size of their input files, and `get_memory(pheno)` is how many bytes `convert(pheno)` needs.
+        Each child hashes the files of its pheno after `convert(pheno)`, so that recording them in this process only reads the hash cache.
+        """
         if phenos is None:
             phenos = get_phenolist()
 
@@ -386,13 +616,18 @@ class PerPhenoParallelizer(Parallelizer):
             pheno
             for pheno in phenos
             if self.should_process_pheno(
-                pheno, get_input_filepaths, get_output_filepaths
+                pheno,
+                get_input_filepaths,
+                get_output_filepaths,
+                cmd=cmd,
+                get_config=get_config,
+                extendable_filepaths=extendable_filepaths,
             )
         ]
 
         if not tasks:
             print(
-                "Output files are all newer than input files, so there's nothing to do."
+                "Output files are all up-to-date, so there's nothing to do."
             )
             return {}
         if len(phenos) == len(tasks):
@@ -404,7 +639,32 @@ class PerPhenoParallelizer(Parallelizer):
                 )
             )
         pheno_results = {}
-        for ret in self.run_single_tasks(tasks, convert, cmd=cmd):
+
+        def record_pheno(pheno):
+            v = pheno_results.get(pheno["phenocode"])
+            if isinstance(v, dict) and v.get("succeeded") is False:
+                return  # `parse-input-files` reports failures as results
+            output_filepaths = get_output_filepaths(pheno)
+            if isinstance(output_filepaths, str):
+                output_filepaths = [output_filepaths]
+            if all(os.path.exists(fp) for fp in output_filepaths):
+                build_manifest.record(
+                    cmd or "per-pheno",
+                    output_filepaths,
+                    get_input_filepaths(pheno),
+                    get_config(pheno) if get_config else None,
+                )
+
+        def get_size(pheno):
+            input_filepaths = get_input_filepaths(pheno)
+            if isinstance(input_filepaths, str):
+                input_filepaths = [input_filepaths]
+            return sum(os.path.getsize(fp) for fp in input_filepaths)
+
+        convert_and_hash = functools.partial(_convert_and_hash, convert, get_input_filepaths, get_output_filepaths)
+        for ret in self.run_single_tasks(
+            tasks, convert_and_hash, cmd=cmd, on_task_completion=record_pheno, get_task_size=get_size, get_task_memory=get_memory
+        ):
             pc = ret["task"]["phenocode"]
             v = ret["value"]
             if isinstance(v, dict) and v.get("type", "") == "warning":
@@ -413,7 +673,9 @@ class PerPhenoParallelizer(Parallelizer):
             pheno_results[pc] = v
         return pheno_results
 
-    def should_process_pheno(self, pheno, get_input_filepaths, get_output_filepaths):
+    def should_process_pheno(
+        self, pheno, get_input_filepaths, get_output_filepaths, *, cmd=None, get_config=None, extendable_filepaths=()
+    ):
         input_filepaths = get_input_filepaths(pheno)
         output_filepaths = get_output_filepaths(pheno)
         
@@ -429,29 +691,150 @@ class PerPhenoParallelizer(Parallelizer):
                         " or ".join(output_filepaths), fp
                     )
                 )
-                
-        # print(f"""
-        #       DEBUG : should process pheno? (should return false)
-        #       1 : {any(not os.path.exists(fp) for fp in output_filepaths)}
-        #       2 : {max(map(mtime, input_filepaths)) > min(map(mtime, output_filepaths))}
-              
-        #       input_filepaths : {input_filepaths}
-        #       output_filepaths : {output_filepaths}
-        #       """, flush = True)
-    
-        return any(not os.path.exists(fp) for fp in output_filepaths) or max(
-            map(mtime, input_filepaths)
-        ) > min(map(mtime, output_filepaths))
+
+        return not build_manifest.is_up_to_date(
+            cmd or "per-pheno",
+            output_filepaths,
+            input_filepaths,
+            get_config(pheno) if get_config else None,
+            extendable_filepaths,
+        )
+
+
+def _convert_and_hash(convert, get_input_filepaths, get_output_filepaths, pheno):
+    x = convert(pheno)
+    if isinstance(x, GeneratorType):
+        yield from x
+    else:
+        yield x
+    output_filepaths = get_output_filepaths(pheno)
+    if isinstance(output_filepaths, str):
+        output_filepaths = [output_filepaths]
+    if all(os.path.exists(fp) for fp in output_filepaths):
+        build_manifest.hash_files(output_filepaths)
+        build_manifest.hash_files(get_input_filepaths(pheno))
 
 
 def parallelize_per_pheno(
-    get_input_filepaths, get_output_filepaths, convert, *, cmd=None, phenos=None
+    get_input_filepaths,
+    get_output_filepaths,
+    convert,
+    *,
+    cmd=None,
+    phenos=None,
+    get_config=None,
+    extendable_filepaths=(),
+    get_memory=None,
 ):
     return PerPhenoParallelizer().run_on_each_pheno(
-        get_input_filepaths, get_output_filepaths, convert, cmd=cmd, phenos=phenos
+        get_input_filepaths,
+        get_output_filepaths,
+        convert,
+        cmd=cmd,
+        phenos=phenos,
+        get_config=get_config,
+        extendable_filepaths=extendable_filepaths,
+        get_memory=get_memory,
     )
 
 
+class ChildTask(NamedTuple):
+    group: str  # eg, a step or a job, which completes once all of its tasks have
+    name: str  # the name of the task's log file
+    description: str  # for messages, like "`pheweb sites`"
+    target: Callable[..., None]  # runs `target(*args)` in a child process
+    args: Tuple[Any, ...]
+    deps: List[str]  # the groups that must complete before the task starts
+
+
+def run_tasks_in_children(
+    tasks: List[ChildTask],
+    log_dir: str,
+    *,
+    max_running: Optional[int] = None,
+    can_start: Optional[Callable[[ChildTask, List[ChildTask]], bool]] = None,
+    on_start: Optional[Callable[[ChildTask, str], None]] = None,
+    on_completion: Optional[Callable[[ChildTask, float, bool], None]] = None,
+) -> List[ChildTask]:
+    """
+    Runs each task in a child process, once the groups that it depends on have completed, with its output in `<log_dir>/<name>.log`.
+    At most `max_running` tasks run at once, and `can_start(task, running_tasks)` can hold a ready task back.
+    `on_start(task, log_filepath)` and `on_completion(task, seconds, whether its group completed)` are called in this process.
+    After a task fails, the end of its log is printed, and no more tasks start. Returns the tasks that failed.
+    The children share MEMORY_BUDGET_GB, see `get_load_memory()`.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    num_tasks_left: Dict[str, int] = {}
+    for task in tasks:
+        num_tasks_left[task.group] = num_tasks_left.get(task.group, 0) + 1
+    completed: Set[str] = set()
+    waiting = list(tasks)
+    running: Dict[Any, Dict[str, Any]] = {}  # {process.sentinel: {task, process, start_time, log_filepath}}
+    failed: List[ChildTask] = []
+
+    while waiting or running:
+        if not failed:
+            for task in [task for task in waiting if all(dep in completed for dep in task.deps)]:
+                if max_running is not None and len(running) >= max_running:
+                    break
+                if can_start is not None and not can_start(task, [r["task"] for r in running.values()]):
+                    continue
+                log_filepath = os.path.join(log_dir, task.name + ".log")
+                process = multiprocessing.Process(
+                    target=_run_task_in_child, args=(task.target, task.args, conf.overrides, log_filepath)
+                )
+                process.start()
+                running[process.sentinel] = {
+                    "task": task,
+                    "process": process,
+                    "start_time": time.time(),
+                    "log_filepath": log_filepath,
+                }
+                waiting.remove(task)
+                if on_start is not None:
+                    on_start(task, log_filepath)
+        if not running:
+            break  # only after a failure, or if some deps aren't groups of `tasks`
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            r = running.pop(sentinel)
+            r["process"].join()
+            task, seconds = r["task"], time.time() - r["start_time"]
+            if r["process"].exitcode == 0:
+                num_tasks_left[task.group] -= 1
+                if num_tasks_left[task.group] == 0:
+                    completed.add(task.group)
+                if on_completion is not None:
+                    on_completion(task, seconds, task.group in completed)
+            else:
+                failed.append(task)
+                print("==> {} failed after {}. The end of its log:".format(task.description, fmt_seconds(seconds)))
+                with open(r["log_filepath"]) as f:
+                    print(indent_log("".join(f.readlines()[-20:])), flush=True)
+
+    if waiting and not failed:
+        raise PheWebError("Some tasks never became ready: {}".format([task.name for task in waiting]))
+    return failed
+
+
+def _run_task_in_child(target: Callable[..., None], args: Tuple[Any, ...], parent_overrides: Dict[str, Any], log_filepath: str) -> None:
+    conf.overrides.update(parent_overrides)
+    conf.overrides["PROCESS_ROOT_PID"] = os.getppid()  # so that the tasks share MEMORY_BUDGET_GB, see `get_load_memory`
+    with open(log_filepath, "w") as log:
+        # redirect the file descriptors, so that the output of subprocesses goes to the log too
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        try:
+            target(*args)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+
+def indent_log(log: str) -> str:
+    return "\n".join("    | " + line for line in log.rstrip("\n").split("\n"))
+
+
 def get_phenos_subset(pheno_subset_str: str) -> List[Dict[str, Any]]:
     phenos = get_phenolist()
     idxs_to_include = _get_idxs_from_subset_str(pheno_subset_str)
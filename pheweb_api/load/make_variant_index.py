@@ -0,0 +1,43 @@
+from ..file_utils import get_filepath
+from ..models.variant_index import INDEX_FORMAT_VERSION, get_index_dir, build_variant_index
+from . import build_manifest
+
+import os
+from typing import List, Optional
+
+STEP = "make-variant-index"
+
+
+def run(argv: List[str]) -> None:
+    if "-h" in argv or "--help" in argv:
+        print(
+            "Make the memory-mapped variant index (in sites/variant-index/) used for rsid <-> chr-pos-ref-alt, nearest genes and autocomplete."
+        )
+        exit(1)
+
+    sites_filepath = get_filepath("sites")
+    index_dir = get_index_dir(os.path.dirname(sites_filepath))
+
+    num_variants = update_variant_index(sites_filepath, index_dir)
+    if num_variants is None:
+        print("variant index is up-to-date!")
+    else:
+        print("Done making the variant index of {} variants at {}".format(num_variants, index_dir))
+
+
+def is_up_to_date(sites_filepath: str, index_dir: str) -> bool:
+    # A rebuild replaces the whole directory, so `meta.json` stands for all of the arrays.
+    return build_manifest.is_up_to_date(
+        STEP, os.path.join(index_dir, "meta.json"), sites_filepath, config={"format_version": INDEX_FORMAT_VERSION}
+    )
+
+
+def update_variant_index(sites_filepath: str, index_dir: str) -> Optional[int]:
+    """Rebuilds the index if `sites.tsv` changed. Returns the number of variants if it was rebuilt, otherwise None."""
+    if is_up_to_date(sites_filepath, index_dir):
+        return None
+    num_variants = build_variant_index(sites_filepath, index_dir)
+    build_manifest.record(
+        STEP, os.path.join(index_dir, "meta.json"), sites_filepath, config={"format_version": INDEX_FORMAT_VERSION}
+    )
+    return num_variants
@@ -64,6 +64,7 @@ def run(argv: List[str]) -> None:
         convert=make_manhattan_json_file,
         cmd="manhattan",
         phenos=non_interaction_phenos,
+        get_config=get_config,
     )
 
     parallelize_per_pheno(
@@ -72,9 +73,20 @@ def run(argv: List[str]) -> None:
         convert=make_manhattan_json_file,
         cmd="manhattan",
         phenos=interaction_phenos,
+        get_config=get_config,
     )
 
 
+def get_config(pheno: dict) -> Dict[str, Any]:
+    return {
+        "manhattan_peak_pval_threshold": conf.get_manhattan_peak_pval_threshold(),
+        "manhattan_peak_variant_counting_pval_threshold": conf.get_manhattan_peak_variant_counting_pval_threshold(),
+        "manhattan_peak_sprawl_dist": conf.get_manhattan_peak_sprawl_dist(),
+        "manhattan_peak_max_count": conf.get_manhattan_peak_max_count(),
+        "manhattan_num_unbinned": conf.get_manhattan_num_unbinned(),
+    }
+
+
 def get_input_filepaths(pheno: dict) -> List[str]:
     # make sure cluster can handle interaction files
     if pheno.get("interaction") is not None:
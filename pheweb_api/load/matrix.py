@@ -1,29 +1,37 @@
-# TODO: Parallelize by chromosome.
-#  Spawn a pheweb process to do each chromosome.  Each one must do:
-#  + For every `pheno_gz/*.gz` and `sites/sites.tsv`, find the byte offset to the block that begins our chromosome.
-#  + Now cffi down into a function just like our normal one, but which starts at that offset, discards variants until it hits the target chromosome, merges, and then exits.
-#  + Don't append an empty block in `BgzipWriter:close()`.
-#  When all the child processes are done, the main thread needs to concatenate all the single-chrom matrix files and then append an empty bgzip block to signal EOF.
+"""
+Makes one matrix with every phenotype's associations for each variant in the sites (or one per stratification).
 
+`pheweb2 cluster` splits this into one job per chromosome (`--chrom`), each of which gives the C++ the chromosome's rows of the
+sites and of each pheno_gz file, and a final `--concat-chroms`, which concatenates the chromosomes.
+Concatenated BGZF files are a valid BGZF file, so the chromosomes are copied without recompressing them.
+"""
 
 from ..utils import (
     get_phenolist_no_interaction,
     PheWebError,
     get_stratification_paths,
     get_phenocode_with_suffixes,
+    chrom_order,
+    chrom_order_list,
 )
-from ..file_utils import MatrixReader, get_tmp_path, get_filepath, get_pheno_filepath
-from .load_utils import mtime, get_phenos_subset
+from ..file_utils import get_tmp_path, get_filepath, get_pheno_filepath, read_maybe_gzip, get_generated_path
+from .load_utils import get_phenos_subset
+from . import build_manifest
 from .cffi._x import ffi, lib
 from .. import conf
 
 import os
 import glob
+import shutil
+import contextlib
 import pysam
 import argparse
 from typing import List
 from ordered_set import OrderedSet
 
+# lines are written to BGZF files this many at a time
+LINES_PER_WRITE = 10_000
+
 
 def clear_out_junk() -> None:
     # Remove files that shouldn't be there (and will confuse the glob in matrixify)
@@ -39,51 +47,13 @@ def clear_out_junk() -> None:
         name = os.path.basename(filepath)
         if name[:-3] not in cur_phenocodes:
             print("Removing {} to help matrix glob".format(filepath))
-            os.remove(filepath)
-
-
-def should_run(matrix_gz_filepath) -> bool:
-    sites_filepath = get_filepath("sites")
+            with contextlib.suppress(FileNotFoundError):  # `matrix --chrom` runs for each chromosome at once
+                os.remove(filepath)
 
-    if not os.path.exists(matrix_gz_filepath):
-        return True
-
-    # If the matrix's columns don't match the phenos in pheno-list, rebuild.
-    cur_phenocodes = set(pheno["phenocode"] for pheno in get_phenolist_no_interaction())
-
-    if conf.has_stratifications():
-        cur_phenocodes = OrderedSet(
-            get_phenocode_with_suffixes(pheno)
-            for pheno in get_phenolist_no_interaction()
-        )
 
-    if not conf.has_stratifications():
-        try:
-            matrix_phenocodes = set(MatrixReader().get_phenocodes())
-        except Exception:
-            return True  # if something broke, let's just rebuild the matrix.
-        if matrix_phenocodes != cur_phenocodes:
-            print("re-running because cur matrix has wrong phenos.")
-            print(
-                "- phenos in pheno-list.json but not matrix.tsv.gz:",
-                ", ".join(repr(p) for p in cur_phenocodes - matrix_phenocodes),
-            )
-            print(
-                "- phenos in matrix.tsv.gz but not pheno-list.json:",
-                ", ".join(repr(p) for p in matrix_phenocodes - cur_phenocodes),
-            )
-            return True
-
-    # If pheno_gz or sites.tsv are newer than matrix, rebuild.
-    infilepaths = [
-        get_pheno_filepath("pheno_gz", phenocode) for phenocode in cur_phenocodes
-    ] + [sites_filepath]
-    infile_modtime = max(mtime(filepath) for filepath in infilepaths)
-    if infile_modtime > mtime(matrix_gz_filepath):
-        print("rerunning because some input files are newer than matrix.tsv.gz")
-        return True
-
-    return False
+def should_run(matrix_gz_filepath: str, input_filepaths: List[str]) -> bool:
+    # The manifest records which pheno_gz files the matrix was made from, so adding or removing a phenotype makes it stale.
+    return not build_manifest.is_up_to_date("matrix", matrix_gz_filepath, input_filepaths)
 
 
 def run(argv: List[str]) -> None:
@@ -98,6 +68,16 @@ def run(argv: List[str]) -> None:
         "--phenos",
         help="Can be like '4,5,6,12' or '4-6,12' to run on only the phenos at those positions (0-indexed) in pheno-list.json (and only if they need to run)",
     )
+    parser.add_argument(
+        "--chrom",
+        choices=chrom_order_list,
+        help="Only make the part of each matrix on this chromosome, for `pheweb2 cluster` (and only if the matrix isn't up-to-date)",
+    )
+    parser.add_argument(
+        "--concat-chroms",
+        action="store_true",
+        help="Make each matrix from the parts that `--chrom` made for every chromosome",
+    )
     args = parser.parse_args(argv)
 
     phenos = (
@@ -106,14 +86,19 @@ def run(argv: List[str]) -> None:
         else get_phenolist_no_interaction()
     )
     if conf.has_stratifications():
-        for stratification_path in set(get_stratification_paths(phenos)):
-            matrix_gz_stratified_filepath = get_pheno_filepath(
-                "matrix-stratified", stratification_path, must_exist=False
-            )
-            run_matrix_functions(matrix_gz_stratified_filepath, stratification_path)
+        matrices = [
+            (get_pheno_filepath("matrix-stratified", stratification_path, must_exist=False), stratification_path)
+            for stratification_path in sorted(set(get_stratification_paths(phenos)))
+        ]
     else:
-        matrix_gz_filepath = get_filepath("matrix", must_exist=False)
-        run_matrix_functions(matrix_gz_filepath)
+        matrices = [(get_filepath("matrix", must_exist=False), None)]
+    for matrix_gz_filepath, stratification in matrices:
+        if args.chrom:
+            make_chrom_part(matrix_gz_filepath, stratification, args.chrom)
+        elif args.concat_chroms:
+            concat_chrom_parts(matrix_gz_filepath, stratification)
+        else:
+            run_matrix_functions(matrix_gz_filepath, stratification)
 
 
 def create_matrix(
@@ -134,11 +119,127 @@ def create_matrix(
     os.rename(matrix_gz_tmp_filepath, matrix_gz_filepath)
 
 
+def append_to_matrix(
+    matrix_gz_filepath, sites_filepath, pheno_gz_filepaths, matrix_gz_tmp_filepath
+):
+    """
+    Writes what `create_matrix()` would for the phenos already in the matrix and `pheno_gz_filepaths`, but reads the
+    previous matrix instead of the pheno_gz files that it was made from.
+    This requires the sites to be an extension of the ones that the matrix was made from.
+    Like in `create_matrix()`, the columns of each pheno are together, and the phenos are sorted by phenocode.
+    """
+    phenocodes = [
+        os.path.basename(filepath)[: -len(".gz")] for filepath in pheno_gz_filepaths
+    ]
+    with contextlib.ExitStack() as exit_stack:
+        sites_f = exit_stack.enter_context(read_maybe_gzip(sites_filepath))
+        matrix_f = exit_stack.enter_context(read_maybe_gzip(matrix_gz_filepath))
+        pheno_fs = [
+            exit_stack.enter_context(read_maybe_gzip(filepath))
+            for filepath in pheno_gz_filepaths
+        ]
+        out_f = exit_stack.enter_context(pysam.BGZFile(matrix_gz_tmp_filepath, "wb"))
+
+        sites_header = next(sites_f).rstrip("\r\n")
+        matrix_header = next(matrix_f).rstrip("\r\n")
+        if not matrix_header.startswith("#" + sites_header):
+            raise PheWebError(
+                "The header of {} doesn't begin with the header of {}".format(
+                    matrix_gz_filepath, sites_filepath
+                )
+            )
+        old_fields = matrix_header[len(sites_header) + 2 :].split("\t") if len(matrix_header) > len(sites_header) + 1 else []
+        num_old_fields = len(old_fields)
+        # columns are like [(phenocode, True, start, stop), ...] for the fields of the previous matrix, and [(phenocode, False, i, None)] for a new pheno
+        columns = []
+        for j, field in enumerate(old_fields):
+            phenocode = field.rsplit("@", 1)[-1]
+            if columns and columns[-1][0] == phenocode:
+                columns[-1] = (phenocode, True, columns[-1][2], j + 1)
+            else:
+                columns.append((phenocode, True, j, j + 1))
+        header_fields = {phenocode: old_fields[start:stop] for phenocode, _, start, stop in columns}
+        num_pheno_fields = []
+        for i, (phenocode, pheno_f, filepath) in enumerate(zip(phenocodes, pheno_fs, pheno_gz_filepaths)):
+            pheno_header = next(pheno_f).rstrip("\r\n")
+            if not pheno_header.startswith(sites_header):
+                raise PheWebError(
+                    "The header of {} doesn't begin with the header of {}".format(
+                        filepath, sites_filepath
+                    )
+                )
+            fields = pheno_header[len(sites_header) + 1 :].split("\t") if len(pheno_header) > len(sites_header) else []
+            header_fields[phenocode] = ["{}@{}".format(field, phenocode) for field in fields]
+            num_pheno_fields.append(len(fields))
+            columns.append((phenocode, False, i, None))
+        if len(header_fields) != len(columns):
+            raise PheWebError("The matrix {} already has some of the phenos in {}".format(matrix_gz_filepath, pheno_gz_filepaths))
+        columns.sort(key=lambda column: column[0])
+
+        lines = ["#" + "\t".join([sites_header] + [field for column in columns for field in header_fields[column[0]]]) + "\n"]
+        # every pheno is a subsequence of the sites, and so is the previous matrix, because the sites only gained variants
+        matrix_line = next(matrix_f, None)
+        pheno_lines = [next(pheno_f, None) for pheno_f in pheno_fs]
+        for sites_line in sites_f:
+            sites_line = sites_line.rstrip("\r\n")
+            cpra_prefix = "\t".join(sites_line.split("\t", 4)[:4]) + "\t"
+            if matrix_line is not None and matrix_line.startswith(cpra_prefix):
+                matrix_line = matrix_line.rstrip("\r\n")
+                if not matrix_line.startswith(sites_line):
+                    raise PheWebError(
+                        "The matrix {} has different information than the sites for the variant {!r}".format(
+                            matrix_gz_filepath, sites_line
+                        )
+                    )
+                old_values = matrix_line[len(sites_line) + 1 :].split("\t") if num_old_fields else []
+                matrix_line = next(matrix_f, None)
+            else:
+                old_values = [""] * num_old_fields
+            new_parts = []
+            for i, pheno_line in enumerate(pheno_lines):
+                if pheno_line is not None and pheno_line.startswith(cpra_prefix):
+                    pheno_line = pheno_line.rstrip("\r\n")
+                    if not pheno_line.startswith(sites_line) or pheno_line.count("\t") != sites_line.count("\t") + num_pheno_fields[i]:
+                        raise PheWebError(
+                            "The pheno file {} doesn't match the sites for the variant {!r}".format(
+                                pheno_gz_filepaths[i], sites_line
+                            )
+                        )
+                    new_parts.append(pheno_line[len(sites_line) :])
+                    pheno_lines[i] = next(pheno_fs[i], None)
+                else:
+                    new_parts.append("\t" * num_pheno_fields[i])
+            parts = [sites_line]
+            for _, is_old, start, stop in columns:
+                if is_old:
+                    parts.extend("\t" + value for value in old_values[start:stop])
+                else:
+                    parts.append(new_parts[start])
+            lines.append("".join(parts) + "\n")
+            if len(lines) >= LINES_PER_WRITE:
+                out_f.write("".join(lines).encode())
+                lines = []
+        out_f.write("".join(lines).encode())
+
+        if matrix_line is not None:
+            raise PheWebError(
+                "The matrix {} has variants that aren't in the sites, like {!r}".format(
+                    matrix_gz_filepath, matrix_line
+                )
+            )
+        for filepath, pheno_line in zip(pheno_gz_filepaths, pheno_lines):
+            if pheno_line is not None:
+                raise PheWebError(
+                    "The pheno file {} has variants that aren't in the sites, like {!r}".format(
+                        filepath, pheno_line
+                    )
+                )
+    os.rename(matrix_gz_tmp_filepath, matrix_gz_filepath)
+
+
 def create_matrix_tbi(matrix_gz_filepath):
     matrix_tbi_filepath = matrix_gz_filepath + ".tbi"
-    if not os.path.exists(matrix_tbi_filepath) or mtime(matrix_tbi_filepath) < mtime(
-        matrix_gz_filepath
-    ):
+    if not build_manifest.is_up_to_date("matrix", matrix_tbi_filepath, matrix_gz_filepath):
         print("tabixing matrix")
         pysam.tabix_index(
             filename=matrix_gz_filepath,
@@ -147,25 +248,159 @@ def create_matrix_tbi(matrix_gz_filepath):
             start_col=1,
             end_col=1,  # note: column indexes start at 0, whereas `/usr/bin/tabix` starts at 1
         )
+        build_manifest.record("matrix", matrix_tbi_filepath, matrix_gz_filepath)
     else:
         print("matrix.tbi is up-to-date!")
 
 
+def get_pheno_gz_glob(stratification: str = None) -> str:
+    return get_filepath("pheno_gz") + (
+        "/*.gz" if stratification is None else "/*" + stratification + "*.gz"
+    )
+
+
+def get_input_filepaths(pheno_gz_glob: str) -> List[str]:
+    return sorted(glob.glob(pheno_gz_glob)) + [get_filepath("sites")]
+
+
+def get_chrom_parts_dir(matrix_gz_filepath: str) -> str:
+    return get_generated_path("tmp", "matrix-chroms", os.path.basename(matrix_gz_filepath))
+
+
+def make_chrom_part(matrix_gz_filepath: str, stratification: str, chrom: str) -> None:
+    """
+    Writes the rows of the matrix on `chrom`, without the header, to `<chrom>.gz` in `get_chrom_parts_dir()`, and the header to `<chrom>.header`.
+    The C++ reads plain text too, so the rows of the sites and of each pheno_gz file on `chrom` are extracted without compressing them.
+    """
+    clear_out_junk()
+    pheno_gz_glob = get_pheno_gz_glob(stratification)
+    if not should_run(matrix_gz_filepath, get_input_filepaths(pheno_gz_glob)):
+        print("{} is up-to-date!".format(matrix_gz_filepath))
+        return
+    parts_dir = get_chrom_parts_dir(matrix_gz_filepath)
+    inputs_dir = os.path.join(parts_dir, chrom + "-inputs")
+    shutil.rmtree(inputs_dir, ignore_errors=True)
+    os.makedirs(inputs_dir)
+    try:
+        sites_filepath = os.path.join(inputs_dir, "sites.tsv")
+        num_sites = 0
+        with read_maybe_gzip(get_filepath("sites")) as in_f, open(sites_filepath, "w") as out_f:
+            out_f.write(next(in_f))
+            # the sites are sorted by chromosome, so stop after `chrom`
+            for line in in_f:
+                line_chrom_idx = chrom_order[line.split("\t", 1)[0]]
+                if line_chrom_idx == chrom_order[chrom]:
+                    out_f.write(line)
+                    num_sites += 1
+                elif line_chrom_idx > chrom_order[chrom]:
+                    break
+        part_filepath = os.path.join(parts_dir, chrom + ".gz")
+        part_tmp_filepath = get_tmp_path(part_filepath)
+        if num_sites == 0:
+            # the C++ writes a blank row for empty sites, so write an empty part, without a header
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(parts_dir, chrom + ".header"))  # from a run when `chrom` had variants
+            with pysam.BGZFile(part_tmp_filepath, "wb"):
+                pass
+            os.rename(part_tmp_filepath, part_filepath)
+            print("There are no variants on chromosome {}".format(chrom))
+            return
+        pheno_gz_dir = os.path.join(inputs_dir, "pheno_gz")
+        os.makedirs(pheno_gz_dir)
+        # the same names as in pheno_gz/, because the C++ names the columns after them
+        for filepath in glob.glob(pheno_gz_glob):
+            with read_maybe_gzip(filepath) as in_f, open(os.path.join(pheno_gz_dir, os.path.basename(filepath)), "w") as out_f:
+                out_f.write(next(in_f))
+                with pysam.TabixFile(filepath) as tabix_file:
+                    if chrom in tabix_file.contigs:
+                        for line in tabix_file.fetch(chrom):
+                            out_f.write(line + "\n")
+
+        part_with_header_filepath = os.path.join(inputs_dir, "matrix.tsv.gz")
+        create_matrix(
+            sites_filepath,
+            os.path.join(pheno_gz_dir, os.path.basename(pheno_gz_glob)),
+            get_tmp_path(part_with_header_filepath),
+            part_with_header_filepath,
+        )
+        with read_maybe_gzip(part_with_header_filepath) as in_f, pysam.BGZFile(part_tmp_filepath, "wb") as out_f:
+            header = next(in_f)
+            lines = []
+            for line in in_f:
+                lines.append(line)
+                if len(lines) >= LINES_PER_WRITE:
+                    out_f.write("".join(lines).encode())
+                    lines = []
+            out_f.write("".join(lines).encode())
+        with open(os.path.join(parts_dir, chrom + ".header"), "w") as f:
+            f.write(header)
+        os.rename(part_tmp_filepath, part_filepath)
+    finally:
+        shutil.rmtree(inputs_dir, ignore_errors=True)
+    print("Made the part of {} on chromosome {}".format(matrix_gz_filepath, chrom))
+
+
+def concat_chrom_parts(matrix_gz_filepath: str, stratification: str = None) -> None:
+    clear_out_junk()
+    input_filepaths = get_input_filepaths(get_pheno_gz_glob(stratification))
+    if should_run(matrix_gz_filepath, input_filepaths):
+        parts_dir = get_chrom_parts_dir(matrix_gz_filepath)
+        missing_chroms = [chrom for chrom in chrom_order_list if not os.path.exists(os.path.join(parts_dir, chrom + ".gz"))]
+        if missing_chroms:
+            raise PheWebError(
+                "Run `pheweb2 matrix --chrom <chrom>` for chromosomes {} first".format(", ".join(missing_chroms))
+            )
+        headers = set()
+        for chrom in chrom_order_list:
+            header_filepath = os.path.join(parts_dir, chrom + ".header")
+            if os.path.exists(header_filepath):  # the parts of chromosomes without variants don't have one
+                with open(header_filepath) as f:
+                    headers.add(f.read())
+        if not headers:
+            raise PheWebError("None of the parts of {} in {} has any variants".format(matrix_gz_filepath, parts_dir))
+        if len(headers) != 1:
+            raise PheWebError("The parts of {} in {} have different headers".format(matrix_gz_filepath, parts_dir))
+        matrix_gz_tmp_filepath = get_tmp_path(matrix_gz_filepath)
+        with pysam.BGZFile(matrix_gz_tmp_filepath, "wb") as out_f:
+            out_f.write(headers.pop().encode())
+        with open(matrix_gz_tmp_filepath, "ab") as out_f:
+            for chrom in chrom_order_list:
+                with open(os.path.join(parts_dir, chrom + ".gz"), "rb") as part_f:
+                    shutil.copyfileobj(part_f, out_f)
+        os.rename(matrix_gz_tmp_filepath, matrix_gz_filepath)
+        build_manifest.record("matrix", matrix_gz_filepath, input_filepaths)
+        shutil.rmtree(parts_dir)
+    else:
+        print("matrix is up-to-date!")
+
+    create_matrix_tbi(matrix_gz_filepath)
+
+
 def run_matrix_functions(
     matrix_gz_filepath: str,
     stratification: str = None,
 ) -> None:
-    if should_run(matrix_gz_filepath):
-        clear_out_junk()
+    clear_out_junk()
+    sites_filepath = get_filepath("sites")
+    pheno_gz_glob = get_pheno_gz_glob(stratification)
+    input_filepaths = get_input_filepaths(pheno_gz_glob)
 
-        sites_filepath = get_filepath("sites")
-        pheno_gz_glob = get_filepath("pheno_gz") + "/*" + stratification + "*.gz"
+    if should_run(matrix_gz_filepath, input_filepaths):
         matrix_gz_tmp_filepath = get_tmp_path(matrix_gz_filepath)
-
-        create_matrix(
-            sites_filepath, pheno_gz_glob, matrix_gz_tmp_filepath, matrix_gz_filepath
-        )
-
+        # If phenos were only added, the previous matrix can be reused instead of the pheno_gz files that it was made from.
+        changes = build_manifest.get_changes(matrix_gz_filepath, input_filepaths)
+        if changes is not None and not (changes["changed"] or changes["removed"]):
+            print(
+                "adding {} phenos to the existing matrix".format(len(changes["added"]))
+            )
+            append_to_matrix(
+                matrix_gz_filepath, sites_filepath, changes["added"], matrix_gz_tmp_filepath
+            )
+        else:
+            create_matrix(
+                sites_filepath, pheno_gz_glob, matrix_gz_tmp_filepath, matrix_gz_filepath
+            )
+        build_manifest.record("matrix", matrix_gz_filepath, input_filepaths)
     else:
         print("matrix is up-to-date!")
 
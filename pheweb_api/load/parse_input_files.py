@@ -41,6 +41,7 @@ def run(argv: List[str]) -> None:
         convert=convert,
         cmd="parse-input-files",
         phenos=phenos,
+        get_config=get_config,
     )
 
     failed_results = {
@@ -106,6 +107,20 @@ def get_output_filepaths(pheno: dict) -> List[str]:
     return [get_pheno_filepath("parsed", pheno["phenocode"], must_exist=False)]
 
 
+def get_config(pheno: dict) -> Dict[str, Any]:
+    return {
+        "pheno": pheno,
+        "assoc_min_maf": conf.get_assoc_min_maf(),
+        "field_aliases": conf.get_field_aliases(),
+        "min_imp_quality": conf.get_min_imp_quality(),
+        "assoc_test_name": conf.get_assoc_test_name(),
+        "interaction_test_name": conf.get_interaction_test_name(),
+        "interaction_min_maf": conf.get_interaction_min_maf(),
+        "interaction_min_mac": conf.get_interaction_min_mac(),
+        "debugging_limit_num_variants": conf.get_debugging_limit_num_variants(),
+    }
+
+
 def write_failures(filepath: str, failed_results: Dict[str, Any]):
     with open(filepath, "w") as f:
         for phenocode, d in failed_results.items():
@@ -6,9 +6,9 @@ from ..file_utils import (
     get_pheno_filepath,
     write_heterogenous_variantfile,
 )
+from . import build_manifest
 
 import json
-from pathlib import Path
 from typing import Iterator, Dict, Any, List
 
 
@@ -108,26 +108,21 @@ def get_phenotypes_including_top_variants_stratified() -> Iterator[Dict[str, Any
         yield ret
 
 
-def should_run() -> bool:
-    output_filepaths = [
-        Path(get_filepath(name, must_exist=False))
-        for name in ["phenotypes_summary", "phenotypes_summary_tsv"]
-    ]
-    if not all(fp.exists() for fp in output_filepaths):
-        return True
-    oldest_output_mtime = min(fp.stat().st_mtime for fp in output_filepaths)
-
-    input_filepaths = []
+def get_input_filepaths() -> List[str]:
+    # pheno-list.json too, because the summary copies fields like `num_samples` and `phenostring` from it
+    filepaths = [get_filepath("phenolist")]
     for pheno in get_phenolist():
-        phenocode = pheno["phenocode"]
-        for strats in pheno["stratification"]:
-            phenocode = phenocode + "." + pheno["stratification"][strats]
-        input_filepaths.append(Path(get_pheno_filepath("manhattan", phenocode)))
-
-    newest_input_mtime = max(fp.stat().st_mtime for fp in input_filepaths)
-    if newest_input_mtime > oldest_output_mtime:
-        return True
-    return False
+        if conf.has_stratifications():
+            phenocode = pheno["phenocode"]
+            if pheno["interaction"]:
+                phenocode = phenocode + ".interaction-" + pheno["interaction"]
+            for strats in pheno["stratification"]:
+                phenocode = phenocode + "." + pheno["stratification"][strats]
+            filepaths.append(get_pheno_filepath("manhattan", phenocode))
+        else:
+            filepaths.append(get_pheno_filepath("qq", pheno["phenocode"]))
+            filepaths.append(get_pheno_filepath("manhattan", pheno["phenocode"]))
+    return filepaths
 
 
 def run(argv: List[str]) -> None:
@@ -137,7 +132,12 @@ def run(argv: List[str]) -> None:
         )
         exit(1)
 
-    if not should_run():
+    output_filepaths = [
+        get_filepath("phenotypes_summary", must_exist=False),
+        get_filepath("phenotypes_summary_tsv", must_exist=False),
+    ]
+    input_filepaths = get_input_filepaths()
+    if build_manifest.is_up_to_date("phenotypes", output_filepaths, input_filepaths):
         print("Already up-to-date!")
         return
 
@@ -148,10 +148,11 @@ def run(argv: List[str]) -> None:
     else:
         data = sorted(get_phenotypes_including_top_variants(), key=lambda p: p["pval"])
 
-    out_filepath = get_filepath("phenotypes_summary", must_exist=False)
+    out_filepath, out_filepath_tsv = output_filepaths
     write_json(filepath=out_filepath, data=data)
     print("wrote {} phenotypes to {}".format(len(data), out_filepath))
 
-    out_filepath_tsv = get_filepath("phenotypes_summary_tsv", must_exist=False)
     write_heterogenous_variantfile(out_filepath_tsv, data, use_gzip=False)
     print("wrote {} phenotypes to {}".format(len(data), out_filepath_tsv))
+
+    build_manifest.record("phenotypes", output_filepaths, input_filepaths)
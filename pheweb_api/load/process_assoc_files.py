@@ -1,75 +1,178 @@
 # TODO: color lines with ==> using `colorama`
 # TODO: add a step to verify that the genome build is correct using detect_ref (once on first 10k of each input file, and again on `sites`)
 
-from ..utils import fmt_seconds
+"""
+Runs every loading step, each one as soon as the steps it depends on have completed.
 
-import time
+Steps that are ready at the same time run concurrently, in child processes.
+A step that uses a `Parallelizer` gets all `NUM_PROCS` processes, so that a long step (eg, `matrix`) uses every core once the steps
+next to it have completed, instead of keeping the share it started with. While steps overlap, the cores are oversubscribed instead.
+What limits the steps that run at once is:
+- `PROCESS_MAX_IO_STEPS` steps that read or write every variant, so that they don't fight over the disk.
+- the memory that their tasks need. Each `Parallelizer` starts a task only if it fits in what the node has available,
+  or in `MEMORY_BUDGET_GB` minus what every step uses, so the steps share one budget.
+The output of each step goes to its own log file in `tmp/process-logs/`.
+
+Completed steps are recorded in a checkpoint. After a failure, `pheweb2 process --resume` skips them.
+The step that failed reruns, and like any run of a per-phenotype step, it skips the phenotypes whose outputs are up-to-date.
+
+After phenotypes are only added to pheno-list.json, the steps update their previous outputs: `sites` merges in just the new phenotypes,
+`add-rsids` only looks up the new variants, `augment-phenos` only runs on the new phenotypes, and `matrix` adds their columns to the previous matrix.
+"""
+
+from ..utils import fmt_seconds, PheWebError
+from .. import conf
+from ..file_utils import get_filepath, get_generated_path, write_json
+from .load_utils import ChildTask, run_tasks_in_children
+
+import os
+import json
 import importlib
-from typing import List
-
-scripts = """
-phenolist verify
-parse_input_files
-sites
-make_gene_aliases_sqlite3
-add_rsids
-add_genes
-make_cpras_rsids_sqlite3
-augment_phenos
-matrix
-gather_pvalues_for_each_gene
-manhattan
-top_hits
-qq
-phenotypes
-best_of_pheno
-pheno_correlation
-generate_autocomplete_db
-""".split("\n")
-scripts = [script for script in scripts if script]
+from typing import List, Dict, Any, NamedTuple
+
+
+class Step(NamedTuple):
+    script: str
+    deps: List[str]
+    parallel: bool = False  # runs its tasks with a `Parallelizer`
+    io: bool = False  # reads or writes every variant
+
+
+steps = [
+    Step("phenolist verify", []),
+    Step("parse_input_files", ["phenolist verify"], parallel=True, io=True),
+    Step("sites", ["parse_input_files"], parallel=True, io=True),
+    Step("make_gene_aliases_sqlite3", ["phenolist verify"]),  # downloads genes, which `add_genes` needs too
+    Step("add_rsids", ["sites"], parallel=True, io=True),
+    Step("add_genes", ["add_rsids", "make_gene_aliases_sqlite3"], io=True),
+    Step("make_variant_index", ["add_genes"]),
+    Step("augment_phenos", ["make_variant_index"], parallel=True, io=True),
+    Step("matrix", ["augment_phenos"], parallel=True, io=True),
+    Step("gather_pvalues_for_each_gene", ["matrix"], parallel=True, io=True),
+    Step("manhattan", ["augment_phenos"], parallel=True),
+    Step("top_hits", ["manhattan"]),
+    Step("qq", ["augment_phenos"], parallel=True),
+    Step("phenotypes", ["top_hits", "qq"]),
+    Step("best_of_pheno", ["augment_phenos"], parallel=True),
+    Step("pheno_correlation", ["phenolist verify"]),
+    Step("generate_autocomplete_db", ["make_variant_index", "gather_pvalues_for_each_gene", "phenotypes"]),
+]
+scripts = [step.script for step in steps]
 
 
 def run(argv: List[str]) -> None:
-    if any(arg in ["-h", "--help"] for arg in argv):
+    if any(arg in ["-h", "--help"] for arg in argv) or set(argv) - {"--no-parse", "--resume"}:
         print(
             "Run all the steps to go from a prepared phenolist to a ready-to-serve pheweb."
         )
-        print("This is equivalent to running:\n")
-        print(
-            " &&\n".join(
-                "    pheweb {}".format(script.replace("_", "-")) for script in scripts
+        print("This runs these steps, each one once the steps it depends on have completed:\n")
+        for step in steps:
+            print(
+                "    pheweb {}{}".format(
+                    step.script.replace("_", "-"),
+                    "  (after {})".format(", ".join(dep.replace("_", "-") for dep in step.deps)) if step.deps else "",
+                )
             )
-        )
         print("")
         print(
             "Passing `--no-parse` will skip `pheweb parse-input-files` (so it won't error if input filepaths are missing)"
         )
+        print(
+            "Passing `--resume` will skip the steps that completed in the previous run, eg after fixing the cause of a failure"
+        )
         exit(1)
 
-    if argv == ["--no-parse"]:
-        myscripts = [s for s in scripts if s != "parse_input_files"]
-    else:
-        myscripts = scripts
-
-    for script in myscripts:
-        print("==> Starting `pheweb {}`".format(script.replace("_", "-")))
-        start_time = time.time()
-        script_parts = script.split()
-        module = importlib.import_module(".{}".format(script_parts[0]), __package__)
-        module_run = getattr(module, "run", None)  # appeases mypy
-        if not callable(module_run):
-            raise Exception(
-                "module.run ({!r}) isn't callable for module {!r} for script {!r}".format(
-                    module_run, module, script
-                )
+    mysteps = steps
+    if "--no-parse" in argv:
+        mysteps = remove_step(mysteps, "parse_input_files")
+
+    checkpoint_filepath = get_filepath("process-checkpoint", must_exist=False)
+    checkpoint: Dict[str, Any] = {"completed": {}}
+    if "--resume" in argv and os.path.exists(checkpoint_filepath):
+        with open(checkpoint_filepath) as f:
+            checkpoint = json.load(f)
+    run_steps(mysteps, checkpoint, checkpoint_filepath)
+
+
+def remove_step(steps: List[Step], script: str) -> List[Step]:
+    """Removes a step, and makes the steps that depended on it depend on its dependencies instead."""
+    removed = next(step for step in steps if step.script == script)
+    return [
+        step._replace(
+            deps=[dep for dep in step.deps if dep != script]
+            + (removed.deps if script in step.deps else [])
+        )
+        for step in steps
+        if step.script != script
+    ]
+
+
+def run_steps(steps: List[Step], checkpoint: Dict[str, Any], checkpoint_filepath: str) -> None:
+    num_procs = conf.get_num_procs()
+    max_io_steps = conf.get_process_max_io_steps()
+
+    completed = {step.script for step in steps if step.script in checkpoint["completed"]}
+    for step in steps:
+        if step.script in completed:
+            print("==> Skipping `pheweb {}`, which completed in the previous run".format(step.script.replace("_", "-")))
+    steps_by_script = {step.script: step for step in steps}
+    tasks = [
+        ChildTask(
+            group=step.script,
+            name=step.script.replace(" ", "-"),
+            description="`pheweb {}`".format(step.script.replace("_", "-")),
+            target=run_script,
+            args=(step.script,),
+            deps=[dep for dep in step.deps if dep not in completed],
+        )
+        for step in steps
+        if step.script not in completed
+    ]
+
+    def can_start(task: ChildTask, running: List[ChildTask]) -> bool:
+        if not steps_by_script[task.group].io:
+            return True
+        return sum(steps_by_script[r.group].io for r in running) < max_io_steps
+
+    def on_start(task: ChildTask, log_filepath: str) -> None:
+        print(
+            "==> Starting {}{} (log: {})".format(
+                task.description,
+                " with {} processes".format(num_procs) if steps_by_script[task.group].parallel else "",
+                log_filepath,
+            ),
+            flush=True,
+        )
+
+    def on_completion(task: ChildTask, seconds: float, group_completed: bool) -> None:
+        checkpoint["completed"][task.group] = {"seconds": round(seconds, 1)}
+        write_json(filepath=checkpoint_filepath, data=checkpoint, indent=1)
+        print("==> Completed {} in {}".format(task.description, fmt_seconds(seconds)), flush=True)
+
+    failed = run_tasks_in_children(
+        tasks,
+        get_generated_path("tmp", "process-logs"),
+        can_start=can_start,
+        on_start=on_start,
+        on_completion=on_completion,
+    )
+    if failed:
+        raise PheWebError(
+            "Failed: {}. The steps that completed are recorded in {}, so `pheweb2 process --resume` will skip them.".format(
+                ", ".join(task.description.strip("`") for task in failed),
+                checkpoint_filepath,
             )
-        try:
-            module_run(script_parts[1:])
-        except Exception:
-            print("==> failed after {}".format(fmt_seconds(time.time() - start_time)))
-            raise
-        else:
-            print(
-                "==> Completed in {}".format(fmt_seconds(time.time() - start_time)),
-                end="\n\n",
+        )
+
+
+def run_script(script: str) -> None:
+    script_parts = script.split()
+    module = importlib.import_module(".{}".format(script_parts[0]), __package__)
+    module_run = getattr(module, "run", None)  # appeases mypy
+    if not callable(module_run):
+        raise Exception(
+            "module.run ({!r}) isn't callable for module {!r} for script {!r}".format(
+                module_run, module, script
             )
+        )
+    module_run(script_parts[1:])
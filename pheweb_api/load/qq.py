@@ -6,8 +6,7 @@ This script creates json files which can be used to render QQ plots.
 # TODO: make gc_lambda for maf strata, and show them if they're >1.1?
 # TODO: copy some changes from <https://github.com/statgen/encore/blob/master/plot-epacts-output/make_qq_json.py>
 
-# TODO: Reduce memory usage by binning the (twosigfigs(maf), rounded(neglogpval,2)) for all variants with neglogpval<2.
-#       If manhattan and qq were computed together, we could re-use some information from the first pass.
+# TODO: If manhattan and qq were computed together, we could share one pass over the file.
 
 
 # NOTE: `qval` means `-log10(pvalue)`
@@ -24,17 +23,29 @@ from .. import conf
 from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
 from .load_utils import get_maf, parallelize_per_pheno, get_phenos_subset
 
-from typing import Dict, Any, List, Iterator, Set, Tuple
+from typing import Dict, Any, List, Iterator, Tuple
 import argparse
 import boltons.mathutils
 import boltons.iterutils
 import math
+import functools
+import scipy.special
 import scipy.stats
 import numpy as np
 
 NUM_BINS = 400
 NUM_MAF_RANGES = 4
 
+# qvals are counted in bins of QVAL_BIN_WIDTH up to MAX_BINNED_QVAL, and each maf bin also keeps its NUM_EXACT_QVALS largest qvals exactly.
+QVAL_BIN_WIDTH = 0.001
+MAX_BINNED_QVAL = 20  # above `ceil(2 * max_exp_qval)` for up to 5 billion variants
+NUM_QVAL_BINS = int(MAX_BINNED_QVAL / QVAL_BIN_WIDTH) + 1
+NUM_EXACT_QVALS = 1000
+MIN_LOG2_MAF = -24
+MAF_BINS_PER_OCTAVE = 16
+NUM_MAF_BINS = 2 + -MIN_LOG2_MAF * MAF_BINS_PER_OCTAVE
+CHUNK_SIZE = 100_000
+
 
 def run(argv: List[str]) -> None:
     parser = argparse.ArgumentParser(description="Make a QQ plot for each phenotype.")
@@ -107,43 +118,156 @@ def make_json_file(pheno: Dict[str, Any], ignore=None) -> None:
 def make_json_file_explicit(
     in_filepath: str, out_filepath: str, pheno: Dict[str, Any]
 ) -> None:
-    # Store all variants in a dataframe with columns (qval, maf) or just (qval)
-    variants = get_variants_df(in_filepath, pheno)
+    histogram = get_qq_histogram(in_filepath, pheno)
     rv: Dict[str, Any] = {}
-    if "maf" in variants.dtype.fields:  # type:ignore
-        rv["by_maf"] = make_qq_stratified(variants)
-        rv["overall"] = make_qq_unstratified(
-            variants, include_qq=False
-        )  # Must run AFTER `_stratified()`, because it sorts by qval, which could bias the maf_range strata.
-        rv["ci"] = list(get_confidence_intervals(len(variants) / len(rv["by_maf"])))
+    if histogram.has_maf:
+        rv["by_maf"] = make_qq_stratified(histogram)
+        rv["overall"] = make_qq_unstratified(histogram.get_qvals(), include_qq=False)
+        rv["ci"] = list(get_confidence_intervals(histogram.count / len(rv["by_maf"])))
     else:
-        rv["overall"] = make_qq_unstratified(variants, include_qq=True)
-        rv["ci"] = list(get_confidence_intervals(len(variants)))
+        rv["overall"] = make_qq_unstratified(histogram.get_qvals(), include_qq=True)
+        rv["ci"] = list(get_confidence_intervals(histogram.count))
     write_json(filepath=out_filepath, data=rv)
 
 
-def get_variants_df(in_filepath: str, pheno: Dict[str, Any]) -> np.ndarray:
-    # I'm making a dataframe with either the columns [qval maf] or just [qval], depending on whether we can calculate maf from the fields we have.
-    # I use float32 because I have no use for more precision, and I want to 100M variants in <1GB.  (ie, <10bytes/variant)
-    # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
-    # And anyways pd.DataFrame() allows passing in an iterator, but then it just calls list() on it, so it temporarily uses python's list overhead.
-    # Instead, I'm using np.fromiter() to make a "structured array".
+class QQHistogram:
+    """
+    Counts of qvals in fine bins, for each of the maf bins, built in one streaming pass.
+    The `NUM_EXACT_QVALS` largest qvals of each maf bin are also kept exactly, because the top of the QQ plot shows each of them.
+    Each qval bin also keeps its smallest and largest qval. Pvalues only have a few significant digits,
+    so most qval bins hold a single distinct qval, which makes them exact too.
+    Memory doesn't depend on the number of variants.
+    """
+
+    def __init__(self, has_maf: bool):
+        self.has_maf = has_maf
+        num_maf_bins = NUM_MAF_BINS if has_maf else 1
+        self.counts = np.zeros((num_maf_bins, NUM_QVAL_BINS), dtype=np.uint32)
+        self.maf_mins = np.full(num_maf_bins, np.inf, dtype=np.float32)
+        self.maf_maxs = np.full(num_maf_bins, -np.inf, dtype=np.float32)
+        self.qval_mins = np.full(NUM_QVAL_BINS, np.inf, dtype=np.float32)
+        self.qval_maxs = np.full(NUM_QVAL_BINS, -np.inf, dtype=np.float32)
+        self.top_qvals = [np.empty(0, dtype=np.float32) for _ in range(num_maf_bins)]
+        self._top_thresholds = np.full(num_maf_bins, -np.inf, dtype=np.float32)
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum(dtype=np.int64))
+
+    def add(self, mafs: np.ndarray, qvals: np.ndarray) -> None:
+        maf_bins = _get_maf_bins(mafs) if self.has_maf else np.zeros(len(qvals), dtype=np.int64)
+        qval_bins = _get_qval_bins(qvals)
+        cells, cell_counts = np.unique(maf_bins * NUM_QVAL_BINS + qval_bins, return_counts=True)
+        self.counts.reshape(-1)[cells] += cell_counts.astype(np.uint32)
+        np.minimum.at(self.maf_mins, maf_bins, mafs)
+        np.maximum.at(self.maf_maxs, maf_bins, mafs)
+        np.minimum.at(self.qval_mins, qval_bins, qvals)
+        np.maximum.at(self.qval_maxs, qval_bins, qvals)
+
+        # Only qvals that could enter the top of their maf bin are looked at again.
+        candidates = np.nonzero(qvals > self._top_thresholds[maf_bins])[0]
+        candidates = candidates[np.argsort(maf_bins[candidates], kind="stable")]
+        candidate_bins, starts = np.unique(maf_bins[candidates], return_index=True)
+        for maf_bin, idxs in zip(candidate_bins, np.split(candidates, starts[1:])):
+            top = np.concatenate([self.top_qvals[maf_bin], qvals[idxs]])
+            if len(top) > NUM_EXACT_QVALS:
+                top = -np.partition(-top, NUM_EXACT_QVALS - 1)[:NUM_EXACT_QVALS]
+                self._top_thresholds[maf_bin] = top.min()
+            self.top_qvals[maf_bin] = top
+
+    def get_qvals(self, maf_bins: slice = slice(None)) -> "DescendingQvals":
+        return DescendingQvals(
+            np.concatenate(self.top_qvals[maf_bins]),
+            self.counts[maf_bins].sum(axis=0, dtype=np.int64),
+            self.qval_mins,
+            self.qval_maxs,
+        )
+
+    def get_maf_strata(self) -> List[slice]:
+        """Splits the maf bins into `NUM_MAF_RANGES` consecutive groups with counts as close to equal as possible."""
+        cum_counts = np.cumsum(self.counts.sum(axis=1, dtype=np.int64))
+        targets = cum_counts[-1] * np.arange(1, NUM_MAF_RANGES) / NUM_MAF_RANGES
+        # each boundary is the end of whichever maf bin brings the cumulative count closest to its target
+        after = np.searchsorted(cum_counts, targets, side="left")
+        before = np.maximum(after - 1, 0)
+        ends = np.where(targets - cum_counts[before] < cum_counts[after] - targets, before, after) + 1
+        boundaries = [0] + ends.tolist() + [len(cum_counts)]
+        return [
+            slice(start, end)
+            for start, end in zip(boundaries, boundaries[1:])
+            if cum_counts[end - 1] > (cum_counts[start - 1] if start else 0)
+        ]
+
+
+class DescendingQvals:
+    """
+    Qvals in decreasing order: the largest ones exactly, then runs of qvals in the same qval bin.
+    Within a run, qvals are taken to be evenly spread from the largest to the smallest qval of the bin.
+    """
+
+    def __init__(self, top_qvals: np.ndarray, counts: np.ndarray, qval_mins: np.ndarray, qval_maxs: np.ndarray):
+        top_qvals = -np.sort(-top_qvals)[:NUM_EXACT_QVALS]
+        counts = counts.copy()
+        top_cells, top_counts = np.unique(_get_qval_bins(top_qvals), return_counts=True)
+        counts[top_cells] -= top_counts
+        self.top = top_qvals
+        run_bins = np.nonzero(counts)[0][::-1]
+        self.run_counts = counts[run_bins]
+        self.run_starts = len(top_qvals) + np.cumsum(self.run_counts) - self.run_counts
+        self.run_mins = qval_mins[run_bins].astype(np.float64)
+        self.run_maxs = qval_maxs[run_bins].astype(np.float64)
+        self._len = len(top_qvals) + int(self.run_counts.sum())
+
+    def __len__(self) -> int:
+        return self._len
+
+    def max(self) -> float:
+        return float(self.top[0]) if len(self.top) else float(self.run_maxs[0])
+
+    def max_at_most(self, limit: float) -> float:
+        """Returns the largest qval that is <= `limit`, or `limit` if there are none."""
+        idx = int(np.searchsorted(-self.top, -limit, side="left"))
+        if idx < len(self.top):
+            return float(self.top[idx])
+        run_idx = int(np.searchsorted(-self.run_mins, -limit, side="left"))
+        if run_idx < len(self.run_mins):
+            return min(float(self.run_maxs[run_idx]), limit)
+        return limit
+
+    def at_rank(self, rank: int) -> float:
+        """Returns the qval at index `rank` of the decreasing order."""
+        if rank < len(self.top):
+            return float(self.top[rank])
+        run_idx = int(np.searchsorted(self.run_starts, rank, side="right")) - 1
+        fraction = (rank - self.run_starts[run_idx]) / max(self.run_counts[run_idx] - 1, 1)
+        return float(self.run_maxs[run_idx] - fraction * (self.run_maxs[run_idx] - self.run_mins[run_idx]))
+
+
+def _get_maf_bins(mafs: np.ndarray) -> np.ndarray:
+    """maf bin 0 holds maf=0, and each octave from 2**MIN_LOG2_MAF up to 0.5 is split into `MAF_BINS_PER_OCTAVE` bins."""
+    with np.errstate(divide="ignore"):
+        log_bins = np.floor((np.log2(mafs) - MIN_LOG2_MAF) * MAF_BINS_PER_OCTAVE)
+    return np.where(mafs > 0, np.clip(log_bins, 0, NUM_MAF_BINS - 2) + 1, 0).astype(np.int64)
+
+
+def _get_qval_bins(qvals: np.ndarray) -> np.ndarray:
+    """The last qval bin holds every qval above the range of the QQ plot."""
+    return np.minimum(qvals.astype(np.float64) // QVAL_BIN_WIDTH, NUM_QVAL_BINS - 1).astype(np.int64)
+
+
+def get_qq_histogram(in_filepath: str, pheno: Dict[str, Any]) -> QQHistogram:
+    # maf is only used if it can be computed for the first variant.
     with VariantFileReader(in_filepath) as variant_dicts:
         try:
             first_variant = next(iter(variant_dicts))
         except StopIteration:
             raise PheWebError("No variants found in {}".format(in_filepath))
-    has_maf = get_maf(first_variant, pheno) is not None
-    if has_maf:
-        return np.fromiter(
-            get_maf_qval_pairs(in_filepath, pheno),
-            dtype=[("maf", np.float32), ("qval", np.float32)],
-        )
-    else:
-        return np.fromiter(
-            (qval for maf, qval in get_maf_qval_pairs(in_filepath, pheno)),
-            dtype=[("qval", np.float32)],
-        )
+    histogram = QQHistogram(has_maf=get_maf(first_variant, pheno) is not None)
+    # float32 is all the precision that the QQ plot needs.
+    for chunk in boltons.iterutils.chunked_iter(get_maf_qval_pairs(in_filepath, pheno), CHUNK_SIZE):
+        pairs = np.array(chunk, dtype=np.float32)
+        histogram.add(pairs[:, 0], pairs[:, 1])
+    return histogram
 
 
 def get_maf_qval_pairs(
@@ -156,49 +280,33 @@ def get_maf_qval_pairs(
             yield (maf, qval)
 
 
-def make_qq_stratified(variants: np.ndarray) -> List[Dict[str, Any]]:
-    # `variants.sort(order=['maf'])` breaks ties with remaining column 'qval', which biases the qq for the different maf slices.  Unacceptable.
-    # We could fix that by shuffling all the tied rows at maf_range borders.
-    # `sorted_mafs = np.sort(variants['maf'])` would require us to deal with ties.  Inconvenient.
-    # I want the behavior of `pd.sort_values(by='mf', inplace=True, ignore_index=True)` but without requiring pandas.
-    # This is the only way I could find to sort by only one column in numpy, and it's quite inefficient:
-    variants = variants[np.argsort(variants["maf"])]
-
-    def make_strata(idx: int) -> Dict[str, Any]:
-        # Note: slice_indices[1] is the same as slice_indices[0] of the next slice.
-        # But that's not a problem, because range() ignores the last index.
-        slice_indices = (
-            len(variants) * idx // NUM_MAF_RANGES,
-            len(variants) * (idx + 1) // NUM_MAF_RANGES,
+def make_qq_stratified(histogram: QQHistogram) -> List[Dict[str, Any]]:
+    # Strata are groups of whole maf bins, so that every stratum is an unbiased sample of qvals within its maf range.
+    # Splitting ties by qval would bias the qq for the different maf slices.
+    strata = []
+    for maf_bins in histogram.get_maf_strata():
+        qvals = histogram.get_qvals(maf_bins)
+        strata.append(
+            {
+                "maf_range": (
+                    histogram.maf_mins[maf_bins].min(),
+                    histogram.maf_maxs[maf_bins].max(),
+                ),
+                "count": len(qvals),
+                "qq": compute_qq(qvals),
+            }
         )
-        qvals = variants["qval"][
-            slice_indices[0] : slice_indices[1]
-        ].copy()  # Make sure to copy so we don't modify `variants`.
-        qvals *= -1
-        qvals.sort()
-        qvals *= -1  # lol, sort descending
-        return {
-            "maf_range": (
-                variants["maf"][slice_indices[0]],
-                variants["maf"][slice_indices[1] - 1],
-            ),
-            "count": len(qvals),
-            "qq": compute_qq(qvals),
-        }
-
-    return [make_strata(i) for i in range(NUM_MAF_RANGES)]
-
-
-def make_qq_unstratified(variants: np.ndarray, include_qq: bool) -> Dict[str, Any]:
-    variants[::-1].sort(order=["qval"])  # Sort descending.
-    qvals = variants["qval"]
+    return strata
+
+
+def make_qq_unstratified(qvals: "DescendingQvals", include_qq: bool) -> Dict[str, Any]:
     rv: Dict[str, Any] = {}
     if include_qq:
         rv["qq"] = compute_qq(qvals)
     rv["count"] = len(qvals)
     rv["gc_lambda"] = {}
     for perc in ["0.5", "0.1", "0.01", "0.001"]:
-        gc = gc_value_from_list(qvals, float(perc))
+        gc = gc_value_from_qvals(qvals, float(perc))
         if math.isnan(gc) or abs(gc) == math.inf:
             print("WARNING: got gc_value {!r}".format(gc))
         else:
@@ -206,12 +314,9 @@ def make_qq_unstratified(variants: np.ndarray, include_qq: bool) -> Dict[str, An
     return rv
 
 
-def compute_qq(qvals: np.ndarray) -> Dict[str, Any]:
-    # qvals must be in decreasing order.
+def compute_qq(qvals: DescendingQvals) -> Dict[str, Any]:
     # Decreasing order (from strongest pvalue to weakest) works well because we it lets us use `(idx+0.5)/len(qvals)` as the expected pvalue.
-    assert all(a >= b for a, b in boltons.iterutils.pairwise_iter(qvals))
-
-    if len(qvals) == 0 or qvals[0] == 0:
+    if len(qvals) == 0 or qvals.max() == 0:
         return {}  # the js detects that the values for each key are undefined
 
     max_exp_qval = -math.log10(0.5 / len(qvals))
@@ -221,43 +326,49 @@ def compute_qq(qvals: np.ndarray) -> Dict[str, Any]:
     # this calculation must avoid dropping points that would be shown by the calculation done in javascript.
     # `max_obs_qval` means the largest observed -log10(pvalue) that will be shown in the plot. It's usually NOT the largest in the data.
     max_obs_qval = boltons.mathutils.clamp(
-        qvals[0], lower=max_exp_qval, upper=math.ceil(2 * max_exp_qval)
+        qvals.max(), lower=max_exp_qval, upper=math.ceil(2 * max_exp_qval)
     )
-    if qvals[0] > max_obs_qval:
-        for qval in qvals:
-            if qval <= max_obs_qval:
-                max_obs_qval = qval
-                break
-
-    occupied_bins: Set[Tuple[int, int]] = set()
-    for i, obs_qval in enumerate(qvals):
-        if obs_qval > max_obs_qval:
-            continue
-        exp_qval = -math.log10((i + 0.5) / len(qvals))
-        exp_bin = int(exp_qval / max_exp_qval * NUM_BINS)
-        # TODO: it'd be great if the `obs_bin`s started right at the lowest qval in that `exp_bin`.
-        #       that way we could have fewer bins but still get a nice straight diagonal line without that stair-stepping appearance.
-        obs_bin = int(obs_qval / max_obs_qval * NUM_BINS)
-        occupied_bins.add((exp_bin, obs_bin))
-
-    bins = []
-    for exp_bin, obs_bin in occupied_bins:
-        assert 0 <= exp_bin <= NUM_BINS, exp_bin
-        assert 0 <= obs_bin <= NUM_BINS, obs_bin
-        bins.append(
-            (exp_bin / NUM_BINS * max_exp_qval, obs_bin / NUM_BINS * max_obs_qval)
+    if qvals.max() > max_obs_qval:
+        max_obs_qval = qvals.max_at_most(max_obs_qval)
+
+    def get_exp_bins(ranks: np.ndarray) -> np.ndarray:
+        exp_qvals = -np.log10((ranks + 0.5) / len(qvals))
+        return (exp_qvals / max_exp_qval * NUM_BINS).astype(np.int64)
+
+    # The exact qvals each occupy one bin.
+    shown = np.nonzero(qvals.top <= max_obs_qval)[0]
+    exp_bins = [get_exp_bins(shown)]
+    obs_bins = [(qvals.top[shown] / max_obs_qval * NUM_BINS).astype(np.int64)]
+
+    # A run of qvals in one qval bin occupies every exp_bin between those of its first and last ranks,
+    # because past the exact qvals, consecutive ranks are much closer than an exp_bin.
+    shown = np.nonzero(qvals.run_mins <= max_obs_qval)[0]
+    first_exp_bins = get_exp_bins(qvals.run_starts[shown])
+    last_exp_bins = get_exp_bins(qvals.run_starts[shown] + qvals.run_counts[shown] - 1)
+    num_exp_bins = first_exp_bins - last_exp_bins + 1
+    offsets = np.arange(num_exp_bins.sum()) - np.repeat(np.cumsum(num_exp_bins) - num_exp_bins, num_exp_bins)
+    run_obs_qvals = np.minimum((qvals.run_mins[shown] + qvals.run_maxs[shown]) / 2, max_obs_qval)
+    exp_bins.append(np.repeat(first_exp_bins, num_exp_bins) - offsets)
+    obs_bins.append(np.repeat((run_obs_qvals / max_obs_qval * NUM_BINS).astype(np.int64), num_exp_bins))
+
+    # TODO: it'd be great if the `obs_bin`s started right at the lowest qval in that `exp_bin`.
+    #       that way we could have fewer bins but still get a nice straight diagonal line without that stair-stepping appearance.
+    occupied_bins = np.unique(np.concatenate(exp_bins) * (NUM_BINS + 1) + np.concatenate(obs_bins))
+    exp_bins, obs_bins = np.divmod(occupied_bins, NUM_BINS + 1)
+    bins = list(
+        zip(
+            (exp_bins / NUM_BINS * max_exp_qval).tolist(),
+            (obs_bins / NUM_BINS * max_obs_qval).tolist(),
         )
-    bins.sort()
+    )
     return {
         "bins": bins,
         "max_exp_qval": max_exp_qval,
     }
 
 
-def gc_value_from_list(qvals: List[float], quantile: float = 0.5) -> float:
-    # qvals must be in decreasing order.
-    assert all(a >= b for a, b in boltons.iterutils.pairwise_iter(qvals))
-    qval = qvals[int(len(qvals) * quantile)]
+def gc_value_from_qvals(qvals: DescendingQvals, quantile: float = 0.5) -> float:
+    qval = qvals.at_rank(int(len(qvals) * quantile))
     pval = 10**-qval
     return gc_value(pval, quantile)
 
@@ -276,20 +387,27 @@ assert approx_equal(gc_value(0.6123), 0.5645607)
 def get_confidence_intervals(
     num_variants: float, confidence: float = 0.95
 ) -> Iterator[Dict[str, float]]:
+    for x, y_min, y_max in _get_confidence_intervals(num_variants, confidence):
+        yield {"x": x, "y_min": y_min, "y_max": y_max}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_confidence_intervals(
+    num_variants: float, confidence: float
+) -> Tuple[Tuple[float, float, float], ...]:
+    # Each worker computes the intervals once for each number of variants, and phenotypes often have the same number.
     one_sided_doubt = (1 - confidence) / 2
 
     # `variant_counts` are the numbers of variants at which we'll calculate the confidence intervals
     # any `1 <= variant_count <= num_variants-1` could be used, but we scale in powers of 2 to make the CI visually pretty smooth.
-    variant_counts = []
-    for x in range(0, int(math.ceil(math.log2(num_variants)))):
-        variant_counts.append(2**x)
-    variant_counts.append(num_variants - 1)
-    variant_counts.reverse()
-
-    for variant_count in variant_counts:
-        rv = scipy.stats.beta(variant_count, num_variants - variant_count)
-        yield {
-            "x": round(-math.log10((variant_count - 0.5) / num_variants), 2),
-            "y_min": round(-math.log10(rv.ppf(1 - one_sided_doubt)), 2),
-            "y_max": round(-math.log10(rv.ppf(one_sided_doubt)), 2),
-        }
+    variant_counts = 2.0 ** np.arange(int(math.ceil(math.log2(num_variants))))
+    variant_counts = np.append(variant_counts, num_variants - 1)[::-1]
+
+    # `betaincinv(a, b, q)` is the same as `scipy.stats.beta(a, b).ppf(q)`, for every variant count at once.
+    xs = -np.log10((variant_counts - 0.5) / num_variants)
+    y_mins = -np.log10(scipy.special.betaincinv(variant_counts, num_variants - variant_counts, 1 - one_sided_doubt))
+    y_maxs = -np.log10(scipy.special.betaincinv(variant_counts, num_variants - variant_counts, one_sided_doubt))
+    return tuple(
+        (round(x, 2), round(y_min, 2), round(y_max, 2))
+        for x, y_min, y_max in zip(xs.tolist(), y_mins.tolist(), y_maxs.tolist())
+    )
@@ -13,8 +13,10 @@ from ..file_utils import (
     make_basedir,
     get_dated_tmp_path,
     get_tmp_path,
+    get_generated_path,
 )
-from .load_utils import mtime, indent, ProgressBar
+from .load_utils import indent, ProgressBar
+from . import build_manifest
 
 import contextlib
 import os
@@ -29,6 +31,8 @@ MAX_NUM_FILES_TO_MERGE_AT_ONCE = (
 MIN_NUM_FILES_TO_MERGE_AT_ONCE = (
     4   # Try to avoid ever merging fewer than this many files at a time.
 )
+# how many files each node of the merge tree of `pheweb2 cluster` merges
+TREE_FAN_IN = 8
 
 
 
@@ -40,6 +44,10 @@ def run(argv):
     force = False
     if argv == ["-f"]:
         force = True
+    elif len(argv) == 2 and argv[0] == "--tree-node":
+        level, index = argv[1].split("-")
+        run_tree_node(int(level), int(index))
+        return
     elif argv:
         print(
             "1. Extract all variants from each phenotype\n"
@@ -50,6 +58,7 @@ def run(argv):
             + "  -f   run even if {} is up-to-date\n".format(
                 os.path.basename(out_filepath)
             )
+            + "  --tree-node <level>-<index>   only merge one node of the merge tree (for `pheweb2 cluster`)\n"
         )
         exit(1)
 
@@ -60,11 +69,16 @@ def run(argv):
         MIN_NUM_FILES_TO_MERGE_AT_ONCE = max(MAX_NUM_FILES_TO_MERGE_AT_ONCE // 2, 2)
         
 
-    # TODO: If a phenotype is removed, this still reports that the list of sites is up-to-date.  How to check that?
-    if os.path.exists(out_filepath) and not force:
-        if mtime(out_filepath) >= max(mtime(f["filepath"]) for f in manna.files):
-            print("The list of sites is up-to-date!")
-            return
+    # The manifest records which parsed files the sites came from, so adding or removing a phenotype makes this stale.
+    input_filepaths = [f["filepath"] for f in manna.files]
+    if not force and build_manifest.is_up_to_date("sites", out_filepath, input_filepaths):
+        print("The list of sites is up-to-date!")
+        return
+    changes = None if force else build_manifest.get_changes(out_filepath, input_filepaths)
+    if changes is not None and not (changes["changed"] or changes["extended"] or changes["removed"]):
+        add_sites(out_filepath, changes["added"])
+        build_manifest.record("sites", out_filepath, input_filepaths)
+        return
 
     taskq = multiprocessing.Queue()
     retq = multiprocessing.Queue()
@@ -106,6 +120,75 @@ def run(argv):
         assert p.exitcode == 0
     make_basedir(out_filepath)
     os.rename(manna.files[0]["filepath"], out_filepath)
+    build_manifest.record("sites", out_filepath, input_filepaths)
+
+
+def add_sites(out_filepath, new_filepaths):
+    """When phenotypes were only added, merges just their variants into the existing list of sites."""
+    print(
+        "Adding the variants of {} new phenotypes to the existing list of sites".format(
+            len(new_filepaths)
+        )
+    )
+    old_sha256 = build_manifest.get_hash(out_filepath)
+    tmp_filepath = get_tmp_path(f"merging-{random.randrange(int(1e10))}")
+    files_to_merge = [
+        {"type": "input", "filepath": filepath}
+        for filepath in [out_filepath] + new_filepaths
+    ]
+    for ret in merge(files_to_merge, tmp_filepath):
+        print(ret["warning_str"])
+    os.rename(tmp_filepath, out_filepath)
+    build_manifest.record_extension(out_filepath, old_sha256)
+
+
+def get_merge_tree(num_files, fan_in=TREE_FAN_IN):
+    """
+    Splits merging `num_files` files into levels of nodes, so that `pheweb2 cluster` can run each node as a job.
+    Each node of level 0 merges up to `fan_in` input files, and each node of a later level merges the outputs of up to `fan_in` nodes
+    of the level before it. The last level has one node, which writes the list of sites.
+    Returns [[[the index of each file or node that a node merges] for each node] for each level].
+    """
+    levels = []
+    while True:
+        levels.append([list(range(i, min(i + fan_in, num_files))) for i in range(0, max(num_files, 1), fan_in)])
+        if len(levels[-1]) == 1:
+            return levels
+        num_files = len(levels[-1])
+
+
+assert get_merge_tree(20, 4) == [[[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11], [12, 13, 14, 15], [16, 17, 18, 19]], [[0, 1, 2, 3], [4]], [[0, 1]]]
+assert get_merge_tree(3, 4) == [[[0, 1, 2]]]
+
+
+def run_tree_node(level, index):
+    out_filepath = get_filepath("unanno", must_exist=False)
+    input_filepaths = [f["filepath"] for f in MergeManager().files]
+    if build_manifest.is_up_to_date("sites", out_filepath, input_filepaths):
+        print("The list of sites is up-to-date!")
+        return
+    levels = get_merge_tree(len(input_filepaths))
+    if level == 0:
+        files_to_merge = [{"type": "input", "filepath": input_filepaths[i]} for i in levels[level][index]]
+    else:
+        files_to_merge = [{"type": "merged", "filepath": get_tree_node_filepath(level - 1, i)} for i in levels[level][index]]
+        for file_to_merge in files_to_merge:
+            if not os.path.exists(file_to_merge["filepath"]):
+                raise PheWebError(
+                    "{} doesn't exist, so the nodes of level {} of the merge tree must run first".format(file_to_merge["filepath"], level - 1)
+                )
+    is_root = level == len(levels) - 1
+    node_filepath = out_filepath if is_root else get_tree_node_filepath(level, index)
+    make_basedir(node_filepath)
+    print("Merging {} files into {}".format(len(files_to_merge), node_filepath))
+    for ret in merge(files_to_merge, node_filepath):
+        print(ret["warning_str"])
+    if is_root:
+        build_manifest.record("sites", out_filepath, input_filepaths)
+
+
+def get_tree_node_filepath(level, index):
+    return get_generated_path("tmp", "sites-tree", "{}-{}".format(level, index))
 
 
 class MergeManager:
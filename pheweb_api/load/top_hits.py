@@ -7,9 +7,9 @@ from ..file_utils import (
     get_pheno_filepath,
     get_phenocode_with_stratifications,
 )
+from . import build_manifest
 
 import json
-from pathlib import Path
 from typing import Dict, Any, List, Iterator
 
 # TODO: It'd be great if each peak also included a list of all the associations that it is masking, so that on-click we could display a variants-under-this-peak table.
@@ -47,33 +47,21 @@ def stringify_assocs(assocs: List[Dict[str, Any]]) -> None:
             a["nearest_genes"] = ",".join(a["nearest_genes"])
 
 
-def should_run() -> bool:
-    output_filepaths = [
-        Path(get_filepath(name, must_exist=False))
-        for name in ["top-hits", "top-hits-1k", "top-hits-tsv"]
-    ]
-    print(f"{output_filepaths=}")
-    if not all(fp.exists() for fp in output_filepaths):
-        return True
-    oldest_output_mtime = min(fp.stat().st_mtime for fp in output_filepaths)
-    if conf.has_stratifications():
-        input_filepaths = [
-            Path(
-                get_pheno_filepath(
-                    "manhattan", get_phenocode_with_stratifications(pheno)
-                )
-            )
-            for pheno in get_phenolist()
-        ]
-    else:
-        input_filepaths = [
-            Path(get_pheno_filepath("manhattan", pheno["phenocode"]))
-            for pheno in get_phenolist()
-        ]
-    newest_input_mtime = max(fp.stat().st_mtime for fp in input_filepaths)
-    if newest_input_mtime > oldest_output_mtime:
-        return True
-    return False
+def get_input_filepaths() -> List[str]:
+    # pheno-list.json too, because hits copy fields like `phenostring` and `category` from it
+    filepaths = [get_filepath("phenolist")]
+    for pheno in get_phenolist():
+        phenocode = pheno["phenocode"]
+        if pheno["interaction"] is not None:
+            phenocode += ".interaction-" + pheno["interaction"]
+        if conf.has_stratifications():
+            phenocode = get_phenocode_with_stratifications(dict(pheno, phenocode=phenocode))
+        filepaths.append(get_pheno_filepath("manhattan", phenocode))
+    return filepaths
+
+
+def get_config() -> Dict[str, Any]:
+    return {"top_hits_pval_cutoff": conf.get_top_hits_pval_cutoff()}
 
 
 def run(argv: List[str]) -> None:
@@ -108,7 +96,10 @@ just the top phenotype for each, use `pheweb top-loci`.
         )
         exit(1)
 
-    if not should_run():
+    input_filepaths = get_input_filepaths()
+    if build_manifest.is_up_to_date(
+        "top-hits", [out_filepath_json, out_filepath_1k_json], input_filepaths, get_config()
+    ):
         print("Already up-to-date!")
         return
 
@@ -124,3 +115,10 @@ just the top phenotype for each, use `pheweb top-loci`.
         stringify_assocs(hits)
         write_heterogenous_variantfile(out_filepath_tsv, hits, use_gzip=False)
         print("wrote {} hits to {}".format(len(hits), out_filepath_tsv))
+
+    build_manifest.record(
+        "top-hits",
+        [out_filepath_json, out_filepath_1k_json] + ([out_filepath_tsv] if hits else []),
+        input_filepaths,
+        get_config(),
+    )
@@ -1,13 +1,22 @@
-import gzip
 import os
 # from flask import current_app
 import sqlite3
-import csv
+import threading
+import urllib.parse
 from functools import lru_cache
-import tqdm
 from .models import create_phenotypes_list, create_genes
+from .variant_index import load_variant_index, get_index_dir
+from .pheno_search import PhenoSearch, create_pheno_search_tables
 from flask import g
-from ..conf import is_debug_mode, get_pheweb_data_dir
+from ..conf import is_debug_mode, get_pheweb_data_dir, get_autocomplete_mmap_size
+from ..file_utils import get_filepath
+from ..load import build_manifest
+from ..load.make_variant_index import update_variant_index
+
+
+# Bump this when the layout of `autocomplete.db` changes, so that existing databases get rebuilt.
+AUTOCOMPLETE_SCHEMA_VERSION = 3
+STEP = "generate-autocomplete-db"
 
 
 class GenesServiceNotAvailable(Exception):
@@ -42,205 +51,122 @@ class AutocompleteLoading:
         self.variants = {}
         self.file_path = os.path.join(get_pheweb_data_dir(), "sites")
         self.db_path = os.path.join(self.file_path, "autocomplete.db")
-        print(f"DEBUG: db_path: {self.db_path}")
+        self.variant_index_dir = get_index_dir(self.file_path)
+        if is_debug_mode(): print(f"DEBUG: db_path: {self.db_path}")
         self.create_table()
-        self._load_to_memory()
+        self.create_variant_index()
+        self._local = threading.local()
+        self.pheno_search = PhenoSearch(lambda: self.connection)
 
         
-    def _load_to_memory(self):
-        file_connection = sqlite3.connect(self.db_path)
-        mem_connection = sqlite3.connect(":memory:", check_same_thread=False)
-        file_connection.backup(mem_connection)
-        file_connection.close()
-
-        try:
-            cur = mem_connection.cursor()
-            cur.execute("SELECT COUNT(*) FROM variants")
-            count = cur.fetchone()[0]
-            if is_debug_mode(): print(f"DEBUG: {count} variant records loaded into memory")
-            # cur.execute("SELECT rsid, variant_id FROM variants LIMIT 5")
-            # sample_rows = cur.fetchall()
-            # print(f"DEBUG: Sample rsids in DB: {sample_rows}")
-
-            cur.execute("SELECT COUNT(*) FROM genes")
-            count = cur.fetchone()[0]
-            if is_debug_mode(): print(f"DEBUG: {count} gene records loaded into memory")
-
-            cur.execute("SELECT COUNT(*) FROM phenotypes")
-            count = cur.fetchone()[0]
-            if is_debug_mode(): print(f"DEBUG: {count} phenotype records loaded into memory")
-            
-        except Exception as e:
-            print("DEBUG: Failed to query memory DB:", e)
+    @property
+    def variant_index(self):
+        """Reopened after `make-variant-index` rebuilds it, see `load_variant_index`."""
+        return load_variant_index(self.variant_index_dir)
+
+    @property
+    def connection(self):
+        """
+        A read-only connection to `autocomplete.db` that memory-maps the file instead of copying it into `:memory:`.
+        The mapped pages live in the OS page cache, so every gunicorn worker shares them and startup doesn't depend on the size of the database.
+        Each thread gets its own connection, so that the backends of one search query SQLite concurrently instead of taking turns on one connection.
+        Connections are opened lazily and reopened after a fork, because SQLite connections must not cross processes.
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = self._open_read_only()
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _open_read_only(self):
+        uri = "file:{}?mode=ro".format(urllib.parse.quote(self.db_path))
+        conn = sqlite3.connect(uri, uri=True)
+        cur = conn.cursor()
+        cur.execute("PRAGMA mmap_size = {:d}".format(get_autocomplete_mmap_size()))
+        cur.execute("PRAGMA query_only = ON")
+        if is_debug_mode():
+            mmap_size = cur.execute("PRAGMA mmap_size").fetchone()[0]
+            print(f"DEBUG: Opened {self.db_path} read-only with mmap_size={mmap_size} (pid {os.getpid()})")
+        return conn
 
-        self.connection = mem_connection
-    
     def table_exists(self, cur, table_name):
         cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
         return cur.fetchone() is not None
-    
-    def create_table(self):
-        if os.path.exists(self.db_path):
-            if is_debug_mode(): print(f"DEBUG: Found existing database at {self.db_path}")
-            conn = sqlite3.connect(self.db_path)
-            cur = conn.cursor()
-            
-            if not self.table_exists(cur, "variants"):
-                if is_debug_mode(): print(f"DEBUG: Creating variants table")
-                self.create_autocomplete_db_variants_table()
-
-            if not self.table_exists(cur, "genes"):
-                if is_debug_mode(): print(f"DEBUG: Creating genes table")
-                self.create_autocomplete_db_genes_table()
 
-            if not self.table_exists(cur, "phenotypes"):
-                if is_debug_mode(): print(f"DEBUG: Creating phenotypes table")
-                self.create_autocomplete_db_phenotypes_table()
+    def get_sources(self):
+        """The input files of each part of the autocomplete store. A part is rebuilt when any of its inputs changes."""
+        return {
+            "genes": [get_filepath("genes"), get_filepath("best-phenos-by-gene-sqlite3")],
+            "phenotypes": [get_filepath("phenotypes_summary")],
+        }
 
-            if self.table_exists(cur, "phenotypes") and not self.table_exists(cur, "phenotypes_fts"):
-                if is_debug_mode(): print(f"DEBUG: Creating phenotypes_fts virtual table")
-                cur.execute("""
-                    CREATE VIRTUAL TABLE phenotypes_fts USING fts5(
-                        phenocode,
-                        phenostring,
-                        content=phenotypes,
-                        content_rowid=rowid
-                    )
-                """)
-                cur.execute("INSERT INTO phenotypes_fts(phenotypes_fts) VALUES ('rebuild')")
-                conn.commit()
-                if is_debug_mode(): print("DEBUG: phenotypes_fts virtual table created and rebuilt.")
-           
-            conn.close()
-            if is_debug_mode(): print(f"DEBUG: Database creation complete. Entries loaded.")
+    def create_table(self):
+        """
+        Brings `autocomplete.db` up to date, rebuilding only the parts whose inputs changed (see `build_manifest`).
+        An unchanged store costs a few `stat()`s.
+        """
+        sources = self.get_sources()
+        input_filepaths = sorted({filepath for filepaths in sources.values() for filepath in filepaths})
+        config = {"schema_version": AUTOCOMPLETE_SCHEMA_VERSION}
+        self._remove_legacy_db()
+        if build_manifest.is_up_to_date(STEP, self.db_path, input_filepaths, config):
+            if is_debug_mode(): print("DEBUG: autocomplete.db is up to date")
+            return
+        changes = build_manifest.get_changes(self.db_path, input_filepaths, config)
+        builders = {
+            "genes": self.create_autocomplete_db_genes_table,
+            "phenotypes": self.create_autocomplete_db_phenotypes_table,
+        }
+        for part, part_sources in sources.items():
+            if changes is None or set(changes["added"] + changes["changed"] + changes["extended"]) & set(part_sources):
+                if is_debug_mode(): print(f"DEBUG: Building {part}")
+                builders[part]()
+        build_manifest.record(STEP, self.db_path, input_filepaths, config)
+
+    def _remove_legacy_db(self):
+        """Removes an `autocomplete.db` made before it was in the build manifest, so that it's rebuilt rather than adopted by its mtime."""
+        if not os.path.exists(self.db_path):
             return
-        else:
-            if is_debug_mode(): print(f"DEBUG: Creating new database at {self.db_path}")
-            self.create_autocomplete_db_variants_table()
-            self.create_autocomplete_db_genes_table()
-            self.create_autocomplete_db_phenotypes_table()
-            conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        try:
             cur = conn.cursor()
-            if is_debug_mode(): print("DEBUG: Creating phenotypes_fts virtual table...")
-            cur.execute("""
-                CREATE VIRTUAL TABLE IF NOT EXISTS phenotypes_fts USING fts5(
-                    phenocode,
-                    phenostring,
-                    content='phenotypes',
-                    content_rowid='rowid'
-                )
-            """)
-            cur.execute("INSERT INTO phenotypes_fts(phenotypes_fts) VALUES ('rebuild')")
-            conn.commit()
+            is_legacy = self.table_exists(cur, "variants") or self.table_exists(cur, "build_manifest")
+        finally:
             conn.close()
-            if is_debug_mode(): print("DEBUG: phenotypes_fts virtual table created and rebuilt.")
-        
-    
-    def create_autocomplete_db_variants_table(self):
-        
-        db_path = self.db_path
-
-        # if is_debug_mode(): print(f"DEBUG: Creating new database at {db_path}")
-        conn = sqlite3.connect(db_path)
-        cur = conn.cursor()
-
-        try:
-            cur.execute("PRAGMA journal_mode = OFF")
-            cur.execute("PRAGMA synchronous = OFF")
-            cur.execute("PRAGMA cache_size = 1000000")
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS variants (
-                    id INTEGER PRIMARY KEY,
-                    rsid TEXT,
-                    variant_id TEXT,
-                    chrom TEXT,
-                    pos INTEGER
-                )
-            """)
-
-            tsv_path = os.path.join(self.file_path, "sites.tsv")
-            if is_debug_mode(): print(f"DEBUG: Loading data from {tsv_path}")
-            rows = []
-            batch_size = 1_000_000
-            with gzip.open(tsv_path, "rt") as tsvfile:
-                reader = csv.DictReader(tsvfile, delimiter="\t")
-                for row in tqdm.tqdm(reader, desc="Loading TSV"):
-                    chrom = row["chrom"]
-                    pos = row["pos"]
-                    ref = row["ref"]
-                    alt = row["alt"]
-                    rsid = row["rsids"].split(",")[0] if row["rsids"] else None
-                    variant_id = f"{chrom}-{pos}-{ref}-{alt}"
-                    rows.append((rsid, variant_id, chrom, int(pos)))
-                    if len(rows) >= batch_size:
-                        if is_debug_mode(): print(f"\nDEBUG: Inserting {len(rows)} rows into database")
-                        if is_debug_mode(): print(f"DEBUG: Example row: {rows[0]}")
-                        cur.execute("BEGIN TRANSACTION")
-                        cur.executemany(
-                            "INSERT INTO variants (rsid, variant_id, chrom, pos) VALUES (?, ?, ?, ?)", rows
-                        )
-                        rows = []
-                        conn.commit()
-                if len(rows) > 0:
-                    if is_debug_mode(): print(f"DEBUG: Inserting {len(rows)} rows into database")
-                    if is_debug_mode(): print(f"DEBUG: Example row: {rows[0]}")
-                    cur.execute("BEGIN TRANSACTION")
-                    cur.executemany(
-                        "INSERT INTO variants (rsid, variant_id, chrom, pos) VALUES (?, ?, ?, ?)", rows
-                    )
-                    rows = []
-                    conn.commit()
-
-            if is_debug_mode(): print("DEBUG: Creating indexes for rsid and variant_id...")
-            cur.execute("CREATE INDEX idx_variant_id ON variants(variant_id)")
-            cur.execute("CREATE INDEX idx_rsid ON variants(rsid)")
-            cur.execute("CREATE INDEX idx_chrom ON variants(chrom)")
-            cur.execute("CREATE INDEX idx_pos ON variants(pos)")
-            # cur.execute("CREATE INDEX idx_pos_str ON variants(pos_str)")
-            conn.commit()
+        if is_legacy:
+            os.remove(self.db_path)
 
-            if is_debug_mode(): print(f"DEBUG: Database creation complete. Entries loaded.")
+    def create_variant_index(self):
+        num_variants = update_variant_index(get_filepath("sites"), self.variant_index_dir)
+        if num_variants is not None:
+            if is_debug_mode(): print(f"DEBUG: Variant index created with {num_variants} variants.")
 
-        except Exception as e:
-            print(f"DEBUG: Error inserting data: {e}")
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
-    
-    
     def create_autocomplete_db_genes_table(self):
-        db_path = self.db_path
-        # genes_service = get_genes_service()
-        # gene_dict = genes_service.get_all_genes()
         gene_dict = create_genes().get_all_genes()
         
         if gene_dict is None:
             raise Exception("genes cannot be retrieved")
-            # raise GenesServiceNotAvailable(
-            #     "Could not create gene service. Check if data path (named generated-by-pheweb/ by default) is correctly configured in .env or config.py."
-            # )
         
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(self.db_path)
         cur = conn.cursor()
 
         try:
+            cur.execute("BEGIN TRANSACTION")
+            cur.execute("DROP TABLE IF EXISTS genes")
+            # NOCASE lets SQLite use the primary key for the case-insensitive `gene_id LIKE 'prefix%'` in `query_genes`
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS genes (
-                    gene_id TEXT PRIMARY KEY,
+                CREATE TABLE genes (
+                    gene_id TEXT PRIMARY KEY COLLATE NOCASE,
                     chrom TEXT,
                     start INTEGER,
                     stop INTEGER
-                )
+                ) WITHOUT ROWID
             """)
 
             rows = [
                 (gene, val["chrom"], val["start"], val["stop"])
                 for gene, val in gene_dict.items()
             ]
-            cur.execute("BEGIN TRANSACTION")
-            cur.executemany("INSERT INTO genes (gene_id, chrom, start, stop) VALUES (?, ?, ?, ?)", rows)
+            cur.executemany("INSERT OR IGNORE INTO genes (gene_id, chrom, start, stop) VALUES (?, ?, ?, ?)", rows)
             conn.commit()
             if is_debug_mode(): print(f"DEBUG: Genes table creation complete. {len(rows)} entries loaded.")
         except Exception as e:
@@ -251,23 +177,21 @@ class AutocompleteLoading:
             conn.close()
 
     def create_autocomplete_db_phenotypes_table(self):
-        db_path = self.db_path
-        
-        # pheno_service = get_pheno_service()
-        # pheno_dict = pheno_service.get_all_pheno_names()
         pheno_dict = create_phenotypes_list().get_all_pheno_names()
         if pheno_dict is None:
             raise Exception("phenotypes cannot be retrieved")
-            # raise PhenotypeServiceNotAvailable(
-            #     "Could not create phenotype service. Check if data path (named generated-by-pheweb/ by default) is correctly configured in .env or config.py."
-            # )
         
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(self.db_path)
         cur = conn.cursor()
 
         try:
+            cur.execute("BEGIN TRANSACTION")
+            cur.execute("DROP TABLE IF EXISTS phenotypes_fts")
+            cur.execute("DROP TABLE IF EXISTS phenotypes_trigram")
+            cur.execute("DROP TABLE IF EXISTS phenotypes")
+            # the FTS5 tables use `phenotypes` as their external content, so it needs a rowid
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS phenotypes (
+                CREATE TABLE phenotypes (
                     phenocode TEXT PRIMARY KEY,
                     phenostring TEXT
                 )
@@ -277,17 +201,10 @@ class AutocompleteLoading:
                 (phenocode, val["phenostring"])
                 for phenocode, val in pheno_dict.items()
             ]
-            cur.execute("BEGIN TRANSACTION")
             cur.executemany("INSERT INTO phenotypes (phenocode, phenostring) VALUES (?, ?)", rows)
-            conn.commit()
+            create_pheno_search_tables(conn)
             if is_debug_mode(): print(f"DEBUG: Phenotypes table creation complete. {len(rows)} entries loaded.")
 
-            if is_debug_mode(): print("DEBUG: Creating indexes for phenostring...")
-            cur.execute("CREATE INDEX idx_phenostring ON phenotypes(phenostring)")
-            conn.commit()
-
-            if is_debug_mode(): print(f"DEBUG: Database creation complete. Entries loaded.")
-
         except Exception as e:
             print(f"DEBUG: Error inserting data: {e}")
             conn.rollback()
@@ -296,76 +213,30 @@ class AutocompleteLoading:
             conn.close()
 
 
-
-
-    # @lru_cache(maxsize=1000)
     def query_variants(self, prefix: str, chrom: str = None, pos: int = None, max_results=4):
-        # db_path = self.db_path
-        # conn = sqlite3.connect(db_path)
-        # cur = conn.cursor()
-        # print(f"DEBUG: query_variants called")
-        # print(f"DEBUG: self.connection = {self.connection}")
-        try:
-            cur = self.connection.cursor()
-            # print(f"DEBUG: cursor created")
-            cur.execute("SELECT rsid, variant_id FROM variants LIMIT 1")
-            sample_rows = cur.fetchall()
-            if is_debug_mode(): print(f"DEBUG: Sample rsids in DB: {sample_rows}")
-        except Exception as e:
-            print(f"DEBUG: Error querying variants: {e}")
-            raise e
-        
+        """
+        Returns [(rsid, variant_id), ...] for variants whose rsid or chr-pos-ref-alt starts with `prefix`.
+        If `chrom` and `pos` are given without alleles, the variants nearest to that position are returned instead, nearest first.
+        Lookups are binary searches over the memory-mapped variant index, so they don't depend on the number of variants.
+        """
         try:
-            if is_debug_mode(): print(f"DEBUG: chrom: {chrom}, pos: {pos}")
-
             if chrom and pos:
-                pos_window = 10
-                pos_min = int(pos) - pos_window
-                pos_max = int(pos) + pos_window
-                exact = prefix
-                like_pattern = prefix + "%"
-                cur.execute("""
-                    SELECT rsid, variant_id FROM variants
-                    WHERE chrom = ? and variant_id = ?
-                """, (chrom, exact))
-                exact_matches = cur.fetchall()
-                if len(exact_matches) != 0:
-                    return exact_matches
-                else:
-                    similar_matches = []
-                    cur.execute("""
-                        SELECT rsid, variant_id FROM variants
-                        WHERE chrom = ? and variant_id LIKE ?
-                        AND variant_id != ?
-                        LIMIT ?
-                    """, (chrom, like_pattern, exact, max_results))
-                    similar_matches = cur.fetchall()
-                    return similar_matches
-
+                # prefix is like "1-19669", "1-19669-A" or "1-19669-A-T"
+                parts = prefix.split("-")
+                ref = parts[2] if len(parts) > 2 else ""
+                alt = parts[3] if len(parts) > 3 else ""
+                if not ref and not alt:
+                    return self.variant_index.query_nearest(chrom, int(pos), max_results)
+                return self.variant_index.query_cpra_prefix(chrom, str(pos), ref, alt, max_results)
+            elif prefix.lower().startswith("rs"):
+                return self.variant_index.query_rsid_prefix(prefix, max_results)
             else:
-                exact = prefix
-                like_pattern = prefix + "%"
-
-                cur.execute("""
-                    SELECT rsid, variant_id FROM variants
-                    WHERE rsid = ? OR variant_id = ?
-                """, (exact, exact))
-                exact_matches = cur.fetchall()
-                if len(exact_matches) != 0:
-                    return exact_matches
-                else:
-                    similar_matches = []
-
-                    cur.execute("""
-                        SELECT rsid, variant_id FROM variants
-                        WHERE (rsid LIKE ? OR variant_id LIKE ?)
-                        AND rsid != ?
-                        AND variant_id != ?
-                        LIMIT ?
-                    """, (like_pattern, like_pattern, exact, exact, max_results))
-                    similar_matches = cur.fetchall()
-
-                return similar_matches
+                parts = prefix.split("-")
+                if len(parts) >= 2:
+                    return self.variant_index.query_cpra_prefix(
+                        parts[0], parts[1], *parts[2:4], max_results=max_results
+                    )
+                return []
 
         except Exception as e:
             print(f"DEBUG: Error querying variants: {e}")
@@ -408,52 +279,5 @@ class AutocompleteLoading:
             raise e   
 
     def query_phenotypes(self, prefix, max_results=4):
-
-        try:
-            cur = self.connection.cursor()
-        except Exception as e:
-            print(f"DEBUG: Error querying phenotypes: {e}")
-            raise e
-
-        try:
-            exact = prefix
-            like_pattern = "%" + prefix + "%"
-
-            cur.execute("""
-                SELECT phenocode, phenostring FROM phenotypes_fts
-                WHERE phenostring = ?
-            """, (exact,))
-            exact_matches = cur.fetchall()
-            if len(exact_matches) != 0:
-                return exact_matches
-            else:
-                similar_matches = []
-
-                cur.execute("""
-                    SELECT phenocode, phenostring FROM phenotypes_fts
-                    WHERE (phenocode LIKE ? OR phenostring LIKE ?)
-                    AND phenocode != ?
-                    AND phenostring != ?
-                    LIMIT ?
-                """, (like_pattern, like_pattern, exact, exact, max_results))
-                similar_matches = cur.fetchall()
-                
-                search_term = prefix.strip()
-                cur.execute("""
-                    SELECT phenocode, phenostring
-                    FROM phenotypes_fts
-                    WHERE phenotypes_fts MATCH ?
-                    LIMIT ?
-                """, (f"phenocode:{search_term} OR phenostring:{search_term}", max_results))
-                similar_matches.extend(cur.fetchall())
-                if len(similar_matches) == 0:
-                    return []
-                else:
-                    return list(set(similar_matches))
-
-
-        except Exception as e:
-            print(f"DEBUG: Error querying phenotypes: {e}")
-            raise e
-    
-
+        """Returns [(phenocode, phenostring), ...], best match first. See `PhenoSearch`."""
+        return self.pheno_search.search(prefix, max_results)
@@ -0,0 +1,159 @@
+"""
+The genes of the gene BED file, as `GeneIntervals` for each chromosome.
+
+Genes of a chromosome are kept in NumPy arrays sorted by start, with the running maximum of their ends.
+The genes that overlap a position are among those in [first gene whose running max end reaches it, first gene whose start is past it),
+and both bounds are found with `np.searchsorted()`, for a whole array of positions at once.
+The loaders that annotate every variant (`add-genes`, `gather-pvalues-for-each-gene`) use `get_gene_intervals_for_chrom()`,
+and the API uses `get_gene_index()`, which is loaded once per process.
+"""
+
+from .gene_utils import get_gene_tuples, chrom_aliases
+
+import functools
+import numpy as np
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class GeneIntervals:
+    def __init__(self, intervals: Iterable[Tuple[int, int, Any]]):
+        """intervals is like [(12321, 12345, 'APOL1'), ...], in any order. `end` is exclusive."""
+        intervals = list(intervals)
+        starts = np.array([start for start, _, _ in intervals], dtype=np.int64)
+        ends = np.array([end for _, end, _ in intervals], dtype=np.int64)
+        # stable sorts, so that ties keep the order of `intervals`
+        by_start = np.argsort(starts, kind="stable")
+        self.starts = starts[by_start]
+        self.ends = ends[by_start]
+        self.data = [intervals[i][2] for i in by_start]
+        self.max_ends = np.maximum.accumulate(self.ends) if len(intervals) else self.ends
+        by_end = np.argsort(ends, kind="stable")
+        self._sorted_ends = ends[by_end]
+        idx_of_interval = np.empty(len(intervals), dtype=np.int64)
+        idx_of_interval[by_start] = np.arange(len(intervals))
+        self._idx_by_end = idx_of_interval[by_end]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get_overlapping(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns `(position_idxs, gene_idxs)`, with one element per pair of position and gene that overlaps it,
+        grouped by position in the order of `positions`. `gene_idxs` index `self.data`.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        lo = np.searchsorted(self.max_ends, positions, side="right")
+        hi = np.searchsorted(self.starts, positions, side="right")
+        counts = np.maximum(hi - lo, 0)
+        position_idxs = np.repeat(np.arange(len(positions)), counts)
+        offsets = np.arange(len(position_idxs)) - np.repeat(np.cumsum(counts) - counts, counts)
+        gene_idxs = np.repeat(lo, counts) + offsets
+        keep = self.ends[gene_idxs] > positions[position_idxs]
+        return position_idxs[keep], gene_idxs[keep]
+
+    def get_overlapping_region(self, start: int, end: int) -> np.ndarray:
+        """Returns the indexes of the genes that overlap `start`-`end`, sorted by start. Unlike `get_overlapping()`, both ends are inclusive."""
+        lo = int(np.searchsorted(self.max_ends, start, side="left"))
+        hi = int(np.searchsorted(self.starts, end, side="right"))
+        return lo + np.nonzero(self.ends[lo:hi] >= start)[0]
+
+    def get_nearest(self, positions: np.ndarray) -> np.ndarray:
+        """
+        For each position, returns the index of the gene whose start or end is closest, or -1 if there are no genes.
+        Ends are at or before the position and starts are at or after it; ties go to the start.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(self.data) == 0:
+            return np.full(len(positions), -1, dtype=np.int64)
+        before = np.searchsorted(self._sorted_ends, positions, side="right") - 1
+        after = np.searchsorted(self.starts, positions, side="left")
+        has_before = before >= 0
+        has_after = after < len(self.starts)
+        gene_before = self._idx_by_end[np.maximum(before, 0)]
+        gene_after = np.minimum(after, len(self.starts) - 1)
+        dist_before = positions - self._sorted_ends[np.maximum(before, 0)]
+        dist_after = self.starts[gene_after] - positions
+        use_before = has_before & (~has_after | (dist_before < dist_after))
+        return np.where(use_before, gene_before, np.where(has_after, gene_after, -1))
+
+
+def get_gene_intervals_for_chrom(interval_tuples: Iterable[Tuple[str, int, int, Any]]) -> Dict[str, GeneIntervals]:
+    """interval_tuples is like [('22', 12321, 12345, 'APOL1'), ...]"""
+    intervals_for_chrom: Dict[str, List[Tuple[int, int, Any]]] = {}
+    for chrom, start, end, data in interval_tuples:
+        intervals_for_chrom.setdefault(chrom, []).append((start, end, data))
+    return {chrom: GeneIntervals(intervals) for chrom, intervals in intervals_for_chrom.items()}
+
+
+class GeneIndex:
+    def __init__(self, gene_tuples):
+        self.gene_region_mapping: Dict[str, Tuple[str, int, int]] = {}
+        genes_by_chrom: Dict[str, List[Tuple[int, int, str]]] = {}
+        for chrom, start, end, genename in gene_tuples:
+            self.gene_region_mapping[genename] = (chrom, start, end)
+            genes_by_chrom.setdefault(chrom, []).append((start, end, genename))
+        # sorted, so that genes with the same start are in the order of their ends and names
+        self._chroms = {chrom: GeneIntervals(sorted(genes)) for chrom, genes in genes_by_chrom.items()}
+
+    def __len__(self) -> int:
+        return len(self.gene_region_mapping)
+
+    def get_position(self, gene: str) -> Optional[Tuple[str, int, int]]:
+        return self.gene_region_mapping.get(gene)
+
+    def _get_chrom(self, chrom: str) -> Optional[GeneIntervals]:
+        return self._chroms.get(chrom_aliases.get(chrom, chrom))
+
+    def get_overlapping(self, chrom: str, start: int, end: int) -> List[Dict]:
+        """Returns the genes overlapping `chrom`:`start`-`end` (inclusive), sorted by start."""
+        genes = self._get_chrom(chrom)
+        if genes is None or start > end:
+            return []
+        return [self._to_dict(genes, int(i), chrom) for i in genes.get_overlapping_region(start, end)]
+
+    def get_nearest(self, chrom: str, pos: int, max_results: int = 5, max_distance: Optional[int] = None) -> List[Dict]:
+        """Returns the `max_results` genes closest to `chrom`:`pos`, nearest first. Genes containing `pos` are at distance 0."""
+        genes = self._get_chrom(chrom)
+        if genes is None or max_results <= 0 or len(genes) == 0:
+            return []
+        distances = np.maximum(0, np.maximum(genes.starts - pos, pos - genes.ends))
+        if max_distance is not None:
+            candidates = np.nonzero(distances <= max_distance)[0]
+        else:
+            candidates = np.arange(len(distances))
+        if len(candidates) > max_results:
+            candidates = candidates[np.argpartition(distances[candidates], max_results - 1)[:max_results]]
+        candidates = candidates[np.lexsort((genes.starts[candidates], distances[candidates]))]
+        return [
+            dict(self._to_dict(genes, int(i), chrom), distance=int(distances[i]))
+            for i in candidates
+        ]
+
+    @staticmethod
+    def _to_dict(genes: GeneIntervals, i: int, chrom: str) -> Dict:
+        return {
+            "gene": genes.data[i],
+            "chrom": chrom_aliases.get(chrom, chrom),
+            "start": int(genes.starts[i]),
+            "end": int(genes.ends[i]),
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def get_gene_index() -> GeneIndex:
+    """Reads the gene BED file the first time it's needed in this process."""
+    return GeneIndex(get_gene_tuples())
+
+
+_test_intervals = GeneIntervals([(100, 200, "A"), (150, 1000, "B"), (300, 400, "C")])
+assert [list(x) for x in _test_intervals.get_overlapping(np.array([50, 150, 200, 350, 1000]))] == [[1, 1, 2, 3, 3], [0, 1, 1, 1, 2]]
+assert [_test_intervals.data[i] for i in _test_intervals.get_overlapping(np.array([350]))[1]] == ["B", "C"]
+assert list(_test_intervals.get_nearest(np.array([50, 1100, 1000]))) == [0, 1, 1]
+assert list(GeneIntervals([]).get_nearest(np.array([5]))) == [-1]
+del _test_intervals
+_test_index = GeneIndex([("1", 100, 200, "A"), ("1", 150, 1000, "B"), ("1", 300, 400, "C"), ("2", 10, 20, "D")])
+assert [g["gene"] for g in _test_index.get_overlapping("1", 250, 350)] == ["B", "C"]
+assert [g["gene"] for g in _test_index.get_overlapping("chr1", 1001, 2000)] == []
+assert [(g["gene"], g["distance"]) for g in _test_index.get_nearest("1", 1100, max_results=2)] == [("B", 100), ("C", 700)]
+assert [g["gene"] for g in _test_index.get_nearest("1", 1100, max_distance=50)] == []
+del _test_index
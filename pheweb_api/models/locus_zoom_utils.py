@@ -1,17 +1,28 @@
-from typing import List, Dict, Optional, Any, Iterator
+from typing import List, Dict, Optional, Any, Iterable, Iterator, Tuple
 from pheweb_api import parse_utils
 from flask import current_app
 import math
 from contextlib import contextmanager
-from ..conf import get_pheweb_data_dir
+from ..conf import get_pheweb_data_dir, get_manhattan_peak_variant_counting_pval_threshold
 
 
+import array
 import itertools
+import concurrent.futures
 import gzip
 import io
 import csv
 import os
 import pysam
+import numpy as np
+
+# Used by `max_points` thinning of region views.
+NUM_QVAL_BINS = 16
+MAX_QVAL = 1000  # -log10(pval) used when pval == 0
+
+# Used by multi-pheno region views.
+MAX_REGION_WORKERS = 8
+SHARED_REGION_FIELDS = ["id", "chr", "position", "end", "ref", "alt", "rsid", "nearest_genes", "consequence"]
 
 csv.register_dialect(
     "pheweb-internal-dialect",
@@ -53,12 +64,88 @@ class _Get_Pheno_Region:
         return dataframe
 
     @staticmethod
-    def get_pheno_region(
-        phenocode: str, chrom: str, pos_start: int, pos_end: int
-    ) -> dict:
+    def _thin_variants(
+        positions: np.ndarray, pvals: np.ndarray, max_points: int
+    ) -> np.ndarray:
+        """
+        Returns the sorted indices of the `max_points` variants to keep (or of all of them, if there are fewer).
+        The significant variants and the strongest variants are kept first, strongest first.
+        The rest are binned by (position, -log10(pval)), and the budget that's left is filled with the strongest variant of each bin,
+        then the second-strongest of each bin, and so on.
+        """
+        qvals = np.full(len(pvals), MAX_QVAL, dtype=np.float64)
+        nonzero = pvals > 0
+        qvals[nonzero] = -np.log10(pvals[nonzero])
+        by_strength = np.argsort(-qvals, kind="stable")
+
+        # the significant variants are the strongest ones, so they're a prefix of `by_strength`, like the top ones.
+        num_significant = int((pvals <= get_manhattan_peak_variant_counting_pval_threshold()).sum())
+        num_top = max(1, max_points // 10)
+        num_first = min(max_points, max(num_significant, num_top))
+        keep = np.zeros(len(pvals), dtype=bool)
+        keep[by_strength[:num_first]] = True
+
+        budget = max_points - num_first
+        if budget <= 0:
+            return np.flatnonzero(keep)
+
+        # Each bin is a cell of a (position x qval) grid with about `budget` cells.
+        num_qval_bins = min(NUM_QVAL_BINS, budget)
+        num_pos_bins = max(1, budget // num_qval_bins)
+        pos_min, pos_max = positions.min(), positions.max()
+        pos_bins = ((positions - pos_min) * num_pos_bins // max(1, pos_max - pos_min + 1)).astype(np.int64)
+        max_qval = qvals.max()
+        if max_qval > 0:
+            qval_bins = np.minimum((qvals / max_qval * num_qval_bins).astype(np.int64), num_qval_bins - 1)
+        else:
+            qval_bins = np.zeros(len(qvals), dtype=np.int64)
+        bins = pos_bins * num_qval_bins + qval_bins
+
+        candidates = np.flatnonzero(~keep)
+        # order candidates by bin, strongest first within each bin, and rank them within their bin.
+        order = candidates[np.lexsort((-qvals[candidates], bins[candidates]))]
+        is_first_in_bin = np.ones(len(order), dtype=bool)
+        is_first_in_bin[1:] = bins[order][1:] != bins[order][:-1]
+        idxs = np.arange(len(order))
+        rank_in_bin = idxs - np.maximum.accumulate(np.where(is_first_in_bin, idxs, 0))
+        # take every bin's strongest variant before any bin's second-strongest, and stronger bins first.
+        keep[order[np.lexsort((-qvals[order], rank_in_bin))][:budget]] = True
+        return np.flatnonzero(keep)
+
+    @staticmethod
+    def _get_region_variants(
+        phenocode: str, chrom: str, pos_start: int, pos_end: int, max_points: Optional[int] = None
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """returns (variants, number of variants in the region before thinning)"""
         variants = []
         with IndexedVariantFileReader(phenocode) as reader:
-            for v in reader.get_region(chrom, pos_start, pos_end + 1):
+            rows: Iterable[List[str]] = reader.get_region_rows(chrom, pos_start, pos_end + 1)
+            num_variants = None
+            if max_points:
+                # Only keep `pos` and `pval` of every row (and the first rows, in case there are at most `max_points`),
+                # and then fetch the region again for the rows we keep.
+                pos_idx, pval_idx = reader.get_colidx("pos"), reader.get_colidx("pval")
+                positions, pvals = array.array("q"), array.array("d")
+                first_rows: Optional[List[List[str]]] = []
+                for row in rows:
+                    positions.append(int(row[pos_idx]))
+                    pvals.append(float(row[pval_idx]) if row[pval_idx] != "" else 1.0)
+                    if first_rows is not None:
+                        first_rows.append(row)
+                        if len(first_rows) > max_points:
+                            first_rows = None
+                num_variants = len(positions)
+                if first_rows is not None:
+                    rows = first_rows
+                else:
+                    idxs_to_keep = _Get_Pheno_Region._thin_variants(
+                        np.frombuffer(positions, dtype=np.int64), np.frombuffer(pvals, dtype=np.float64), max_points
+                    )
+                    rows = _Get_Pheno_Region._select_rows(
+                        reader.get_region_rows(chrom, pos_start, pos_end + 1), idxs_to_keep
+                    )
+            for row in rows:
+                v = reader._parse_variant_row(row)
                 v["id"] = "{chrom}:{pos}_{ref}/{alt}".format(**v)
                 # TODO: change JS to make these unnecessary
                 v["end"] = v["pos"]
@@ -67,6 +154,36 @@ class _Get_Pheno_Region:
                 _Get_Pheno_Region._rename(v, "rsids", "rsid")
                 _Get_Pheno_Region._rename(v, "pval", "pvalue")
                 variants.append(v)
+        return variants, len(variants) if num_variants is None else num_variants
+
+    @staticmethod
+    def _select_rows(rows: Iterable[List[str]], sorted_idxs: np.ndarray) -> Iterator[List[str]]:
+        """yields the rows at `sorted_idxs`, reading no further than the last one"""
+        idxs = iter(sorted_idxs.tolist())
+        next_idx = next(idxs, None)
+        for idx, row in enumerate(rows):
+            if next_idx is None:
+                return
+            if idx == next_idx:
+                yield row
+                next_idx = next(idxs, None)
+
+    @staticmethod
+    def _thinning_info(max_points: int, num_variants: int, num_returned: int) -> Dict[str, Any]:
+        return {
+            "max_points": max_points,
+            "num_variants": num_variants,
+            "num_returned": num_returned,
+            "is_thinned": num_returned < num_variants,
+        }
+
+    @staticmethod
+    def get_pheno_region(
+        phenocode: str, chrom: str, pos_start: int, pos_end: int, max_points: Optional[int] = None
+    ) -> dict:
+        variants, num_variants = _Get_Pheno_Region._get_region_variants(
+            phenocode, chrom, pos_start, pos_end, max_points
+        )
 
         df = _Get_Pheno_Region._dataframify(variants)
 
@@ -74,13 +191,76 @@ class _Get_Pheno_Region:
 
         df["max_log10p"] = max_log10p
 
-        return {
+        response = {
             "data": df,
             "lastpage": None,
         }
+        if max_points:
+            response["thinning"] = _Get_Pheno_Region._thinning_info(max_points, num_variants, len(variants))
+        return response
+
+    @staticmethod
+    def get_multi_pheno_region(
+        phenocodes: List[str], chrom: str, pos_start: int, pos_end: int, max_points: Optional[int] = None
+    ) -> dict:
+        """
+        Fetches the region for several phenocodes (each including its stratification suffix) concurrently.
+        Returns one columnar payload: per-variant columns (see SHARED_REGION_FIELDS) are sent once in `data`,
+        and each pheno in `phenos` only has its per-association columns, aligned to `data`.
+        Missing associations are `None`.
+        """
+        num_workers = max(1, min(len(phenocodes), MAX_REGION_WORKERS))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(
+                lambda phenocode: _Get_Pheno_Region._get_region_variants(
+                    phenocode, chrom, pos_start, pos_end, max_points
+                ),
+                phenocodes,
+            ))
+
+        # Union of all variants, ordered by position.
+        shared_for_variant: Dict[str, Dict[str, Any]] = {}
+        for variants, _ in results:
+            for v in variants:
+                if v["id"] not in shared_for_variant:
+                    shared_for_variant[v["id"]] = {k: v[k] for k in SHARED_REGION_FIELDS if k in v}
+        variant_ids = sorted(
+            shared_for_variant,
+            key=lambda variant_id: (shared_for_variant[variant_id]["position"], variant_id),
+        )
+        row_for_variant = {variant_id: idx for idx, variant_id in enumerate(variant_ids)}
+
+        phenos = []
+        for phenocode, (variants, num_variants) in zip(phenocodes, results):
+            assoc_fields = sorted(
+                set(itertools.chain.from_iterable(variants)) - set(SHARED_REGION_FIELDS)
+            )
+            columns: Dict[str, list] = {field: [None] * len(variant_ids) for field in assoc_fields}
+            for v in variants:
+                row = row_for_variant[v["id"]]
+                for field in assoc_fields:
+                    columns[field][row] = v.get(field)
+            pvals = [v["pvalue"] for v in variants if v["pvalue"] != ""]
+            pheno = {
+                "phenocode": phenocode,
+                "data": columns,
+                "max_log10p": -math.log10(min(pvals)) if pvals and min(pvals) > 0 else None,
+            }
+            if max_points:
+                pheno["thinning"] = _Get_Pheno_Region._thinning_info(max_points, num_variants, len(variants))
+            phenos.append(pheno)
+
+        return {
+            "data": _Get_Pheno_Region._dataframify(
+                [shared_for_variant[variant_id] for variant_id in variant_ids]
+            ),
+            "phenos": phenos,
+            "lastpage": None,
+        }
 
 
 get_pheno_region = _Get_Pheno_Region.get_pheno_region
+get_multi_pheno_region = _Get_Pheno_Region.get_multi_pheno_region
 
 
 @contextmanager
@@ -109,6 +289,9 @@ class _ivfr:
         self._tabix_file = _tabix_file
         self._colidxs = _colidxs
 
+    def get_colidx(self, field: str) -> int:
+        return self._colidxs[field]
+
     def _parse_variant_row(self, variant_row: List[str]) -> Dict[str, Any]:
         variant = {}
         for field in self._colidxs:
@@ -126,12 +309,9 @@ class _ivfr:
                 # raise PheWebError('ERROR: Failed to parse the value {!r} for field {!r} in file {!r}'.format(val, field, self._tabix_file.filename)) from exc
         return variant
 
-    def get_region(self, chrom: str, start: int, end: int) -> Iterator[Dict[str, Any]]:
+    def get_region_rows(self, chrom: str, start: int, end: int) -> Iterator[List[str]]:
         """
-        includes `start`, does not include `end`
-        return is like [{
-              'chrom': 'X', 'pos': 43254, ...,
-            }, ...]
+        Like `get_region`, but yields the unparsed rows.
         """
         if start < 1:
             start = 1
@@ -152,10 +332,16 @@ class _ivfr:
                     chrom, start - 1, end - 1, self._tabix_file.filename
                 )
             ) from exc
-        reader: Iterator[List[str]] = csv.reader(
-            tabix_iter, dialect="pheweb-internal-dialect"
-        )
-        for variant_row in reader:
+        yield from csv.reader(tabix_iter, dialect="pheweb-internal-dialect")
+
+    def get_region(self, chrom: str, start: int, end: int) -> Iterator[Dict[str, Any]]:
+        """
+        includes `start`, does not include `end`
+        return is like [{
+              'chrom': 'X', 'pos': 43254, ...,
+            }, ...]
+        """
+        for variant_row in self.get_region_rows(chrom, start, end):
             yield self._parse_variant_row(variant_row)
 
     def get_variant(
@@ -1,16 +1,19 @@
-from .locus_zoom_utils import get_pheno_region
+from .locus_zoom_utils import get_pheno_region, get_multi_pheno_region
 # from flask import current_app, send_from_directory, send_file
 from flask import send_from_directory
-from .gene_utils import get_gene_tuples
+from .gene_index import get_gene_index
 from .download_utils import getDownloadFunction
 
 import sqlite3
 import os
+import re
 import json
 from .variant import PhewasMatrixReader
+from .variant_index import load_variant_index, get_index_dir
 from .gwas_missing import SNPFetcher
 import gzip
 from ..conf import get_pheweb_data_dir
+from ..utils import get_phenocode_with_stratifications
 
 """
 My eventual aspiration is to have an SQLite3 database for all these 
@@ -23,6 +26,8 @@ In addition, these classes allow pre-loading of most data, thereby only having l
 for the query part (again, in theory)
 """
 
+RESOLVE_BATCH_SIZE = 10_000
+
 
 class Tophits:
     def __init__(self, data):
@@ -36,6 +41,7 @@ class Genes:
     def __init__(self, data=None, **kwargs: dict):
         self.data = data
         self.gene_region_mapping = kwargs["gene_region_mapping"]
+        self.gene_index = kwargs["gene_index"]
 
     def connect_to_sqlite(self):
         # connect to sqlite3 database of best-phenos-by-gene
@@ -47,33 +53,69 @@ class Genes:
         connection.row_factory = sqlite3.Row  # each row as dictionary
         return connection
 
-    def get_genes_table(self, gene):
-        # get best phenos for the selected gene
-        connection = self.connect_to_sqlite()
-        cursor = connection.cursor()
-        cursor.execute(f"SELECT * FROM best_phenos_for_each_gene WHERE gene='{gene}'")
-        results = cursor.fetchone()
-        connection.close()
+    def get_genes_table(self, gene, max_pval=None, stratifications=None, limit=None, offset=0):
+        """
+        Returns {"gene", "total", "offset", "limit", "data"} for the associations of `gene` that pass the filters, best p-value first,
+        or None if the gene has no associations at all.
+        "data" is a generator of each association already encoded as JSON, so a page is streamed without decoding it.
+        """
+        where = ["gene = ?"]
+        params = [gene]
+        if max_pval is not None:
+            where.append("pval <= ?")
+            params.append(max_pval)
+        if stratifications:
+            where.append("stratification IN ({})".format(",".join("?" * len(stratifications))))
+            params.extend(stratification.lstrip(".") for stratification in stratifications)
+        where_clause = " AND ".join(where)
 
-        if results:
-            data = json.loads(results["json"])
-            response = {
-                "gene": gene,
-                "data": data,
-            }
-            return response
-        else:
-            pass
+        connection = self.connect_to_sqlite()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT num_associations FROM genes WHERE gene = ?", (gene,))
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute(f"SELECT COUNT(*) FROM gene_associations WHERE {where_clause}", params)
+            total = cursor.fetchone()[0]
+        finally:
+            connection.close()
+
+        def iter_json():
+            connection = self.connect_to_sqlite()
+            try:
+                cursor = connection.execute(
+                    f"SELECT json FROM gene_associations WHERE {where_clause} ORDER BY pval, phenocode LIMIT ? OFFSET ?",
+                    params + [-1 if limit is None else limit, offset],
+                )
+                for row in cursor:
+                    yield row[0]
+            finally:
+                connection.close()
+
+        return {
+            "gene": gene,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "data": iter_json(),
+        }
 
     def get_gene_position(self, gene):
-        chrom, start, end = self.gene_region_mapping[gene]
+        chrom, start, end = self.gene_region_mapping.get(gene, (None, None, None))
 
         return chrom, start, end
 
+    def get_genes_in_region(self, region):
+        chrom, start, end = Pheno._parse_region(region)
+        return self.gene_index.get_overlapping(chrom, start, end)
+
+    def get_genes_near(self, chrom, pos, max_results=5, max_distance=None):
+        return self.gene_index.get_nearest(chrom, pos, max_results=max_results, max_distance=max_distance)
+
     def get_gene_names(self):
         connection = self.connect_to_sqlite()
         cursor = connection.cursor()
-        cursor.execute("SELECT gene FROM best_phenos_for_each_gene")
+        cursor.execute("SELECT gene FROM genes")
         results = cursor.fetchall()
         connection.close()
 
@@ -84,7 +126,7 @@ class Genes:
         # Fetch all gene names from the sqlite3 database
         connection = self.connect_to_sqlite()
         cursor = connection.cursor()
-        cursor.execute("SELECT gene FROM best_phenos_for_each_gene")
+        cursor.execute("SELECT gene FROM genes")
         results = cursor.fetchall()
         connection.close()
 
@@ -169,16 +211,41 @@ class Pheno:
         
         return download_function
 
-    def get_region(self, phenocode, stratification, region):
+    def get_region(self, phenocode, stratification, region, max_points=None):
         if stratification:
             phenocode += stratification
 
+        chrom, pos_start, pos_end = self._parse_region(region)
+
+        return get_pheno_region(phenocode, chrom, pos_start, pos_end, max_points=max_points)
+
+    def has_pheno(self, phenocode, stratification):
+        """Returns whether `phenocode` was loaded with `stratification` (eg, ".european.male"), which is None for unstratified phenos."""
+        if not hasattr(self, "_pheno_names"):
+            self._pheno_names = {
+                get_phenocode_with_stratifications(pheno) if "stratification" in pheno else pheno["phenocode"]
+                for pheno in self.phenotypes_list
+            }
+        return phenocode + (stratification or "") in self._pheno_names
+
+    def get_multi_region(self, phenos, region, max_points=None):
+        # phenos is like [{"phenocode": "X", "stratification": ".european.male"}, ...]
+        phenocodes = [
+            pheno["phenocode"] + (pheno.get("stratification") or "") for pheno in phenos
+        ]
+        chrom, pos_start, pos_end = self._parse_region(region)
+
+        response = get_multi_pheno_region(phenocodes, chrom, pos_start, pos_end, max_points=max_points)
+        for pheno, pheno_region in zip(phenos, response["phenos"]):
+            pheno_region["phenocode"] = pheno["phenocode"]
+            pheno_region["stratification"] = pheno.get("stratification")
+        return response
+
+    @staticmethod
+    def _parse_region(region):
         chrom, part2_and_part3 = region.split(":")
         pos_start, pos_end = part2_and_part3.split("-")
-        pos_start = int(pos_start)
-        pos_end = int(pos_end)
-
-        return get_pheno_region(phenocode, chrom, pos_start, pos_end)
+        return chrom, int(pos_start), int(pos_end)
 
     def get_gwas_missing(self, gwas_missing_data):
         #print(f"{gwas_missing_data=}")
@@ -213,44 +280,71 @@ class Variant:
         return response
     
     def get_nearest_genes(self, variant_code):
-        try:
-            db_path = os.path.join(get_pheweb_data_dir(), "sites", "variants.db")
-            conn = sqlite3.connect(db_path)
-            cur = conn.cursor()
-            cur.execute("SELECT nearest_genes FROM variants WHERE variant_id = ?", (variant_code,))
-            nearest_genes = cur.fetchone()[0].split(",")
-            print("DEBUG: nearest_genes", nearest_genes)
-            print("DEBUG: type of nearest_genes", type(nearest_genes))
-            conn.close()
-            return {"nearest_genes": nearest_genes} if nearest_genes else None
-        except Exception as e:
-            print("DEBUG: error", e)
-            return {}
+        variant_index = load_variant_index(get_index_dir(os.path.join(get_pheweb_data_dir(), "sites")))
+        row = variant_index.find_row(variant_code)
+        nearest_genes = variant_index.get_nearest_genes(row) if row is not None else []
+        return {"nearest_genes": nearest_genes} if nearest_genes else {}
     
     def get_variant_rsid(self, variant_code):
-        try:
-            db_path = os.path.join(get_pheweb_data_dir(), "sites", "autocomplete.db")
-            conn = sqlite3.connect(db_path)
-            cur = conn.cursor()
-            cur.execute("SELECT rsid FROM variants WHERE variant_id = ?", (variant_code,))
-            rsid = cur.fetchone()
-            print("DEBUG: rsid", rsid)
-            print("DEBUG: type of rsid", type(rsid))
-            conn.close()
-            return {"rsid": rsid} if rsid else None
-        except Exception as e:
-            print("DEBUG: error", e)
-            return {}
+        variant_index = load_variant_index(get_index_dir(os.path.join(get_pheweb_data_dir(), "sites")))
+        row = variant_index.find_row(variant_code)
+        if row is None:
+            return None
+        return {"rsid": [variant_index.get_rsid(row)]}
+
+    def resolve_variants(self, queries, batch_size=RESOLVE_BATCH_SIZE):
+        """
+        Resolves rsids to chr-pos-ref-alt and chr-pos-ref-alt to rsids, yielding one dict per query, in order.
+        Queries are looked up `batch_size` at a time with vectorized searches over the variant index.
+        """
+        variant_index = load_variant_index(get_index_dir(os.path.join(get_pheweb_data_dir(), "sites")))
+        for batch_start in range(0, len(queries), batch_size):
+            batch = queries[batch_start : batch_start + batch_size]
+            parsed = [_parse_variant_query(query) for query in batch]
+
+            rsid_idxs = [i for i, (kind, _) in enumerate(parsed) if kind == "rsid"]
+            cpra_idxs = [i for i, (kind, _) in enumerate(parsed) if kind == "cpra"]
+            rows_by_idx = {}
+            for i, rows in zip(rsid_idxs, variant_index.resolve_rsids([parsed[i][1] for i in rsid_idxs])):
+                rows_by_idx[i] = rows
+            for i, row in zip(cpra_idxs, variant_index.resolve_variant_ids([parsed[i][1] for i in cpra_idxs])):
+                rows_by_idx[i] = [row] if row is not None else []
+
+            for i, query in enumerate(batch):
+                yield {
+                    "query": query,
+                    "type": parsed[i][0],
+                    "matches": [
+                        {
+                            "variant_id": variant_index.get_variant_id(row),
+                            "rsids": variant_index.get_rsids(row),
+                        }
+                        for row in rows_by_idx.get(i, [])
+                    ],
+                }
 
 
+def _parse_variant_query(query):
+    """Returns ("rsid", "rs123"), ("cpra", (chrom, pos, ref, alt)) or ("unknown", None)."""
+    query = query.strip() if isinstance(query, str) else ""
+    if query.lower().startswith("rs") and query[2:].isdigit():
+        return "rsid", query.lower()
+    parts = re.split(r"[-:_/]", query)
+    if len(parts) == 4 and parts[1].isdigit():
+        chrom = parts[0][3:] if parts[0].lower().startswith("chr") else parts[0]
+        return "cpra", (chrom.upper(), int(parts[1]), parts[2].upper(), parts[3].upper())
+    return "unknown", None
 
-def create_genes() -> Genes:
-    gene_region_mapping = {
-        genename: (chrom, pos1, pos2)
-        for chrom, pos1, pos2, genename in get_gene_tuples()
-    }
 
-    return Genes(gene_region_mapping=gene_region_mapping)
+assert _parse_variant_query(" RS123 ") == ("rsid", "rs123")
+assert _parse_variant_query("chr1:19669:a:t") == ("cpra", ("1", 19669, "A", "T"))
+assert _parse_variant_query("1-19669-A") == ("unknown", None)
+
+
+
+def create_genes() -> Genes:
+    gene_index = get_gene_index()
+    return Genes(gene_region_mapping=gene_index.gene_region_mapping, gene_index=gene_index)
 
 
 def create_tophits() -> Tophits:
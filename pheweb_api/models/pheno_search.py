@@ -0,0 +1,203 @@
+"""
+Ranked, typo-tolerant phenotype search over the FTS5 tables of `autocomplete.db`.
+
+Each keystroke runs at most two bounded queries:
+  1. a prefix query on `phenotypes_fts`, where every typed token must be a prefix of a token in the phenocode or phenostring,
+     ranked by bm25, with exact matches moved first;
+  2. only if (1) returns too few results, a fuzzy query on `phenotypes_trigram` (FTS5's trigram tokenizer),
+     ranked by the fraction of the typed trigrams that match.
+
+Results are cached per normalized query. While the user keeps typing, a complete (ie, not truncated) result for
+an earlier prefix of the query is filtered in Python instead of querying SQLite again.
+"""
+
+from ..conf import is_debug_mode
+
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+NUM_CANDIDATES = 50
+MIN_TRIGRAM_SIMILARITY = 0.3
+CACHE_SIZE = 4096
+
+_token_re = re.compile(r"[^\W_]+")
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases `query` and keeps only the characters that the FTS5 tokenizers index, so it is safe to put in MATCH."""
+    return " ".join(_token_re.findall(query.lower()))
+
+
+assert normalize_query('  Type-2 "Diabetes"* ') == "type 2 diabetes"
+assert normalize_query("CCC_MACDEG_COM") == "ccc macdeg com"
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {
+        token[i : i + 3]
+        for token in text.split()
+        for i in range(len(token) - 2)
+    }
+
+
+def create_pheno_search_tables(conn: sqlite3.Connection) -> None:
+    """Creates the FTS5 tables over `phenotypes` that don't exist yet and (re)builds them."""
+    cur = conn.cursor()
+    existing = {
+        row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    }
+    if "phenotypes_fts" not in existing:
+        if is_debug_mode(): print("DEBUG: Creating phenotypes_fts virtual table")
+        cur.execute("""
+            CREATE VIRTUAL TABLE phenotypes_fts USING fts5(
+                phenocode,
+                phenostring,
+                content='phenotypes',
+                content_rowid='rowid'
+            )
+        """)
+        cur.execute("INSERT INTO phenotypes_fts(phenotypes_fts) VALUES ('rebuild')")
+    if "phenotypes_trigram" not in existing:
+        if is_debug_mode(): print("DEBUG: Creating phenotypes_trigram virtual table")
+        try:
+            cur.execute("""
+                CREATE VIRTUAL TABLE phenotypes_trigram USING fts5(
+                    phenocode,
+                    phenostring,
+                    content='phenotypes',
+                    content_rowid='rowid',
+                    tokenize='trigram'
+                )
+            """)
+            cur.execute("INSERT INTO phenotypes_trigram(phenotypes_trigram) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            # the trigram tokenizer needs SQLite >= 3.34; search still works, just without typo tolerance
+            print(f"Warning: fuzzy phenotype search is disabled because phenotypes_trigram could not be created: {e}")
+    conn.commit()
+
+
+class PhenoSearch:
+    def __init__(self, get_connection: Callable[[], sqlite3.Connection]):
+        self._get_connection = get_connection
+        self._has_trigram: Optional[bool] = None
+        # normalized query -> (prefix matches, whether they are all of the matches)
+        self._cache: "OrderedDict[str, Tuple[List[Tuple[str, str]], bool]]" = OrderedDict()
+        self._fuzzy_cache: Dict[str, List[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def search(self, query: str, max_results: int = 4) -> List[Tuple[str, str]]:
+        """Returns [(phenocode, phenostring), ...], best match first."""
+        normalized = normalize_query(query)
+        if not normalized:
+            return []
+        candidates, _ = self._get_prefix_matches(normalized)
+        results = candidates[:max_results]
+        if len(results) < max_results:
+            seen = {phenocode for phenocode, _ in results}
+            for match in self._get_fuzzy_matches(normalized):
+                if match[0] not in seen:
+                    results.append(match)
+                    seen.add(match[0])
+                    if len(results) >= max_results:
+                        break
+        return results
+
+    def _get_prefix_matches(self, normalized: str) -> Tuple[List[Tuple[str, str]], bool]:
+        with self._lock:
+            if normalized in self._cache:
+                self._cache.move_to_end(normalized)
+                return self._cache[normalized]
+            reusable = self._find_complete_prefix_entry(normalized)
+        if reusable is not None:
+            entry = (self._filter(reusable, normalized), True)
+        else:
+            entry = self._query_prefix_matches(normalized)
+        with self._lock:
+            self._cache[normalized] = entry
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return entry
+
+    def _find_complete_prefix_entry(self, normalized: str) -> Optional[List[Tuple[str, str]]]:
+        """Returns the cached matches of the longest earlier prefix of `normalized` whose matches weren't truncated."""
+        for end in range(len(normalized) - 1, 0, -1):
+            entry = self._cache.get(normalized[:end])
+            if entry is not None and entry[1]:
+                return entry[0]
+        return None
+
+    @staticmethod
+    def _filter(candidates: List[Tuple[str, str]], normalized: str) -> List[Tuple[str, str]]:
+        """Keeps the candidates that match every token of `normalized` as a prefix, like the FTS5 prefix query does."""
+        query_tokens = normalized.split()
+        filtered = []
+        for phenocode, phenostring in candidates:
+            tokens = _token_re.findall("{} {}".format(phenocode, phenostring).lower())
+            if all(any(token.startswith(q) for token in tokens) for q in query_tokens):
+                filtered.append((phenocode, phenostring))
+        filtered.sort(key=lambda match: not _is_exact(match, normalized))
+        return filtered
+
+    def _query_prefix_matches(self, normalized: str) -> Tuple[List[Tuple[str, str]], bool]:
+        match_expr = " ".join('"{}"*'.format(token) for token in normalized.split())
+        cur = self._get_connection().cursor()
+        cur.execute("""
+            SELECT p.phenocode, p.phenostring
+            FROM phenotypes_fts
+            JOIN phenotypes AS p ON p.rowid = phenotypes_fts.rowid
+            WHERE phenotypes_fts MATCH ?
+            ORDER BY bm25(phenotypes_fts, 2.0, 1.0)
+            LIMIT ?
+        """, (match_expr, NUM_CANDIDATES + 1))
+        rows = [(phenocode, phenostring) for phenocode, phenostring in cur.fetchall()]
+        rows.sort(key=lambda match: not _is_exact(match, normalized))  # exact matches first, then bm25
+        return rows[:NUM_CANDIDATES], len(rows) <= NUM_CANDIDATES
+
+    def _get_fuzzy_matches(self, normalized: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            if normalized in self._fuzzy_cache:
+                return self._fuzzy_cache[normalized]
+        matches = self._query_fuzzy_matches(normalized)
+        with self._lock:
+            if len(self._fuzzy_cache) >= CACHE_SIZE:
+                self._fuzzy_cache.clear()
+            self._fuzzy_cache[normalized] = matches
+        return matches
+
+    def _query_fuzzy_matches(self, normalized: str) -> List[Tuple[str, str]]:
+        query_trigrams = _trigrams(normalized)
+        if not query_trigrams or not self._trigram_table_exists():
+            return []
+        match_expr = " OR ".join('"{}"'.format(trigram) for trigram in sorted(query_trigrams))
+        cur = self._get_connection().cursor()
+        cur.execute("""
+            SELECT p.phenocode, p.phenostring
+            FROM phenotypes_trigram
+            JOIN phenotypes AS p ON p.rowid = phenotypes_trigram.rowid
+            WHERE phenotypes_trigram MATCH ?
+            ORDER BY bm25(phenotypes_trigram, 2.0, 1.0)
+            LIMIT ?
+        """, (match_expr, NUM_CANDIDATES))
+        scored = []
+        for phenocode, phenostring in cur.fetchall():
+            text = " ".join(_token_re.findall("{} {}".format(phenocode, phenostring).lower()))
+            similarity = len(query_trigrams & _trigrams(text)) / len(query_trigrams)
+            if similarity >= MIN_TRIGRAM_SIMILARITY:
+                scored.append((similarity, phenocode, phenostring))
+        scored.sort(key=lambda x: -x[0])  # stable, so ties keep the bm25 order
+        return [(phenocode, phenostring) for _, phenocode, phenostring in scored]
+
+    def _trigram_table_exists(self) -> bool:
+        if self._has_trigram is None:
+            cur = self._get_connection().cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='phenotypes_trigram'")
+            self._has_trigram = cur.fetchone() is not None
+        return self._has_trigram
+
+
+def _is_exact(match: Tuple[str, str], normalized: str) -> bool:
+    return normalize_query(match[0]) == normalized or normalize_query(match[1]) == normalized
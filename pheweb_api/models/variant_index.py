@@ -0,0 +1,460 @@
+"""
+A compact, memory-mapped store of every variant in `sites/sites.tsv`, used for autocomplete, rsid <-> chr-pos-ref-alt, nearest genes
+and by `augment-phenos` to annotate each phenotype without re-reading `sites.tsv`.
+
+The store lives in `sites/variant-index/` and is built by `pheweb2 make-variant-index` (or `pheweb2 generate-autocomplete-db`).
+Every file is a `.npy` array that is opened with `mmap_mode="r"`, so a lookup only touches the pages it needs,
+and every API worker shares the same pages.
+
+Variants are kept in the same order as `sites.tsv`, ie sorted by (chrom_idx, pos):
+    chrom_idx.npy              uint8   index into `chrom_order_list`
+    pos.npy                    uint32
+    ref.npy, alt.npy           uint16 or uint32, index into the allele dictionary
+    nearest_genes.npy          uint16 or uint32, index into the nearest-genes dictionary
+    rsids.npy                  uint64  numeric part of every rsid, in variant order
+    rsids_offsets.npy          uint64  variant `i` has rsids `rsids[rsids_offsets[i]:rsids_offsets[i+1]]`
+Every rsid is also indexed by value:
+    rsid_sorted.npy            uint64  sorted numeric rsids
+    rsid_rows.npy              uint64  the variant (row) that each entry of `rsid_sorted` belongs to
+Dictionaries are concatenated strings with offsets:
+    alleles_dict.npy, alleles_dict_offsets.npy
+    nearest_genes_dict.npy, nearest_genes_dict_offsets.npy
+
+Prefixes of numbers are ranges of numbers, so prefix lookups are a few `np.searchsorted()` calls:
+"rs12" matches rsids in [12, 13), [120, 130), [1200, 1300), ...
+"1-19669" matches positions on chromosome 1 in [19669, 19670), [196690, 196700), ...
+Positions are sorted within each chromosome, so the variants nearest to a position are next to its insertion point.
+"""
+
+from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
+from ..file_utils import read_maybe_gzip
+
+import os
+import csv
+import json
+import array
+import shutil
+import functools
+import threading
+import numpy as np
+from typing import Dict, List, Tuple, Iterator, Optional, Sequence
+
+
+INDEX_FORMAT_VERSION = 3
+MAX_UINT32 = 2**32 - 1
+ARRAY_NAMES = [
+    "chrom_idx",
+    "pos",
+    "ref",
+    "alt",
+    "nearest_genes",
+    "rsids",
+    "rsids_offsets",
+    "rsid_sorted",
+    "rsid_rows",
+    "alleles_dict",
+    "alleles_dict_offsets",
+    "nearest_genes_dict",
+    "nearest_genes_dict_offsets",
+]
+
+
+def get_index_dir(sites_dir: str) -> str:
+    return os.path.join(sites_dir, "variant-index")
+
+
+class _StringDictionary:
+    """Assigns consecutive codes to strings, to store each distinct string once."""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+
+    def encode(self, string: str) -> int:
+        code = self.codes.get(string)
+        if code is None:
+            code = self.codes[string] = len(self.codes)
+        return code
+
+    def to_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        encoded = [string.encode("utf-8") for string in self.codes]  # dicts keep insertion order, ie code order
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+    def code_dtype(self) -> type:
+        return np.uint16 if len(self.codes) <= 2**16 else np.uint32
+
+
+def build_variant_index(sites_filepath: str, index_dir: str) -> int:
+    """Builds the index from `sites.tsv` into `index_dir` and returns the number of variants."""
+    chrom_idxs = array.array("B")
+    positions = array.array("I")
+    refs = array.array("I")
+    alts = array.array("I")
+    nearest_genes = array.array("I")
+    rsids = array.array("Q")
+    rsids_offsets = array.array("Q", [0])
+    rsid_rows = array.array("Q")
+    alleles_dict = _StringDictionary()
+    nearest_genes_dict = _StringDictionary()
+    rsids_are_exact = True  # whether the rsids column can be rebuilt from the numeric rsids
+
+    with read_maybe_gzip(sites_filepath) as f:
+        reader = csv.reader(f, delimiter="\t")
+        fields = next(reader)
+        fields[0] = fields[0].lstrip("#")
+        chrom_col, pos_col, ref_col, alt_col, rsids_col, genes_col = (
+            fields.index(field) for field in ["chrom", "pos", "ref", "alt", "rsids", "nearest_genes"]
+        )
+        prev_key = (-1, -1)
+        for row_num, row in enumerate(reader):
+            chrom_idx, pos = chrom_order[row[chrom_col]], int(row[pos_col])
+            if (chrom_idx, pos) < prev_key:
+                raise PheWebError(
+                    "{} is not sorted by chrom and pos: {}-{} came after {}-{}".format(
+                        sites_filepath,
+                        row[chrom_col],
+                        pos,
+                        chrom_order_list[prev_key[0]],
+                        prev_key[1],
+                    )
+                )
+            prev_key = (chrom_idx, pos)
+            chrom_idxs.append(chrom_idx)
+            positions.append(pos)
+            refs.append(alleles_dict.encode(row[ref_col]))
+            alts.append(alleles_dict.encode(row[alt_col]))
+            nearest_genes.append(nearest_genes_dict.encode(row[genes_col]))
+
+            for rsid in row[rsids_col].split(","):
+                num = _rsid_to_num(rsid)
+                if num is not None:
+                    rsids.append(num)
+                    rsid_rows.append(row_num)
+            if rsids_are_exact and row[rsids_col] != ",".join(
+                "rs{}".format(num) for num in rsids[rsids_offsets[-1] :]
+            ):
+                rsids_are_exact = False
+            rsids_offsets.append(len(rsids))
+
+    rsids_arr = np.frombuffer(rsids, dtype=np.uint64)
+    rsid_order = np.argsort(rsids_arr, kind="stable")
+    alleles_blob, alleles_offsets = alleles_dict.to_arrays()
+    genes_blob, genes_offsets = nearest_genes_dict.to_arrays()
+
+    arrays = {
+        "chrom_idx": np.frombuffer(chrom_idxs, dtype=np.uint8),
+        "pos": np.frombuffer(positions, dtype=np.uint32),
+        "ref": np.frombuffer(refs, dtype=np.uint32).astype(alleles_dict.code_dtype()),
+        "alt": np.frombuffer(alts, dtype=np.uint32).astype(alleles_dict.code_dtype()),
+        "nearest_genes": np.frombuffer(nearest_genes, dtype=np.uint32).astype(nearest_genes_dict.code_dtype()),
+        "rsids": rsids_arr,
+        "rsids_offsets": np.frombuffer(rsids_offsets, dtype=np.uint64),
+        "rsid_sorted": rsids_arr[rsid_order],
+        "rsid_rows": np.frombuffer(rsid_rows, dtype=np.uint64)[rsid_order],
+        "alleles_dict": alleles_blob,
+        "alleles_dict_offsets": alleles_offsets,
+        "nearest_genes_dict": genes_blob,
+        "nearest_genes_dict_offsets": genes_offsets,
+    }
+
+    tmp_dir = index_dir.rstrip(os.path.sep) + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), arr)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "format_version": INDEX_FORMAT_VERSION,
+                "num_variants": len(positions),
+                "sites_fields": fields,
+                "rsids_are_exact": rsids_are_exact,
+                "max_pos": max(positions, default=0),
+                "max_rsid": int(rsids_arr.max()) if len(rsids_arr) else 0,
+            },
+            f,
+        )
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.rename(tmp_dir, index_dir)
+    return len(positions)
+
+
+def _rsid_to_num(rsid: str) -> Optional[int]:
+    if rsid.startswith("rs") and rsid[2:].isdigit():
+        return int(rsid[2:])
+    return None
+
+
+def _decimal_prefix_ranges(digits: str, max_value: int) -> Iterator[Tuple[int, int]]:
+    """Yields the half-open ranges of the numbers (up to `max_value`) whose decimal representation starts with `digits`."""
+    if not digits.isdigit() or (digits.startswith("0") and digits != "0"):
+        return
+    lo, hi = int(digits), int(digits) + 1
+    while lo <= max_value:
+        yield lo, hi
+        if lo == 0:
+            return  # nothing else starts with "0"
+        lo, hi = lo * 10, hi * 10
+
+
+assert list(_decimal_prefix_ranges("12", 1500)) == [(12, 13), (120, 130), (1200, 1300)]
+assert list(_decimal_prefix_ranges("012", 1500)) == []
+
+
+class VariantIndex:
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("format_version") != INDEX_FORMAT_VERSION:
+            raise PheWebError(
+                "The variant index at {} is outdated. Rebuild it with `pheweb2 make-variant-index`.".format(
+                    index_dir
+                )
+            )
+        for name in ARRAY_NAMES:
+            setattr(
+                self,
+                "_" + name,
+                np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r"),
+            )
+        self._max_pos = self.meta["max_pos"]
+        self._max_rsid = self.meta["max_rsid"]
+
+    @staticmethod
+    def exists(index_dir: str) -> bool:
+        return os.path.exists(os.path.join(index_dir, "meta.json"))
+
+    def __len__(self) -> int:
+        return len(self._pos)
+
+    @functools.lru_cache(maxsize=65536)
+    def _get_allele(self, code: int) -> str:
+        return self._alleles_dict[
+            self._alleles_dict_offsets[code] : self._alleles_dict_offsets[code + 1]
+        ].tobytes().decode("utf-8")
+
+    def get_variant_id(self, row: int) -> str:
+        return "{}-{}-{}-{}".format(
+            chrom_order_list[self._chrom_idx[row]],
+            self._pos[row],
+            self._get_allele(int(self._ref[row])),
+            self._get_allele(int(self._alt[row])),
+        )
+
+    def get_rsids(self, row: int) -> List[str]:
+        start, end = int(self._rsids_offsets[row]), int(self._rsids_offsets[row + 1])
+        return ["rs{}".format(int(num)) for num in self._rsids[start:end]]
+
+    def get_rsid(self, row: int) -> Optional[str]:
+        """Returns the first rsid of the variant, like `sites.tsv` lists them."""
+        start, end = int(self._rsids_offsets[row]), int(self._rsids_offsets[row + 1])
+        return "rs{}".format(int(self._rsids[start])) if start < end else None
+
+    def get_nearest_genes(self, row: int) -> List[str]:
+        code = int(self._nearest_genes[row])
+        genes = self._nearest_genes_dict[
+            self._nearest_genes_dict_offsets[code] : self._nearest_genes_dict_offsets[code + 1]
+        ].tobytes().decode("utf-8")
+        return genes.split(",") if genes else []
+
+    def get_chrom_rows(self, chrom: str) -> Tuple[int, int]:
+        """Returns the half-open range of rows on `chrom`."""
+        chrom = chrom_aliases.get(chrom, chrom)
+        if chrom not in chrom_order:
+            return (0, 0)
+        chrom_idx = np.uint8(chrom_order[chrom])
+        return (
+            int(np.searchsorted(self._chrom_idx, chrom_idx, side="left")),
+            int(np.searchsorted(self._chrom_idx, chrom_idx, side="right")),
+        )
+
+    def _get_pos_rows(self, chrom: str, pos: int) -> Tuple[int, int]:
+        """Returns the half-open range of rows at `chrom`-`pos`."""
+        chrom_start, chrom_end = self.get_chrom_rows(chrom)
+        if chrom_start == chrom_end or not 0 <= pos <= MAX_UINT32:
+            return (0, 0)
+        chrom_pos = self._pos[chrom_start:chrom_end]
+        return (
+            chrom_start + int(np.searchsorted(chrom_pos, np.uint32(pos), side="left")),
+            chrom_start + int(np.searchsorted(chrom_pos, np.uint32(pos), side="right")),
+        )
+
+    def find_row(self, variant_id: str) -> Optional[int]:
+        """Returns the row of `variant_id` (like "1-19669-A-T"), or None if it isn't in `sites.tsv`."""
+        try:
+            chrom, pos, ref, alt = variant_id.split("-")
+            pos_int = int(pos)
+        except ValueError:
+            return None
+        start, end = self._get_pos_rows(chrom, pos_int)
+        for row in range(start, end):
+            if self._get_allele(int(self._ref[row])) == ref and self._get_allele(int(self._alt[row])) == alt:
+                return row
+        return None
+
+    def find_rows_for_rsid(self, rsid: str) -> List[int]:
+        """Returns the rows of the variants that have `rsid`."""
+        num = _rsid_to_num(rsid.strip().lower())
+        if num is None:
+            return []
+        start = int(np.searchsorted(self._rsid_sorted, np.uint64(num), side="left"))
+        end = int(np.searchsorted(self._rsid_sorted, np.uint64(num), side="right"))
+        return [int(row) for row in self._rsid_rows[start:end]]
+
+    def resolve_rsids(self, rsids: List[str]) -> List[List[int]]:
+        """Returns the rows of each of `rsids` (like "rs123"), with one vectorized search for the whole batch."""
+        nums = [_rsid_to_num(rsid.strip().lower()) for rsid in rsids]
+        query = np.array([num if num is not None else 0 for num in nums], dtype=np.uint64)
+        starts = np.searchsorted(self._rsid_sorted, query, side="left")
+        ends = np.searchsorted(self._rsid_sorted, query, side="right")
+        return [
+            [int(row) for row in self._rsid_rows[start:end]] if num is not None else []
+            for num, start, end in zip(nums, starts, ends)
+        ]
+
+    def resolve_variant_ids(self, variant_ids: List[Tuple[str, int, str, str]]) -> List[Optional[int]]:
+        """Returns the row of each (chrom, pos, ref, alt) in `variant_ids`, or None."""
+        rows = self.find_rows(
+            [chrom_order.get(chrom_aliases.get(chrom, chrom), -1) for chrom, _, _, _ in variant_ids],
+            [pos for _, pos, _, _ in variant_ids],
+            [ref for _, _, ref, _ in variant_ids],
+            [alt for _, _, _, alt in variant_ids],
+        )
+        return [int(row) if row >= 0 else None for row in rows]
+
+    @functools.cached_property
+    def _allele_codes(self) -> Dict[str, int]:
+        blob, offsets = self._alleles_dict.tobytes(), self._alleles_dict_offsets.tolist()
+        return {blob[start:end].decode("utf-8"): code for code, (start, end) in enumerate(zip(offsets, offsets[1:]))}
+
+    def find_rows(self, chrom_idxs: Sequence[int], positions: Sequence[int], refs: Sequence[str], alts: Sequence[str]) -> np.ndarray:
+        """
+        Returns the row of each variant, or -1 if it isn't in `sites.tsv`, with one vectorized search per chromosome.
+        Alleles are compared by their codes, so no allele is decoded.
+        """
+        chrom_idxs = np.asarray(chrom_idxs, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.int64)
+        ref_codes = np.array([self._allele_codes.get(ref, -1) for ref in refs], dtype=np.int64)
+        alt_codes = np.array([self._allele_codes.get(alt, -1) for alt in alts], dtype=np.int64)
+        rows = np.full(len(positions), -1, dtype=np.int64)
+        valid = (positions >= 0) & (positions <= MAX_UINT32) & (ref_codes >= 0) & (alt_codes >= 0)
+        for chrom_idx in np.unique(chrom_idxs[valid]):
+            if not 0 <= chrom_idx < len(chrom_order_list):
+                continue
+            chrom_start, chrom_end = self.get_chrom_rows(chrom_order_list[chrom_idx])
+            idxs = np.nonzero(valid & (chrom_idxs == chrom_idx))[0]
+            chrom_pos = self._pos[chrom_start:chrom_end]
+            query = positions[idxs].astype(np.uint32)
+            starts = np.searchsorted(chrom_pos, query, side="left")
+            counts = np.searchsorted(chrom_pos, query, side="right") - starts
+            # one candidate per variant of `sites.tsv` at the same position, usually exactly one
+            query_idxs = np.repeat(idxs, counts)
+            offsets = np.arange(len(query_idxs)) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidate_rows = chrom_start + np.repeat(starts, counts) + offsets
+            matches = (self._ref[candidate_rows] == ref_codes[query_idxs]) & (
+                self._alt[candidate_rows] == alt_codes[query_idxs]
+            )
+            rows[query_idxs[matches]] = candidate_rows[matches]
+        return rows
+
+    def query_rsid_prefix(self, prefix: str, max_results: int = 4) -> List[Tuple[Optional[str], str]]:
+        """
+        Returns [(rsid, variant_id), ...] for rsids starting with `prefix` (like "rs12").
+        If `prefix` is a complete rsid, only the exact matches are returned.
+        """
+        prefix = prefix.strip().lower()
+        if not prefix.startswith("rs"):
+            return []
+        results = []
+        for lo, hi in _decimal_prefix_ranges(prefix[2:], self._max_rsid):
+            start = int(np.searchsorted(self._rsid_sorted, np.uint64(lo), side="left"))
+            end = int(np.searchsorted(self._rsid_sorted, np.uint64(hi), side="left"))
+            for i in range(start, end):
+                row = int(self._rsid_rows[i])
+                results.append(("rs{}".format(int(self._rsid_sorted[i])), self.get_variant_id(row)))
+                if len(results) >= max_results:
+                    return results
+            if results and lo == int(prefix[2:]):
+                return results  # exact matches
+        return results
+
+    def query_cpra_prefix(
+        self, chrom: str, pos_prefix: str, ref_prefix: str = "", alt_prefix: str = "", max_results: int = 4
+    ) -> List[Tuple[Optional[str], str]]:
+        """
+        Returns [(rsid, variant_id), ...] for variants on `chrom` whose chr-pos-ref-alt starts like the query.
+        `ref_prefix` only applies if `pos_prefix` is a complete position, and `alt_prefix` only if `ref_prefix` is a complete ref.
+        """
+        chrom_start, chrom_end = self.get_chrom_rows(chrom)
+        if chrom_start == chrom_end:
+            return []
+        chrom_pos = self._pos[chrom_start:chrom_end]
+        ref_prefix, alt_prefix = ref_prefix.upper(), alt_prefix.upper()
+        results = []
+        for lo, hi in _decimal_prefix_ranges(pos_prefix, self._max_pos):
+            start = chrom_start + int(np.searchsorted(chrom_pos, np.uint32(lo), side="left"))
+            end = chrom_start + int(
+                np.searchsorted(chrom_pos, np.uint32(min(hi - 1, MAX_UINT32)), side="right")
+            )
+            for row in range(start, end):
+                if ref_prefix or alt_prefix:
+                    ref = self._get_allele(int(self._ref[row]))
+                    if alt_prefix:
+                        if ref != ref_prefix or not self._get_allele(int(self._alt[row])).startswith(alt_prefix):
+                            continue
+                    elif not ref.startswith(ref_prefix):
+                        continue
+                results.append((self.get_rsid(row), self.get_variant_id(row)))
+                if len(results) >= max_results:
+                    return results
+            if ref_prefix or alt_prefix:
+                break  # ref and alt are only given after a complete position
+        if alt_prefix:
+            exact_id = "-".join([chrom_aliases.get(chrom, chrom), pos_prefix, ref_prefix, alt_prefix])
+            exact_matches = [result for result in results if result[1] == exact_id]
+            return exact_matches or results
+        return results
+
+    def query_nearest(self, chrom: str, pos: int, max_results: int = 4) -> List[Tuple[Optional[str], str]]:
+        """Returns [(rsid, variant_id), ...] for the `max_results` variants on `chrom` closest to `pos`, nearest first."""
+        chrom_start, chrom_end = self.get_chrom_rows(chrom)
+        if chrom_start == chrom_end or max_results <= 0:
+            return []
+        chrom_pos = self._pos[chrom_start:chrom_end]
+        idx = int(np.searchsorted(chrom_pos, np.uint32(min(max(pos, 0), MAX_UINT32)), side="left"))
+        # the nearest `max_results` variants are among the `max_results` on either side of the insertion point
+        lo, hi = max(0, idx - max_results), min(len(chrom_pos), idx + max_results)
+        distances = np.abs(chrom_pos[lo:hi].astype(np.int64) - pos)
+        order = np.argsort(distances, kind="stable")[:max_results]
+        rows = [chrom_start + lo + int(i) for i in order]
+        return [(self.get_rsid(row), self.get_variant_id(row)) for row in rows]
+
+
+_loaded_indexes: Dict[str, Tuple[Tuple[int, int], VariantIndex]] = {}  # index_dir -> ((inode, mtime_ns) of meta.json, index)
+_loaded_indexes_lock = threading.Lock()
+
+
+def load_variant_index(index_dir: str) -> VariantIndex:
+    """
+    Opens the index once per process, and again after it was rebuilt.
+    A rebuild replaces the whole directory, so a new `meta.json` means new arrays. Checking it costs one `stat()`.
+    The arrays are memory-mapped, so opening them is cheap and survives forking.
+    """
+    loaded = _loaded_indexes.get(index_dir)
+    try:
+        stat = os.stat(os.path.join(index_dir, "meta.json"))
+    except FileNotFoundError:
+        if loaded is not None:
+            return loaded[1]  # the index is being replaced, and the old arrays are still mapped
+        raise
+    key = (stat.st_ino, stat.st_mtime_ns)
+    if loaded is None or loaded[0] != key:
+        with _loaded_indexes_lock:
+            loaded = _loaded_indexes.get(index_dir)
+            if loaded is None or loaded[0] != key:
+                loaded = _loaded_indexes[index_dir] = (key, VariantIndex(index_dir))
+    return loaded[1]
@@ -1,7 +1,12 @@
 import pytest
 import pheweb_api.conf as conf
 from pheweb_api.api_app import create_app
+from pheweb_api.file_utils import get_filepath
+import pheweb_api.load.make_gene_aliases_sqlite3 as make_gene_aliases_sqlite3
 import os
+import gzip
+import json
+import random
 
 @pytest.fixture
 def app():
@@ -21,3 +26,70 @@ def app():
 @pytest.fixture()
 def client(app):
     return app.test_client()
+
+
+GENES = [
+    ("1", 5000, 12000, "GENEA", "ENSG1"),
+    ("1", 15000, 30000, "GENEB", "ENSG2"),
+    ("2", 2000, 9000, "GENEC", "ENSG3"),
+    ("10", 10000, 20000, "PCSK9", "ENSG4"),
+]
+
+@pytest.fixture
+def make_data_dir(tmp_path, monkeypatch):
+    """
+    Returns a function that makes a data directory in `tmp_path` with the raw inputs of `pheweb2 process`, and loads from it.
+    Every data directory gets the same variants and association files, so that the results of different ways of loading them can be compared.
+    Phenotypes are stratified by sex, and `phenocodes` are the ones in pheno-list.json.
+    """
+    monkeypatch.setattr(conf, "overrides", {"NUM_PROCS": 2})
+    # the gene aliases are downloaded from genenames.org
+    monkeypatch.setattr(make_gene_aliases_sqlite3, "get_genenamesorg_ensg_aliases_map", lambda ensgs: {})
+
+    def make(name, phenocodes):
+        data_dir = tmp_path / name
+        monkeypatch.setenv("PHEWEB_DATA_DIR", str(data_dir))
+        rng = random.Random(0)
+        variants = []
+        for chrom in ["1", "2", "10", "X"]:
+            pos = 1000
+            for _ in range(1000):
+                pos += rng.randint(1, 30)
+                ref = rng.choice("ACGT")
+                variants.extend((chrom, pos, ref, alt) for alt in rng.choice([["A"], ["C", "G"], ["AT", "T"]]) if alt != ref)
+
+        with open(get_filepath("genes", must_exist=False), "w") as f:
+            f.writelines("\t".join(map(str, gene)) + "\n" for gene in GENES)
+        with gzip.open(get_filepath("rsids", must_exist=False), "wt") as f:
+            f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+            for i, (chrom, pos, ref, alt) in enumerate(variants):
+                if i % 2 == 0:
+                    f.write("{}\t{}\trs{}\t{}\t{}\n".format(chrom, pos, 1000 + i, ref, alt))
+
+        os.makedirs(data_dir / "raw")
+        phenos = []
+        for phenocode in phenocodes:
+            for sex in ["both", "male"]:
+                rng = random.Random("{}.{}".format(phenocode, sex))
+                assoc_filepath = str(data_dir / "raw" / "{}.{}.tsv".format(phenocode, sex))
+                with open(assoc_filepath, "w") as f:
+                    f.write("chrom\tpos\tref\talt\tpval\tbeta\taf\ttest\n")
+                    for chrom, pos, ref, alt in variants:
+                        if rng.random() < 0.5:
+                            f.write("{}\t{}\t{}\t{}\t{:.3g}\t{:.3g}\t0.3\tADD\n".format(chrom, pos, ref, alt, rng.random(), rng.gauss(0, 1)))
+                phenos.append({
+                    "phenocode": phenocode,
+                    "phenostring": "{} trait".format(phenocode),
+                    "category": "c",
+                    "num_samples": 100,
+                    "num_cases": 10,
+                    "num_controls": 90,
+                    "interaction": None,
+                    "assoc_files": [assoc_filepath],
+                    "stratification": {"ancestry": "european", "sex": sex},
+                })
+        with open(get_filepath("phenolist", must_exist=False), "w") as f:
+            json.dump(phenos, f)
+        return data_dir
+
+    return make
@@ -0,0 +1,48 @@
+import pytest
+import glob
+import gzip
+import json
+import os
+
+# the matrix is made by the compiled cffi module
+pytest.importorskip("pheweb_api.load.cffi._x")
+
+from pheweb_api.command_line import run
+
+
+def read_gz(filepath):
+    with gzip.open(filepath, "rt") as f:
+        return f.read()
+
+def read_log(data_dir, step):
+    with open(data_dir / "tmp" / "process-logs" / "{}.log".format(step)) as f:
+        return f.read()
+
+@pytest.mark.parametrize("added_phenocodes", [["P3"], ["P0", "P2"]])
+def test_add_phenotype_matches_full_rebuild(make_data_dir, added_phenocodes):
+    """
+    Test that adding phenotypes to a loaded dataset extends the sites and the matrices to the same files that loading everything at once makes,
+    whether the new phenocodes sort after the loaded ones or among them.
+    """
+    incremental_dir = make_data_dir("incremental", ["P0", "P1", "P2", "P3"])
+    with open(incremental_dir / "pheno-list.json") as f:
+        phenos = json.load(f)
+    with open(incremental_dir / "pheno-list.json", "w") as f:
+        json.dump([pheno for pheno in phenos if pheno["phenocode"] not in added_phenocodes], f)
+    run(["process"])
+    with open(incremental_dir / "pheno-list.json", "w") as f:
+        json.dump(phenos, f)
+    run(["process"])
+    # each phenocode has a pheno for both sexes and one for males
+    assert "Adding the variants of {} new phenotypes".format(2 * len(added_phenocodes)) in read_log(incremental_dir, "sites")
+    assert "adding {} phenos to the existing matrix".format(len(added_phenocodes)) in read_log(incremental_dir, "matrix")
+
+    full_dir = make_data_dir("full", ["P0", "P1", "P2", "P3"])
+    run(["process"])
+
+    for filename in ["sites-unannotated.tsv", "sites.tsv"]:
+        assert read_gz(incremental_dir / "sites" / filename) == read_gz(full_dir / "sites" / filename)
+    matrix_filenames = sorted(os.path.basename(filepath) for filepath in glob.glob(str(full_dir / "matrix-stratified" / "*.tsv.gz")))
+    assert matrix_filenames == ["matrix.european.both.tsv.gz", "matrix.european.male.tsv.gz"]
+    for filename in matrix_filenames:
+        assert read_gz(incremental_dir / "matrix-stratified" / filename) == read_gz(full_dir / "matrix-stratified" / filename)
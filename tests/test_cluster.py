@@ -0,0 +1,44 @@
+import pytest
+import glob
+import gzip
+import os
+import sqlite3
+
+# the matrix is made by the compiled cffi module
+pytest.importorskip("pheweb_api.load.cffi._x")
+
+from pheweb_api.command_line import run
+
+
+def read_gz(filepath):
+    with gzip.open(filepath, "rt") as f:
+        return f.read()
+
+def read_table(filepath, table):
+    db = sqlite3.connect(str(filepath))
+    try:
+        return db.execute("SELECT * FROM {} ORDER BY 1, 2".format(table)).fetchall()
+    finally:
+        db.close()
+
+def test_local_cluster_matches_process(make_data_dir):
+    """
+    Test that running the whole pipeline as local cluster jobs makes the same sites, matrices and best phenos of each gene as `pheweb2 process`.
+    """
+    cluster_dir = make_data_dir("cluster", ["P1", "P2", "P3"])
+    run(["cluster", "--engine", "local", "--step", "all", "--N_per_job", "2", "--gather-shards", "3"])
+    process_dir = make_data_dir("process", ["P1", "P2", "P3"])
+    run(["process"])
+
+    assert read_gz(cluster_dir / "sites" / "sites.tsv") == read_gz(process_dir / "sites" / "sites.tsv")
+
+    matrix_filenames = sorted(os.path.basename(filepath) for filepath in glob.glob(str(process_dir / "matrix-stratified" / "*.tsv.gz")))
+    assert matrix_filenames == ["matrix.european.both.tsv.gz", "matrix.european.male.tsv.gz"]
+    for filename in matrix_filenames:
+        assert read_gz(cluster_dir / "matrix-stratified" / filename) == read_gz(process_dir / "matrix-stratified" / filename)
+        assert os.path.exists(cluster_dir / "matrix-stratified" / (filename + ".tbi"))
+
+    for table in ["gene_associations", "genes"]:
+        rows = read_table(process_dir / "best-phenos-by-gene.sqlite3", table)
+        assert rows
+        assert read_table(cluster_dir / "best-phenos-by-gene.sqlite3", table) == rows
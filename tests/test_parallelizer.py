@@ -0,0 +1,139 @@
+import pytest
+import os
+import multiprocessing
+import time
+import pheweb_api.conf as conf
+from pheweb_api.load.load_utils import Parallelizer, RESULT_FILE_MIN_BYTES, _dump_result, _load_result, get_load_memory, get_rss
+
+GB = 1024**3
+
+@pytest.fixture
+def configure(tmp_path, monkeypatch):
+    """Returns a function that sets NUM_PROCS (and MEMORY_BUDGET_GB), with the data directory (for task timings and big results) in `tmp_path`."""
+    monkeypatch.setenv("PHEWEB_DATA_DIR", str(tmp_path))
+    def configure(num_procs, memory_budget_gb=None):
+        overrides = {"NUM_PROCS": num_procs}
+        if memory_budget_gb is not None:
+            overrides["MEMORY_BUDGET_GB"] = memory_budget_gb
+        monkeypatch.setattr(conf, "overrides", overrides)
+    return configure
+
+def do_task(task):
+    start = time.time()
+    time.sleep(task.get("seconds", 0))
+    return {"name": task["name"], "start": start, "end": time.time()}
+
+def run_tasks(tasks):
+    """Runs `tasks`, whose size and memory are given by their "size" and "memory" keys, and returns {task name: result}."""
+    results = {}
+    for ret in Parallelizer().run_single_tasks(
+        tasks,
+        do_task,
+        cmd="test",
+        get_task_size=lambda task: task["size"],
+        get_task_memory=lambda task: task["memory"],
+    ):
+        results[ret["value"]["name"]] = ret["value"]
+    return results
+
+def test_largest_task_starts_first(configure):
+    """
+    Test that tasks start from the largest to the smallest, and that tasks of the same size keep their order.
+    """
+    configure(num_procs=1)
+    tasks = [
+        {"name": "a", "size": 1, "memory": 0},
+        {"name": "b", "size": 30, "memory": 0},
+        {"name": "c", "size": 2, "memory": 0},
+        {"name": "d", "size": 2, "memory": 0},
+    ]
+    results = run_tasks(tasks)
+    assert sorted(results, key=lambda name: results[name]["start"]) == ["b", "c", "d", "a"]
+
+def test_task_waits_for_memory(configure):
+    """
+    Test that a task that doesn't fit next to the running task waits until that one finishes, while a smaller task that fits starts right away.
+    The budget also holds the memory of this process, so the tasks leave room for it.
+    """
+    configure(num_procs=2, memory_budget_gb=4)
+    results = run_tasks([
+        {"name": "first", "size": 3, "memory": 2.4 * GB, "seconds": 1},
+        {"name": "too_big", "size": 2, "memory": 2.4 * GB},
+        {"name": "fits", "size": 1, "memory": 0.4 * GB},
+    ])
+    assert results["fits"]["start"] < results["first"]["end"]
+    assert results["too_big"]["start"] >= results["first"]["end"]
+
+def test_task_bigger_than_budget_runs_alone(configure):
+    """
+    Test that a task that needs more than the whole budget still runs, with no other task next to it.
+    """
+    configure(num_procs=2, memory_budget_gb=4)
+    results = run_tasks([
+        {"name": "huge", "size": 2, "memory": 8 * GB, "seconds": 1},
+        {"name": "small", "size": 1, "memory": 0.4 * GB},
+    ])
+    assert results["small"]["start"] >= results["huge"]["end"]
+
+def test_next_task_starts_before_on_task_completion(configure):
+    """
+    Test that the child that finished a task gets the next one before `on_task_completion` runs, so that it doesn't wait for it.
+    """
+    configure(num_procs=1)
+    completions = {}
+    def on_task_completion(task):
+        start = time.time()
+        time.sleep(1)
+        completions[task["name"]] = {"start": start, "end": time.time()}
+    results = {}
+    for ret in Parallelizer().run_single_tasks(
+        [{"name": "first", "seconds": 0}, {"name": "second", "seconds": 0}],
+        do_task,
+        cmd="test",
+        on_task_completion=on_task_completion,
+    ):
+        results[ret["value"]["name"]] = ret["value"]
+    assert results["second"]["start"] < completions["first"]["end"]
+
+def test_load_memory_holds_children(configure):
+    """
+    Test that the memory of the load holds this process and the memory that a child allocates.
+    """
+    configure(num_procs=1)
+    with multiprocessing.Pool(1) as pool:
+        before = get_load_memory()
+        assert get_rss(os.getpid()) <= before
+        result = pool.apply_async(hold_memory, (GB // 4,))
+        deadline = time.time() + 10
+        while get_load_memory() < before + GB // 8 and time.time() < deadline:
+            time.sleep(0.1)
+        assert get_load_memory() >= before + GB // 8
+        result.get()
+
+def hold_memory(num_bytes):
+    data = bytearray(num_bytes)
+    data[::4096] = b"x" * len(data[::4096])
+    time.sleep(1)
+
+def do_big_task(task):
+    return bytes(range(256)) * (task["num_bytes"] // 256)
+
+def test_big_result_goes_through_a_file(configure, tmp_path):
+    """
+    Test that a result over RESULT_FILE_MIN_BYTES arrives intact, and that its temporary file is removed.
+    """
+    configure(num_procs=2)
+    num_bytes = 2 * RESULT_FILE_MIN_BYTES
+    ret = _dump_result({"num_bytes": num_bytes}, do_big_task({"num_bytes": num_bytes}))
+    assert "pickled_value" not in ret
+    assert os.path.exists(ret["value_filepath"])
+    assert _load_result(ret) == do_big_task({"num_bytes": num_bytes})
+    assert not os.path.exists(ret["value_filepath"])
+
+    tasks = [{"num_bytes": num_bytes}, {"num_bytes": 1024}]
+    results = {
+        ret["task"]["num_bytes"]: ret["value"]
+        for ret in Parallelizer().run_single_tasks(tasks, do_big_task, cmd="test")
+    }
+    assert results == {num_bytes: do_big_task({"num_bytes": num_bytes}), 1024: do_big_task({"num_bytes": 1024})}
+    assert [filename for filename in os.listdir(tmp_path / "tmp") if filename.startswith("result-")] == []
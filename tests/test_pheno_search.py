@@ -0,0 +1,66 @@
+import pytest
+import sqlite3
+from pheweb_api.models.pheno_search import PhenoSearch, create_pheno_search_tables
+
+PHENOTYPES = [
+    ("T2D", "Type 2 diabetes"),
+    ("T1D", "Type 1 diabetes"),
+    ("DIAB", "Diabetes"),
+    ("ASTHMA_CHILD", "Childhood asthma"),
+    ("ASTHMA", "Asthma"),
+    ("GOUT", "Gout"),
+]
+
+@pytest.fixture
+def connection():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE phenotypes (phenocode TEXT PRIMARY KEY, phenostring TEXT)")
+    conn.executemany("INSERT INTO phenotypes (phenocode, phenostring) VALUES (?, ?)", PHENOTYPES)
+    create_pheno_search_tables(conn)
+    yield conn
+    conn.close()
+
+def test_exact_match_first(connection):
+    """
+    Test that an exact match of the phenocode or phenostring comes before the other prefix matches.
+    """
+    pheno_search = PhenoSearch(lambda: connection)
+    results = pheno_search.search("diabetes", max_results=4)
+    assert results[0] == ("DIAB", "Diabetes")
+    assert set(results) == {("DIAB", "Diabetes"), ("T2D", "Type 2 diabetes"), ("T1D", "Type 1 diabetes")}
+
+    results = pheno_search.search("Asthma", max_results=4)
+    assert results[0] == ("ASTHMA", "Asthma")
+    assert ("ASTHMA_CHILD", "Childhood asthma") in results
+
+def test_every_token_is_a_prefix(connection):
+    """
+    Test that every typed token must be a prefix of a token in the phenocode or phenostring.
+    """
+    pheno_search = PhenoSearch(lambda: connection)
+    assert pheno_search.search("type 2 diab", max_results=1) == [("T2D", "Type 2 diabetes")]
+    assert pheno_search.search("child ast", max_results=1) == [("ASTHMA_CHILD", "Childhood asthma")]
+    assert pheno_search.search("", max_results=4) == []
+    assert pheno_search.search('"*', max_results=4) == []
+
+def test_fuzzy_fallback(connection):
+    """
+    Test that a typo finds its phenotypes through trigrams, and that the fuzzy matches only fill in after the prefix matches.
+    """
+    pheno_search = PhenoSearch(lambda: connection)
+    results = pheno_search.search("diabetis", max_results=4)
+    assert set(results) == {("DIAB", "Diabetes"), ("T2D", "Type 2 diabetes"), ("T1D", "Type 1 diabetes")}
+
+    # only T2D has a token starting with "2", and T1D shares the trigrams of "type"
+    assert pheno_search.search("type 2", max_results=4) == [("T2D", "Type 2 diabetes"), ("T1D", "Type 1 diabetes")]
+    assert pheno_search.search("type 2", max_results=1) == [("T2D", "Type 2 diabetes")]
+
+    assert pheno_search.search("xyzzy", max_results=4) == []
+
+def test_cached_prefix_matches_are_reused(connection):
+    """
+    Test that filtering the cached matches of an earlier prefix gives the same results as querying SQLite.
+    """
+    pheno_search = PhenoSearch(lambda: connection)
+    for query in ["d", "di", "dia", "diab", "diabetes", "diabetes t"]:
+        assert pheno_search.search(query, max_results=4) == PhenoSearch(lambda: connection).search(query, max_results=4)
@@ -0,0 +1,134 @@
+import pytest
+import math
+import numpy as np
+import boltons.mathutils
+import scipy.stats
+from pheweb_api.load import qq
+from pheweb_api.utils import round_sig
+
+# The QQ computation before `QQHistogram`, which sorted every qval, and the confidence intervals before they were vectorized.
+
+def sorted_compute_qq(qvals):
+    qvals = qvals.astype(np.float64)
+    if len(qvals) == 0 or qvals[0] == 0:
+        return {}
+    max_exp_qval = -math.log10(0.5 / len(qvals))
+    max_obs_qval = boltons.mathutils.clamp(qvals[0], lower=max_exp_qval, upper=math.ceil(2 * max_exp_qval))
+    if qvals[0] > max_obs_qval:
+        max_obs_qval = next(qval for qval in qvals if qval <= max_obs_qval)
+    occupied_bins = set()
+    for i, obs_qval in enumerate(qvals):
+        if obs_qval > max_obs_qval:
+            continue
+        exp_qval = -math.log10((i + 0.5) / len(qvals))
+        occupied_bins.add((int(exp_qval / max_exp_qval * qq.NUM_BINS), int(obs_qval / max_obs_qval * qq.NUM_BINS)))
+    return {
+        "bins": sorted((exp_bin / qq.NUM_BINS * max_exp_qval, obs_bin / qq.NUM_BINS * max_obs_qval) for exp_bin, obs_bin in occupied_bins),
+        "max_exp_qval": max_exp_qval,
+    }
+
+def sorted_gc_lambda(qvals, quantile):
+    # float(), because `1 - pval` rounds to 1 in float32
+    return qq.gc_value(10 ** -float(qvals[int(len(qvals) * quantile)]), quantile)
+
+def beta_confidence_intervals(num_variants, confidence=0.95):
+    one_sided_doubt = (1 - confidence) / 2
+    variant_counts = [2**x for x in range(int(math.ceil(math.log2(num_variants))))] + [num_variants - 1]
+    for variant_count in reversed(variant_counts):
+        rv = scipy.stats.beta(variant_count, num_variants - variant_count)
+        yield {
+            "x": round(-math.log10((variant_count - 0.5) / num_variants), 2),
+            "y_min": round(-math.log10(rv.ppf(1 - one_sided_doubt)), 2),
+            "y_max": round(-math.log10(rv.ppf(one_sided_doubt)), 2),
+        }
+
+
+def make_variants(num_variants, seed):
+    """Returns (mafs, qvals) like `get_maf_qval_pairs` reads them: pvalues with 3 significant digits, some strong and some 0."""
+    rng = np.random.default_rng(seed)
+    pvals = rng.uniform(size=num_variants)
+    num_strong = num_variants // 100
+    pvals[:num_strong] = 10 ** -rng.uniform(5, 60, size=num_strong)
+    pvals[num_strong : num_strong + 5] = 0
+    pvals = np.array([float("{:.3g}".format(pval)) for pval in pvals])
+    with np.errstate(divide="ignore"):
+        qvals = np.where(pvals == 0, 1000, -np.log10(pvals)).astype(np.float32)
+    mafs = np.array([float("{:.3g}".format(maf)) for maf in rng.beta(0.3, 1.5, size=num_variants)], dtype=np.float32)
+    mafs[rng.uniform(size=num_variants) < 0.05] = 0.5
+    return mafs, qvals
+
+def make_histogram(mafs, qvals, has_maf):
+    histogram = qq.QQHistogram(has_maf=has_maf)
+    for start in range(0, len(qvals), qq.CHUNK_SIZE):
+        histogram.add(mafs[start : start + qq.CHUNK_SIZE], qvals[start : start + qq.CHUNK_SIZE])
+    return histogram
+
+def descending(qvals):
+    return -np.sort(-qvals)
+
+def assert_same_qq(qq_json, sorted_qq_json):
+    """
+    Every qval past the `NUM_EXACT_QVALS` largest is spread over its qval bin, so a few points move to the next bin.
+    Only 1% of the points may differ, and each of them must be next to a point of the other plot.
+    """
+    assert qq_json["max_exp_qval"] == sorted_qq_json["max_exp_qval"]
+    bins = {(round(x, 6), round(y, 6)) for x, y in qq_json["bins"]}
+    sorted_bins = {(round(x, 6), round(y, 6)) for x, y in sorted_qq_json["bins"]}
+    assert len(bins - sorted_bins) <= 0.01 * len(sorted_bins)
+    exp_bin_width = qq_json["max_exp_qval"] / qq.NUM_BINS
+    max_obs_bin_width = math.ceil(2 * qq_json["max_exp_qval"]) / qq.NUM_BINS
+    for x, y in bins ^ sorted_bins:
+        other_bins = sorted_bins if (x, y) in bins else bins
+        assert any(abs(x - other_x) <= exp_bin_width + 1e-6 and abs(y - other_y) <= max_obs_bin_width + 1e-6 for other_x, other_y in other_bins)
+
+def assert_close_gc_lambdas(gc_lambdas, qvals):
+    sorted_gc_lambdas = {}
+    for quantile in ["0.5", "0.1", "0.01", "0.001"]:
+        gc_lambda = sorted_gc_lambda(qvals, float(quantile))
+        if not math.isnan(gc_lambda) and abs(gc_lambda) != math.inf:
+            sorted_gc_lambdas[quantile] = round_sig(gc_lambda, 5)
+    assert gc_lambdas == pytest.approx(sorted_gc_lambdas, rel=0.01)
+
+
+@pytest.mark.parametrize("num_variants", [50, 5000, 200000])
+def test_qq_without_maf(num_variants):
+    """
+    Test that the QQ plot is the same as sorting every qval (see `assert_same_qq`), and that the genomic control lambdas are within 1%.
+    """
+    mafs, qvals = make_variants(num_variants, seed=num_variants)
+    histogram = make_histogram(mafs, qvals, has_maf=False)
+    assert_same_qq(qq.compute_qq(histogram.get_qvals()), sorted_compute_qq(descending(qvals)))
+    overall = qq.make_qq_unstratified(histogram.get_qvals(), include_qq=False)
+    assert overall["count"] == num_variants
+    assert_close_gc_lambdas(overall["gc_lambda"], descending(qvals))
+
+@pytest.mark.parametrize("num_variants", [5000, 300000])
+def test_qq_by_maf(num_variants):
+    """
+    Test that each maf stratum holds about a quarter of the variants, and that its QQ plot is the same as sorting the qvals of its variants.
+    """
+    mafs, qvals = make_variants(num_variants, seed=num_variants)
+    histogram = make_histogram(mafs, qvals, has_maf=True)
+    strata = qq.make_qq_stratified(histogram)
+    assert len(strata) == qq.NUM_MAF_RANGES
+    maf_bins = qq._get_maf_bins(mafs)
+    for stratum, maf_bin_range in zip(strata, histogram.get_maf_strata()):
+        in_stratum = (maf_bins >= maf_bin_range.start) & (maf_bins < maf_bin_range.stop)
+        assert stratum["count"] == in_stratum.sum() == pytest.approx(num_variants / qq.NUM_MAF_RANGES, rel=0.1)
+        assert stratum["maf_range"] == (mafs[in_stratum].min(), mafs[in_stratum].max())
+        assert_same_qq(stratum["qq"], sorted_compute_qq(descending(qvals[in_stratum])))
+    assert sum(stratum["count"] for stratum in strata) == num_variants
+
+    overall = qq.make_qq_unstratified(histogram.get_qvals(), include_qq=False)
+    assert "qq" not in overall
+    assert_close_gc_lambdas(overall["gc_lambda"], descending(qvals))
+
+@pytest.mark.parametrize("num_variants", [50, 1250.25, 5000, 75000, 300000])
+def test_confidence_intervals(num_variants):
+    """
+    Test that the confidence intervals are the same as computing them with `scipy.stats.beta` for each variant count,
+    including for the fractional number of variants per maf stratum, and when they come from the cache.
+    """
+    expected = list(beta_confidence_intervals(num_variants))
+    assert list(qq.get_confidence_intervals(num_variants)) == expected
+    assert list(qq.get_confidence_intervals(num_variants)) == expected
@@ -1,4 +1,7 @@
 import pytest
+import json
+import time
+import pheweb_api.blueprints.autocomplete as autocomplete
 
 def test_get_phenotypes(client):
     """
@@ -36,6 +39,40 @@ def test_get_gene_PCSK9(client):
     assert isinstance(data["data"], list)
     assert len(data["data"]) == 11
 
+def test_get_gene_PCSK9_page(client):
+    """
+    Test paging through and filtering the associations of the gene PCSK9.
+    """
+    response = client.get("/gene/PCSK9?limit=5&offset=5")
+    assert response.status_code == 200
+
+    data = response.json
+    assert data["total"] == 11
+    assert len(data["data"]) == 5
+    pvals = [assoc["pval"] for assoc in data["data"]]
+    assert pvals == sorted(pvals)
+
+    response = client.get("/gene/PCSK9?max_pval=1e-300")
+    assert response.status_code == 200
+    assert response.json["data"] == []
+
+def test_get_genes_in_region_and_near_position(client):
+    """
+    Test that PCSK9 is found both in its own region and near its own start.
+    """
+    chrom, start, end = client.get("/gene/PCSK9/gene_position").json
+
+    response = client.get(f"/gene/region/{chrom}:{start}-{end}")
+    assert response.status_code == 200
+    assert "PCSK9" in [x["gene"] for x in response.json]
+
+    response = client.get(f"/gene/near/{chrom}/{start}?max_results=3")
+    assert response.status_code == 200
+    data = response.json
+    assert len(data) <= 3
+    assert data[0]["distance"] == 0
+    assert "PCSK9" in [x["gene"] for x in data if x["distance"] == 0]
+
 def test_get_tophits(client):
     """
     Test a successful response for getting the tophits.
@@ -60,6 +97,71 @@ def test_get_stratifications(client):
     assert len(data) == 3
     assert all(x in data for x in ["european.both", "european.male", "european.female"])
 
+def test_autocomplete_search(client):
+    """
+    Test a successful response for the unified autocomplete search.
+    """
+    response = client.get("/autocomplete/search?q=PCSK9")
+    assert response.status_code == 200
+
+    data = response.json
+    assert data["query_type"] == "gene"
+    assert data["suggestions"][0]["feature"] == "gene"
+    assert data["suggestions"][0]["gene"] == "PCSK9"
+
+    response = client.get("/autocomplete/search?q=10-112999020-G-T&limit=3")
+    assert response.status_code == 200
+
+    data = response.json
+    assert data["query_type"] == "cpra"
+    assert data["suggestions"][0]["variant_id"] == "10-112999020-G-T"
+
+    response = client.get("/autocomplete/search?q=rs")
+    assert response.status_code == 200
+    assert response.json["query_type"] == "gene"
+
+    response = client.get("/autocomplete/search?q=RS1")
+    assert response.status_code == 200
+
+    data = response.json
+    assert data["query_type"] == "rsid"
+    assert data["suggestions"][0]["feature"] == "gene"
+    assert data["suggestions"][0]["gene"] == "RS1"
+
+    response = client.get("/autocomplete/search?q=")
+    assert response.status_code == 200
+    assert response.json == {"suggestions": [], "query_type": "empty", "partial": False}
+
+def test_autocomplete_search_partial(app, monkeypatch):
+    """
+    Test that a search that leaves out a slow backend is marked partial, and that a partial response isn't cached.
+    """
+    def run_backend(backend, query, max_results):
+        if backend == "pheno":
+            time.sleep(autocomplete.SEARCH_TIMEOUT_SECONDS + 0.5)
+        return [{"gene": "PCSK9", "chrom": "1", "start": 1, "stop": 2, "feature": "gene"}] if backend == "gene" else []
+    monkeypatch.setattr(autocomplete, "_run_backend", run_backend)
+    with app.app_context():
+        result = autocomplete.search("PCSK9")
+    assert result["partial"] is True
+    assert [suggestion["gene"] for suggestion in result["suggestions"]] == ["PCSK9"]
+    assert not autocomplete.is_complete_response((result, 200))
+    assert autocomplete.is_complete_response(({**result, "partial": False}, 200))
+    assert not autocomplete.is_complete_response(({"message": "Internal server error."}, 500))
+
+def test_post_variant_resolve(client):
+    """
+    Test a successful response for resolving a batch of variant ids.
+    """
+    response = client.post("/variant/resolve", json={"ids": ["10-112999020-G-T", "chr10:112999020:G:T", "not-a-variant"]})
+    assert response.status_code == 200
+
+    data = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [x["type"] for x in data] == ["cpra", "cpra", "unknown"]
+    assert data[0]["matches"][0]["variant_id"] == "10-112999020-G-T"
+    assert data[1]["matches"] == data[0]["matches"]
+    assert data[2]["matches"] == []
+
 def test_get_variant_10_112999020_G_T(client):
     """
     Test a successful response for getting the variant 10-112999020-G-T.
@@ -70,6 +172,59 @@ def test_get_variant_10_112999020_G_T(client):
     data = response.json
     assert isinstance(data, dict)
     assert len(data) > 0
+
+def test_get_region_max_points(client):
+    """
+    Test that a large region is thinned down to about `max_points` variants.
+    """
+    response = client.get("/phenotypes/CCC_MACDEG_COM/.european.both/region/10:110000000-115000000?max_points=200")
+    assert response.status_code == 200
+
+    data = response.json
+    assert data["thinning"]["max_points"] == 200
+    assert data["thinning"]["num_returned"] == min(200, data["thinning"]["num_variants"])
+    assert len(data["data"]["position"]) == data["thinning"]["num_returned"]
+
+    # the strongest variant of the region is always kept
+    response = client.get("/phenotypes/CCC_MACDEG_COM/.european.both/region/10:110000000-115000000")
+    assert response.status_code == 200
+    full_data = response.json["data"]
+    assert len(full_data["position"]) == data["thinning"]["num_variants"]
+    top_variant = full_data["id"][full_data["pvalue"].index(min(full_data["pvalue"]))]
+    assert top_variant in data["data"]["id"]
+
+def test_post_multi_pheno_region(client):
+    """
+    Test that several phenotype/stratification pairs share one columnar payload.
+    """
+    response = client.post("/phenotypes/region/10:112900000-113100000", json={
+        "phenos": [
+            {"phenocode": "CCC_MACDEG_COM", "stratification": ".european.male"},
+            {"phenocode": "CCC_MACDEG_COM", "stratification": ".european.female"},
+        ],
+    })
+    assert response.status_code == 200
+
+    data = response.json
+    assert len(data["phenos"]) == 2
+    for pheno in data["phenos"]:
+        assert len(pheno["data"]["pvalue"]) == len(data["data"]["id"])
+
+def test_post_multi_pheno_region_bad_phenos(client):
+    """
+    Test that malformed phenos get a 400, and that unknown phenos, including paths out of pheno_gz, get a 404.
+    """
+    for pheno in [{"phenocode": 5}, {"phenocode": "CCC_MACDEG_COM", "stratification": [".european.male"]}, "CCC_MACDEG_COM"]:
+        response = client.post("/phenotypes/region/10:112900000-113100000", json={"phenos": [pheno]})
+        assert response.status_code == 400
+
+    for pheno in [
+        {"phenocode": "NOT_A_PHENO", "stratification": ".european.male"},
+        {"phenocode": "../pheno_gz/CCC_MACDEG_COM", "stratification": ".european.male"},
+        {"phenocode": "CCC_MACDEG_COM", "stratification": "/../../CCC_MACDEG_COM.european.male"},
+    ]:
+        response = client.post("/phenotypes/region/10:112900000-113100000", json={"phenos": [pheno]})
+        assert response.status_code == 404
     
     
 
@@ -0,0 +1,140 @@
+import pytest
+from pheweb_api.models.variant_index import VariantIndex, build_variant_index, load_variant_index, _decimal_prefix_ranges
+
+SITES = [
+    ("1", 100, "A", "G", "rs12", "GENEA"),
+    ("1", 120, "C", "T", "rs120,rs5", "GENEA"),
+    ("1", 125, "C", "T", "", "GENEA,GENEB"),
+    ("1", 125, "C", "G", "rs1200", "GENEB"),
+    ("1", 1300, "G", "A", "rs13", ""),
+    ("2", 100, "A", "C", "rs12", "GENEC"),
+    ("X", 50, "T", "A", "rs999", "GENED"),
+]
+
+def write_sites(sites_filepath, sites):
+    with open(sites_filepath, "w") as f:
+        f.write("chrom\tpos\tref\talt\trsids\tnearest_genes\n")
+        for site in sites:
+            f.write("\t".join(map(str, site)) + "\n")
+
+@pytest.fixture
+def variant_index(tmp_path):
+    write_sites(tmp_path / "sites.tsv", SITES)
+    index_dir = str(tmp_path / "variant-index")
+    assert build_variant_index(str(tmp_path / "sites.tsv"), index_dir) == len(SITES)
+    return VariantIndex(index_dir)
+
+def test_decimal_prefix_ranges():
+    """
+    Test the ranges of numbers that start with some digits.
+    """
+    assert list(_decimal_prefix_ranges("1", 1000)) == [(1, 2), (10, 20), (100, 200), (1000, 2000)]
+    assert list(_decimal_prefix_ranges("12", 12)) == [(12, 13)]
+    assert list(_decimal_prefix_ranges("12", 11)) == []
+    assert list(_decimal_prefix_ranges("0", 1000)) == [(0, 1)]
+    assert list(_decimal_prefix_ranges("012", 1000)) == []
+    assert list(_decimal_prefix_ranges("", 1000)) == []
+    assert list(_decimal_prefix_ranges("1a", 1000)) == []
+
+def test_query_rsid_prefix(variant_index):
+    """
+    Test that shorter rsids come first, and that a complete rsid only returns its exact matches.
+    """
+    assert variant_index.query_rsid_prefix("rs1", max_results=10) == [
+        ("rs12", "1-100-A-G"),
+        ("rs12", "2-100-A-C"),
+        ("rs13", "1-1300-G-A"),
+        ("rs120", "1-120-C-T"),
+        ("rs1200", "1-125-C-G"),
+    ]
+    assert variant_index.query_rsid_prefix("rs1", max_results=2) == [("rs12", "1-100-A-G"), ("rs12", "2-100-A-C")]
+    assert variant_index.query_rsid_prefix("RS12", max_results=10) == [("rs12", "1-100-A-G"), ("rs12", "2-100-A-C")]
+    assert variant_index.query_rsid_prefix("rs5") == [("rs5", "1-120-C-T")]
+    assert variant_index.query_rsid_prefix("rs4") == []
+    assert variant_index.query_rsid_prefix("12") == []
+
+def test_query_cpra_prefix(variant_index):
+    """
+    Test that positions starting with the typed digits come in order, and that alleles narrow them down.
+    """
+    assert variant_index.query_cpra_prefix("1", "12", max_results=10) == [
+        ("rs120", "1-120-C-T"),
+        (None, "1-125-C-T"),
+        ("rs1200", "1-125-C-G"),
+    ]
+    assert variant_index.query_cpra_prefix("1", "1", max_results=10) == [
+        ("rs12", "1-100-A-G"),
+        ("rs120", "1-120-C-T"),
+        (None, "1-125-C-T"),
+        ("rs1200", "1-125-C-G"),
+        ("rs13", "1-1300-G-A"),
+    ]
+    assert variant_index.query_cpra_prefix("1", "125", "c") == [(None, "1-125-C-T"), ("rs1200", "1-125-C-G")]
+    assert variant_index.query_cpra_prefix("1", "125", "C", "G") == [("rs1200", "1-125-C-G")]
+    assert variant_index.query_cpra_prefix("1", "125", "A") == []
+    assert variant_index.query_cpra_prefix("3", "1") == []
+    assert variant_index.query_cpra_prefix("X", "5") == [("rs999", "X-50-T-A")]
+
+def test_query_nearest(variant_index):
+    """
+    Test that the variants nearest to a position come first, and that ties keep the order of sites.tsv.
+    """
+    assert variant_index.query_nearest("1", 123, max_results=3) == [
+        (None, "1-125-C-T"),
+        ("rs1200", "1-125-C-G"),
+        ("rs120", "1-120-C-T"),
+    ]
+    assert variant_index.query_nearest("1", 5000, max_results=2) == [("rs13", "1-1300-G-A"), ("rs1200", "1-125-C-G")]
+    assert variant_index.query_nearest("1", 0, max_results=1) == [("rs12", "1-100-A-G")]
+    assert variant_index.query_nearest("2", 100, max_results=4) == [("rs12", "2-100-A-C")]
+    assert variant_index.query_nearest("3", 100) == []
+
+def test_resolve_rsids(variant_index):
+    """
+    Test that every rsid of a variant with several rsids resolves to it, and that an rsid of several variants resolves to all of them.
+    """
+    assert variant_index.resolve_rsids(["rs5", "rs120", "RS12", "rs7", "bad", ""]) == [[1], [1], [0, 5], [], [], []]
+    assert variant_index.get_rsids(1) == ["rs120", "rs5"]
+    assert variant_index.get_rsid(1) == "rs120"
+    assert variant_index.get_rsids(2) == []
+    assert variant_index.get_rsid(2) is None
+
+def test_resolve_variant_ids(variant_index):
+    """
+    Test finding the rows of variants, including ones that share a position and ones that aren't in sites.tsv.
+    """
+    assert variant_index.resolve_variant_ids([
+        ("1", 125, "C", "G"),
+        ("1", 125, "C", "T"),
+        ("chrX", 50, "T", "A"),
+        ("1", 125, "C", "A"),
+        ("1", 126, "C", "G"),
+        ("5", 100, "A", "G"),
+    ]) == [3, 2, 6, None, None, None]
+    assert variant_index.find_row("1-125-C-G") == 3
+    assert variant_index.find_row("1-125") is None
+
+def test_get_nearest_genes(variant_index):
+    """
+    Test the nearest genes of variants with several genes and with none.
+    """
+    assert variant_index.get_nearest_genes(2) == ["GENEA", "GENEB"]
+    assert variant_index.get_nearest_genes(0) == ["GENEA"]
+    assert variant_index.get_nearest_genes(4) == []
+
+def test_load_variant_index_after_rebuild(tmp_path):
+    """
+    Test that the index is opened once, and opened again after it was rebuilt.
+    """
+    index_dir = str(tmp_path / "variant-index")
+    write_sites(tmp_path / "sites.tsv", SITES)
+    build_variant_index(str(tmp_path / "sites.tsv"), index_dir)
+    variant_index = load_variant_index(index_dir)
+    assert load_variant_index(index_dir) is variant_index
+    assert len(variant_index) == len(SITES)
+
+    write_sites(tmp_path / "sites.tsv", SITES + [("Y", 10, "A", "G", "rs77", "GENEE")])
+    build_variant_index(str(tmp_path / "sites.tsv"), index_dir)
+    rebuilt_variant_index = load_variant_index(index_dir)
+    assert rebuilt_variant_index is not variant_index
+    assert rebuilt_variant_index.resolve_rsids(["rs77"]) == [[len(SITES)]]